@@ -29,6 +29,8 @@ import glob
 import MEE2024util
 import datetime
 import database_cache
+import platesolve_ensemble
+import profiling
 from multiprocessing import Process, Manager
 
 # default values for all options
@@ -96,6 +98,28 @@ options = {
     'remove_double_stars_eclipse':False,
     'safety_limit_mag':13,
     'object_centre_moon':False,
+    'show_progress':True, # show progress bar windows while stacking
+    'do_platesolve':True, # platesolve the stacked image
+    'platesolve_progressive':True, # platesolve with a small search first, widening it only if that fails
+    'platesolve_time_budget':60, # (in seconds) no wider platesolve search is started after this
+    'platesolve_mirror_mode':'single_pass', # single_pass: match mirrored fields in the same search, second_pass: search again
+    'platesolve_use_hint':True, # restrict the platesolve to the pointing in the FITS header (or platesolve_hint), if there is one
+    'platesolve_hint':'', # results.txt of a previous run (or a FITS file) whose pointing to use as platesolve hint
+    'platesolve_hint_radius':5, # (in degrees) how far the field centre may be from the pointing in the FITS header
+    'platesolve_cache':False, # reuse the solutions of previous platesolves of the same centroids
+    'platesolve_cache_dir':'PlatesolveCache',
+    'platesolve_cache_mb':50, # size cap of the platesolve cache
+    'platesolve_ensemble':False, # race the triangle solver against tetra3 (needs 'database'), see platesolve_ensemble.py
+    'ensemble_tetra3_budget':10, # seconds
+    'platesolve_ensemble_log':'platesolve_ensemble.jsonl', # which solver won, one line per platesolve
+    'platesolve_server':False, # solve through the local platesolve server (python platesolve_server.py), if it is running
+    'platesolve_server_port':47024,
+    'triangle_database_family':True, # choose the platesolve database(s) of the family by field of view (see platesolve_new.generate_family)
+    'triangle_local_index':'auto', # with a hint: match against a database built from the stars around the hinted pointing (True, False, or 'auto' for narrow fields)
+    'triangle_database_tiled':False, # load the platesolve database in sky tiles on demand (for small machines)
+    'triangle_tile_memory_mb':1024, # memory budget for the loaded sky tiles
+    'triangle_tile_threads':4, # number of threads loading sky tiles
+    'profile_stages':'', # comma separated stage names (or patterns such as 'stack.*') to profile, see profiling.py
 }
 
 def precheck_files(files, options, flag_write_ini=False):
@@ -155,27 +179,22 @@ if __name__ == '__main__':
     if len(sys.argv)>1: 
         print('ERROR: CLI is unimplemented')
         
-    if 0: #test code for performance test
+    # if no command line arguments, open GUI interface
+    if len(files)==0:
+        # read initial parameters from config.txt file
         MEE2024util.read_ini(options)
-        files = UI_handler.inputUI(options)
-        cProfile.run('handle_files(files, options)', sort='cumtime')
+        # (for performance tests, set 'profile_stages' in MEE_config.txt or the MEE2024_PROFILE environment variable, see profiling.py)
+        profiling.configure_script(options)
+        while True:
+            newfiles = UI_handler.inputUI(options) # get files
+            if newfiles is None:
+                break # end loop
+            files = newfiles
+            handle_files(files, options) # handle files
+            files.clear()
+        MEE2024util.write_ini(options)       
     else:
-        # if no command line arguments, open GUI interface
-        if len(files)==0:
-            # read initial parameters from config.txt file
-            MEE2024util.read_ini(options)
-            while True:
-                newfiles = UI_handler.inputUI(options) # get files
-                if newfiles is None:
-                    break # end loop
-                files = newfiles
-                handle_files(files, options) # handle files
-                files.clear()
-            MEE2024util.write_ini(options)       
-        else:
-            handle_files(files, options, flag_command_line = True) # use inputs from CLI
+        handle_files(files, options, flag_command_line = True) # use inputs from CLI
     print('closing')
-    # join triangles
-    if database_cache._cache.prepare_process.is_alive():
-        database_cache._cache.prepare_process.terminate() # terminate the prepare thread
-        database_cache._cache.q.close()
+    database_cache.stop_preparation() # terminate the preparation if it is still running
+    platesolve_ensemble.stop_tetra3()
@@ -0,0 +1,167 @@
+'''
+accuracy and throughput benchmark of the centroid detection backends
+
+renders single frames with known sub-pixel star positions and fluxes (see synthetic_data.py),
+optionally with hot pixels, a background gradient and a saturated Moon limb, and runs every
+detection backend on them:
+    tetra3              tetra3.get_centroids_from_image (the default, non-sensitive mode)
+    sensitive_gaussian  get_centroids_blur, 'Gaussian' background subtraction
+    sensitive_annular   get_centroids_blur, 'annular' background subtraction
+For each backend the candidates/s, the recall, the false-positive rate and the centroid
+RMS error (per magnitude bin) are reported, so speed and accuracy are tracked together.
+Results can be compared against a stored baseline as in benchmark_stacking.py
+
+example:
+    python benchmark_centroids.py --images 5 --hot-pixels 50 --gradient 0.5 --moon-radius 300 --output bench_centroids.json
+'''
+
+import sys
+import io
+import time
+import argparse
+import contextlib
+import numpy as np
+from scipy.spatial import KDTree
+import synthetic_data
+import benchmark_util
+import profiling
+import stacker_implementation
+from MEE2024Stacker import options as default_options
+
+# backend name -> (options overrides, offset to add to the centroids to get to the synthetic_data pixel convention)
+BACKENDS = {
+    'tetra3':({'centroid_gaussian_subtract':False}, -0.5), # tetra3 puts the centre of a pixel at +0.5
+    'sensitive_gaussian':({'centroid_gaussian_subtract':True, 'background_subtraction_mode':'Gaussian'}, 0.),
+    'sensitive_annular':({'centroid_gaussian_subtract':True, 'background_subtraction_mode':'annular'}, 0.),
+}
+
+'''
+detect the centroids on img the way the stacker does (blob removal, detection, filtering)
+returns (n x 2 array of (y, x), time in seconds, mask of the removed blob region)
+'''
+def detect(img, options, offset):
+    t0 = time.perf_counter()
+    reg_img, mask, mask2 = stacker_implementation.remove_saturated_blob(img, sat_val=None, radius=options['blob_radius_extra'],
+                                        radius2=options['blob_radius_extra']+options['centroid_gap_blob'],
+                                        blob_saturation=options['blob_saturation_level']/100, perform=options['delete_saturated_blob'])
+    centroids = stacker_implementation.get_centroids_blur((reg_img.astype(float), mask, mask2), options=options)
+    centroids = stacker_implementation.filter_bad_centroids(centroids, mask2, img.shape)
+    elapsed = time.perf_counter() - t0
+    return np.array([c[2] for c in centroids]).reshape((-1, 2)) + offset, elapsed, mask2
+
+'''
+one-to-one matching of detections to true stars (closest pairs first), within radius pixels
+returns (index of true star per detection or -1, distance per detection)
+'''
+def match(detected, truth, radius):
+    owner = -np.ones(detected.shape[0], dtype=int)
+    dist = np.full(detected.shape[0], np.inf)
+    if detected.shape[0] == 0 or truth.shape[0] == 0:
+        return owner, dist
+    d, j = KDTree(truth).query(detected, k=3, distance_upper_bound=radius)
+    candidates = sorted((d[i, k], i, j[i, k]) for i in range(d.shape[0]) for k in range(d.shape[1]) if np.isfinite(d[i, k]))
+    taken = set()
+    for di, i, ji in candidates:
+        if owner[i] == -1 and not ji in taken:
+            owner[i] = ji
+            dist[i] = di
+            taken.add(ji)
+    return owner, dist
+
+def evaluate(backend_runs, bins, recall_mag):
+    out = {'candidates/s':0., 'time_per_image_s':0., 'recall':None, 'false_positive_rate':None, 'rms_px':None, 'per_mag':{}}
+    n_det = sum(r['n_detected'] for r in backend_runs)
+    t = sum(r['time_s'] for r in backend_runs)
+    out['candidates/s'] = n_det / t if t > 0 else 0.
+    out['time_per_image_s'] = t / len(backend_runs)
+    mags = np.concatenate([r['true_mag'] for r in backend_runs])
+    found = np.concatenate([r['true_found'] for r in backend_runs])
+    err = np.concatenate([r['true_err'] for r in backend_runs])
+    bright = mags <= recall_mag
+    out['recall'] = float(np.mean(found[bright])) if np.any(bright) else None
+    out['false_positive_rate'] = sum(r['n_false'] for r in backend_runs) / n_det if n_det else 0.
+    out['rms_px'] = float(np.sqrt(np.mean(err[found & bright]**2))) if np.any(found & bright) else None
+    for lo, hi in zip(bins[:-1], bins[1:]):
+        sel = (mags >= lo) & (mags < hi)
+        key = f'{lo:g}-{hi:g}'
+        out['per_mag'][key] = {'n':int(np.sum(sel)),
+                               'recall':float(np.mean(found[sel])) if np.any(sel) else None,
+                               'rms_px':float(np.sqrt(np.mean(err[sel & found]**2))) if np.any(sel & found) else None}
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='accuracy and throughput benchmark of the centroid detection backends')
+    parser.add_argument('--images', type=int, default=3, help='number of images to render (different star fields)')
+    parser.add_argument('--shape', default='1000x1500', help='sensor size HxW in pixels')
+    parser.add_argument('--density', type=float, default=synthetic_data.defaults['star_density'], help='stars per megapixel')
+    parser.add_argument('--psf', default='gaussian', choices=['gaussian', 'moffat'])
+    parser.add_argument('--psf-sigma', type=float, default=synthetic_data.defaults['psf_sigma'])
+    parser.add_argument('--read-noise', type=float, default=synthetic_data.defaults['read_noise'])
+    parser.add_argument('--hot-pixels', type=int, default=30)
+    parser.add_argument('--gradient', type=float, default=0.3, help='relative background increase across the image')
+    parser.add_argument('--moon-radius', type=int, default=200, help='radius of saturated Moon (0 for none)')
+    parser.add_argument('--match-radius', type=float, default=2., help='pixels: detections further from any star are false positives')
+    parser.add_argument('--recall-mag', type=float, default=10., help='overall recall / rms is for stars up to this magnitude')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated subset of: ' + ', '.join(BACKENDS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help='show the output of the centroid finder')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='baseline json file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change flagged as regression')
+    args = parser.parse_args(argv)
+
+    shape = tuple(int(v) for v in args.shape.lower().split('x'))
+    config = synthetic_data.make_config(shape=shape, n_frames=1, star_density=args.density, psf=args.psf, psf_sigma=args.psf_sigma,
+                                        read_noise=args.read_noise, hot_pixels=args.hot_pixels, gradient=args.gradient,
+                                        blob_radius=args.moon_radius, blob_centre=(shape[0]*0.3, shape[1]*0.3), drift=(0, 0), jitter=0)
+    bins = np.arange(config['mag_range'][0], config['mag_range'][1] + 1, 1.)
+    backends = [b.strip() for b in args.backends.split(',') if b.strip()]
+    runs = {b:[] for b in backends}
+    for k in range(args.images):
+        img, truth = next(synthetic_data.render_sequence(config, seed=args.seed + k))
+        true_yx = np.c_[truth['y'], truth['x']]
+        on_image = (true_yx[:, 0] >= 0) & (true_yx[:, 0] < shape[0]) & (true_yx[:, 1] >= 0) & (true_yx[:, 1] < shape[1])
+        for b in backends:
+            if not b in BACKENDS:
+                raise Exception("unknown backend: " + b)
+            overrides, offset = BACKENDS[b]
+            options = dict(default_options, **overrides)
+            with contextlib.redirect_stdout(io.StringIO()) if args.quiet else contextlib.nullcontext():
+                detected, elapsed, mask2 = detect(img, options, offset)
+            # only stars which are on the image and outside the removed Moon region can be found
+            iy = np.clip(true_yx[:, 0].astype(int), 0, shape[0]-1)
+            ix = np.clip(true_yx[:, 1].astype(int), 0, shape[1]-1)
+            findable = on_image & ~mask2.astype(bool)[iy, ix]
+            owner, dist = match(detected, true_yx[findable], args.match_radius)
+            found = np.zeros(np.sum(findable), dtype=bool)
+            err = np.full(np.sum(findable), np.nan)
+            found[owner[owner >= 0]] = True
+            err[owner[owner >= 0]] = dist[owner >= 0]
+            runs[b].append({'time_s':elapsed, 'n_detected':int(detected.shape[0]), 'n_false':int(np.sum(owner < 0)),
+                            'true_mag':truth['mag'][findable], 'true_found':found, 'true_err':err})
+            print(f'image {k+1}/{args.images} {b}: {detected.shape[0]} detections ({np.sum(owner < 0)} false) '
+                  f'of {np.sum(findable)} stars in {elapsed:.2f} s')
+
+    metrics = {b:evaluate(runs[b], bins, args.recall_mag) for b in backends}
+    print(f'\n{"backend":20s} {"cand/s":>9s} {"s/image":>8s} {"recall":>7s} {"FP rate":>8s} {"rms/px":>7s}')
+    fmt = lambda v, f: format(v, f) if v is not None else '-'
+    for b, m in metrics.items():
+        print(f'{b:20s} {m["candidates/s"]:9.0f} {m["time_per_image_s"]:8.3f} {fmt(m["recall"], "7.3f"):>7s} '
+              f'{m["false_positive_rate"]:8.3f} {fmt(m["rms_px"], "7.3f"):>7s}')
+        for key, v in m['per_mag'].items():
+            print(f'    mag {key:8s} n={v["n"]:5d} recall={fmt(v["recall"], ".3f")} rms={fmt(v["rms_px"], ".3f")}')
+    config = dict(vars(args), **{'synthetic':config})
+    for k in ('output', 'baseline', 'save_baseline', 'quiet', 'tolerance'):
+        config.pop(k)
+    results = benchmark_util.run_info()
+    results.update({'benchmark':'centroids', 'config':config, 'metrics':metrics})
+    if args.output:
+        benchmark_util.save_json(args.output, results)
+    regressed = benchmark_util.check_baseline(results, args.baseline, args.save_baseline,
+                                              higher_is_better=('/s', 'recall'), tolerance=args.tolerance)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    profiling.configure_script()
+    sys.exit(main())
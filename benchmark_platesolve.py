@@ -0,0 +1,158 @@
+'''
+latency and reliability benchmark of the triangle platesolver (platesolve_triangle.platesolve)
+
+centroid lists are synthesised from the bundled Tycho catalogue (see synthetic_data.synthetic_centroids)
+for random pointings, fields of view, rolls, mirror flags, distortion levels and contamination rates,
+and solved one after another. Reported are the latency percentiles, the success rate (solved and
+correct) and the false-positive rate (solved, but wrong). Everything is written to a json file
+(with the per-trial records), which can be stored as a baseline to compare solver changes against
+
+examples:
+    python benchmark_platesolve.py --trials 200 --baseline bench_platesolve.json --save-baseline
+    python benchmark_platesolve.py --trials 200 --baseline bench_platesolve.json
+'''
+
+import sys
+import io
+import time
+import argparse
+import contextlib
+import numpy as np
+import synthetic_data
+import benchmark_util
+import profiling
+import transforms
+import database_cache
+import platesolve_triangle
+from MEE2024util import resource_path
+
+catalogue_path = "resources/compressed_tycho2024epoch.npz"
+
+'''
+draw the parameters of one trial
+'''
+def random_trial(rng, args):
+    fov = rng.uniform(args.fov_min, args.fov_max) # degrees (along the width)
+    return {'ra':rng.uniform(0, 2*np.pi),
+            'dec':np.arcsin(rng.uniform(-1, 1)),
+            'roll':rng.uniform(0, 2*np.pi),
+            'scale':np.radians(fov) / args.shape[1], # radians per pixel
+            'fov':fov,
+            'mirror':bool(rng.uniform() < args.mirror_fraction),
+            'distortion':rng.uniform(0, args.max_distortion),
+            'contamination':rng.uniform(0, args.max_contamination)}
+
+'''
+is the solution correct? compares where the true and the solved plate solution put a few
+test points of the image (centre, and half way to the corners)
+returns the largest error in degrees
+'''
+def solution_error(result, trial, image_shape):
+    h, w = image_shape
+    p = np.array([[0, 0], [h/4, w/4], [-h/4, w/4], [h/4, -w/4], [-h/4, -w/4]], dtype=float)
+    x_true = (trial['scale'], trial['ra'], trial['dec'], trial['roll'])
+    true_vect = transforms.linear_transform(x_true, p[:, ::-1].copy() if trial['mirror'] else p.copy())
+    solved_vect = transforms.linear_transform(result['x'], p[:, ::-1].copy() if result['mirror'] else p.copy())
+    return np.degrees(np.max(np.linalg.norm(true_vect - solved_vect, axis=1)))
+
+def run_trial(trial, star_table, args, rng, options):
+    image_shape = tuple(args.shape)
+    x_true = (trial['scale'], trial['ra'], trial['dec'], trial['roll'])
+    centroids, is_star = synthetic_data.synthetic_centroids(star_table, x_true, image_shape, rng, n_stars=args.stars,
+                                                            distortion=trial['distortion'], contamination=trial['contamination'],
+                                                            mirror=trial['mirror'])
+    if trial['mirror']:
+        image_shape = (image_shape[1], image_shape[0])
+    record = dict(trial, n_centroids=int(centroids.shape[0]), n_spurious=int(np.sum(~is_star)))
+    if centroids.shape[0] < 4:
+        record.update({'solved':False, 'correct':False, 'latency_s':0., 'error_deg':None, 'skipped':True})
+        return record
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out) if args.quiet else contextlib.nullcontext():
+        t0 = time.perf_counter()
+        result = platesolve_triangle.platesolve(centroids, image_shape, options)
+        latency = time.perf_counter() - t0
+    record['latency_s'] = latency
+    record['solved'] = bool(result['success'])
+    record['stage'] = result.get('stage')
+    record['error_deg'] = solution_error(result, trial, args.shape) if result['success'] else None
+    record['correct'] = bool(record['solved'] and record['error_deg'] < max(args.tolerance, 0.02 * trial['fov']))
+    return record
+
+def summarise(records):
+    done = [r for r in records if not r.get('skipped')]
+    latency = np.array([r['latency_s'] for r in done])
+    solved = np.array([r['solved'] for r in done], dtype=bool)
+    correct = np.array([r['correct'] for r in done], dtype=bool)
+    n = max(len(done), 1)
+    return {'latency_s':{'p50':float(np.percentile(latency, 50)),
+                         'p90':float(np.percentile(latency, 90)),
+                         'p99':float(np.percentile(latency, 99)),
+                         'mean':float(np.mean(latency)),
+                         'max':float(np.max(latency))} if latency.size else {},
+            'success_rate':float(np.sum(correct)) / n,
+            'false_positive_rate':float(np.sum(solved & ~correct)) / n,
+            'failure_rate':float(np.sum(~solved)) / n,
+            'n_trials':len(done),
+            'n_skipped':len(records) - len(done)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='latency and success-rate benchmark of the triangle platesolver')
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--shape', default='3000x4000', help='sensor size HxW in pixels')
+    parser.add_argument('--fov-min', type=float, default=2, help='minimum field of view (width) in degrees')
+    parser.add_argument('--fov-max', type=float, default=10, help='maximum field of view (width) in degrees')
+    parser.add_argument('--stars', type=int, default=100, help='number of (brightest) stars in each centroid list')
+    parser.add_argument('--mirror-fraction', type=float, default=0.2, help='fraction of mirror-imaged fields')
+    parser.add_argument('--max-distortion', type=float, default=0.002, help='maximum radial distortion coefficient')
+    parser.add_argument('--max-contamination', type=float, default=0.2, help='maximum fraction of spurious centroids')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='degrees: a solution further off counts as a false positive')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--single-stage', dest='progressive', action='store_false', help='search with the full (f, g, TOLERANCE) at once instead of progressively')
+    parser.add_argument('--time-budget', type=float, default=platesolve_triangle.TIME_BUDGET, help='seconds after which the solver starts no wider search')
+    parser.add_argument('--mirror-mode', default='single_pass', choices=['single_pass', 'second_pass'], help='how mirrored fields are searched')
+    parser.add_argument('--verbose', dest='quiet', action='store_false', help='show the output of the platesolver')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='baseline json file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--regression-tolerance', type=float, default=0.2, help='relative change flagged as regression')
+    args = parser.parse_args(argv)
+    args.shape = [int(v) for v in args.shape.lower().split('x')]
+
+    database_cache.prepare_triangles()
+    dbs = database_cache.open_catalogue(resource_path(catalogue_path))
+    database_cache.open_catalogue(database_cache.triangles_path) # load the triangle database before timing anything
+    options = {'flag_display':False, 'rough_match_threshhold':36, 'flag_display2':False, 'flag_debug':False,
+               'platesolve_progressive':args.progressive, 'platesolve_time_budget':args.time_budget,
+               'platesolve_mirror_mode':args.mirror_mode,
+               'platesolve_cache':False}
+    rng = np.random.default_rng(args.seed)
+    records = []
+    for i in range(args.trials):
+        trial = random_trial(rng, args)
+        record = run_trial(trial, dbs.star_table, args, rng, options)
+        records.append(record)
+        status = 'skipped' if record.get('skipped') else 'ok' if record['correct'] else 'WRONG' if record['solved'] else 'failed'
+        print(f'trial {i+1}/{args.trials}: fov={trial["fov"]:.1f} mirror={trial["mirror"]} contamination={trial["contamination"]:.2f} '
+              f'distortion={trial["distortion"]:.4f} -> {status} ({record["latency_s"]:.2f} s)')
+
+    metrics = summarise(records)
+    config = {k:v for k, v in vars(args).items() if not k in ('output', 'baseline', 'save_baseline', 'quiet', 'regression_tolerance')}
+    config['solver'] = {'f':platesolve_triangle.f, 'g':platesolve_triangle.g, 'TOLERANCE':platesolve_triangle.TOLERANCE,
+                        'progressive':args.progressive, 'schedule':platesolve_triangle.SCHEDULE, 'time_budget':args.time_budget,
+                        'mirror_mode':args.mirror_mode}
+    results = benchmark_util.run_info()
+    results.update({'benchmark':'platesolve', 'config':config, 'metrics':metrics, 'trials':records})
+    print(f'\nsuccess rate {metrics["success_rate"]*100:.1f}%, false positives {metrics["false_positive_rate"]*100:.1f}%, '
+          f'failures {metrics["failure_rate"]*100:.1f}% ({metrics["n_trials"]} trials)')
+    if metrics['latency_s']:
+        print('latency/s: ' + ', '.join(f'{k}={v:.3f}' for k, v in metrics['latency_s'].items()))
+    if args.output:
+        benchmark_util.save_json(args.output, results)
+    regressed = benchmark_util.check_baseline(results, args.baseline, args.save_baseline,
+                                              higher_is_better=('success_rate',), tolerance=args.regression_tolerance)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    profiling.configure_script()
+    sys.exit(main())
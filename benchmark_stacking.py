@@ -0,0 +1,140 @@
+'''
+end-to-end benchmark of the stacking pipeline (stacker_implementation.do_stack) on synthetic star fields
+
+generates a synthetic FITS sequence (see synthetic_data.py), stacks it headless and reports
+the time spent in each phase of do_stack, the throughput in frames/s and MB/s, and the
+number of centroids found. Results can be saved as a baseline, and later runs compared
+against it: any phase more than --tolerance slower (or throughput lower) is flagged as a
+regression and the exit code is 1
+
+examples:
+    python benchmark_stacking.py --frames 10 --shape 2000x3000 --baseline bench_stack.json --save-baseline
+    python benchmark_stacking.py --frames 10 --shape 2000x3000 --baseline bench_stack.json
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import synthetic_data
+import benchmark_util
+import profiling
+import instrumentation
+import stacker_implementation
+from MEE2024Stacker import options as default_options
+
+# benchmark phase -> instrumentation span of do_stack
+PHASES = {
+    'io':'stack.io',
+    'blob_removal':'stack.blob_removal',
+    'centroiding':'stack.centroiding',
+    'alignment':'stack.alignment',
+    'accumulation':'stack.accumulation',
+    'output':'stack.output',
+    'centroiding_stacked':'stack.centroiding_stacked',
+}
+
+'''
+stack the files once, returns the metrics of this run
+'''
+def run_once(files, options):
+    n_bytes = sum(os.path.getsize(f) for f in files)
+    t0 = time.perf_counter()
+    result = stacker_implementation.do_stack(files, [], [], options, archive=False)
+    total = time.perf_counter() - t0
+    summary = instrumentation.current().summary()
+    phases = {phase:summary[name]['wall_s'] if name in summary else 0. for phase, name in PHASES.items()}
+    io = summary.get('stack.io', {'wall_s':0., 'count':0})
+    bytes_read = n_bytes * io['count'] / len(files) # every frame is read once for centroiding and once for stacking
+    metrics = {'total_s':total,
+               'phase_s':phases,
+               'frames/s':len(files) / total,
+               'MB/s':n_bytes / 2**20 / total,
+               'io_MB/s':bytes_read / 2**20 / io['wall_s'] if io['wall_s'] > 0 else None,
+               'peak_rss_mb':max((agg['peak_rss_mb'] or 0 for agg in summary.values()), default=None),
+               'n_centroids':result.results['n_centroids']}
+    shutil.rmtree(result.output_dir, ignore_errors=True)
+    return metrics
+
+'''
+median of each metric over the repeats
+'''
+def median_metrics(runs):
+    out = {}
+    for k, v in runs[0].items():
+        if isinstance(v, dict):
+            out[k] = median_metrics([r[k] for r in runs])
+        elif v is None:
+            out[k] = None
+        else:
+            out[k] = float(np.median([r[k] for r in runs]))
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark of the stacking pipeline on synthetic data')
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--shape', default='1000x1500', help='sensor size HxW in pixels')
+    parser.add_argument('--density', type=float, default=synthetic_data.defaults['star_density'], help='stars per megapixel')
+    parser.add_argument('--psf', default='gaussian', choices=['gaussian', 'moffat'])
+    parser.add_argument('--psf-sigma', type=float, default=synthetic_data.defaults['psf_sigma'])
+    parser.add_argument('--read-noise', type=float, default=synthetic_data.defaults['read_noise'])
+    parser.add_argument('--drift', default='0.7,1.3', help='dy,dx in pixels per frame')
+    parser.add_argument('--blob-radius', type=int, default=150, help='radius of saturated Moon/Sun blob (0 for none)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs (median is reported)')
+    parser.add_argument('--sensitive', action='store_true', help='use the sensitive (gaussian subtract) centroiding mode')
+    parser.add_argument('--workdir', default=None, help='where to write the synthetic frames (default: temporary directory)')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='baseline json file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown flagged as regression')
+    args = parser.parse_args(argv)
+
+    config = synthetic_data.make_config(shape=tuple(int(v) for v in args.shape.lower().split('x')),
+                                        n_frames=args.frames,
+                                        star_density=args.density,
+                                        psf=args.psf,
+                                        psf_sigma=args.psf_sigma,
+                                        read_noise=args.read_noise,
+                                        drift=tuple(float(v) for v in args.drift.split(',')),
+                                        blob_radius=args.blob_radius,
+                                        seed=args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='MEE2024_bench_')
+    try:
+        print(f'generating {args.frames} synthetic frames in {workdir}')
+        files = synthetic_data.write_sequence(os.path.join(workdir, 'frames'), config)
+        options = dict(default_options)
+        options.update({'flag_display':False, 'flag_display2':False, 'flag_display3':False,
+                        'show_progress':False, 'do_platesolve':False,
+                        'output_dir':workdir,
+                        'centroid_gaussian_subtract':args.sensitive})
+        runs = []
+        for i in range(args.repeat):
+            print(f'--- run {i+1} of {args.repeat} ---')
+            runs.append(run_once(files, options))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    metrics = median_metrics(runs)
+    results = benchmark_util.run_info()
+    results.update({'benchmark':'stacking', 'config':config, 'repeat':args.repeat,
+                    'sensitive':args.sensitive, 'metrics':metrics, 'runs':runs})
+    print(f'\n{"phase":25s} {"median wall/s":>14s}')
+    for phase, t in metrics['phase_s'].items():
+        print(f'{phase:25s} {t:14.3f}')
+    print(f'{"total":25s} {metrics["total_s"]:14.3f}')
+    print(f'throughput: {metrics["frames/s"]:.2f} frames/s, {metrics["MB/s"]:.1f} MB/s (file reading {metrics["io_MB/s"] or 0:.1f} MB/s)')
+    print(f'centroids on stacked image: {metrics["n_centroids"]:.0f}')
+    if args.output:
+        benchmark_util.save_json(args.output, results)
+    regressed = benchmark_util.check_baseline(results, args.baseline, args.save_baseline,
+                                              higher_is_better=('/s', 'n_centroids'), tolerance=args.tolerance)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    profiling.configure_script()
+    sys.exit(main())
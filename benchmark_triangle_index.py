@@ -0,0 +1,130 @@
+'''
+benchmark of the triangle search indices of the platesolving database
+
+builds each index over the (ratio, dphi) triangle features of the database:
+    kdtree  scipy KDTree with boxsize=[9999999, 2 pi] (what TriangleData builds from a npz)
+    grid    triangle_database.GridIndex (sorted by ratio bin, then dphi; the default of the database)
+    hash    triangle_database.HashIndex (fixed buckets, CSR offsets, float16 positions)
+and reports the build time, the memory of the index, the query throughput for batches of
+points near database triangles (as the observed triangles of a real field are) and the
+agreement of the results with the KDTree. Results can be compared against a stored baseline
+as in benchmark_stacking.py
+
+example:
+    python benchmark_triangle_index.py --queries 20000 --output bench_index.json
+'''
+
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.spatial import KDTree
+import benchmark_util
+import profiling
+import triangle_database
+import database_cache
+import platesolve_triangle
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def _rss():
+    return psutil.Process().memory_info().rss if psutil is not None else None
+
+'''
+build one index, returns (index, build time in seconds, memory in bytes)
+'''
+def build(name, triangles, cell):
+    rss0 = _rss()
+    t0 = time.perf_counter()
+    if name == 'kdtree':
+        index = KDTree(triangles, boxsize=[9999999, np.pi*2])
+    elif name == 'grid':
+        index = triangle_database.GridIndex(triangles, *triangle_database.GridIndex.build(triangles, cell), cell)
+    elif name == 'hash':
+        index = triangle_database.HashIndex(*triangle_database.HashIndex.build(triangles, cell), cell)
+    else:
+        raise Exception("unknown index: " + name)
+    elapsed = time.perf_counter() - t0
+    if name in ('grid', 'hash'):
+        n_bytes = index.nbytes
+    else: # (the tree lives in C++: use the growth of the process memory)
+        n_bytes = _rss() - rss0 if rss0 is not None else None
+    return index, elapsed, n_bytes
+
+def query(index, points, tolerance):
+    if hasattr(index, 'query_flat'):
+        lengths, found = index.query_flat(points, tolerance)
+        return [part.tolist() for part in np.split(found, np.cumsum(lengths)[:-1])]
+    return list(index.query_ball_point(points, tolerance, workers=-1, return_sorted=True))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark of the triangle search indices')
+    parser.add_argument('--database', default=database_cache.triangles_path, help='npz triangle database')
+    parser.add_argument('--indices', default='kdtree,grid,hash', help='comma separated subset of: kdtree, grid, hash')
+    parser.add_argument('--queries', type=int, default=10000, help='number of query points per batch')
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=platesolve_triangle.TOLERANCE, help='query radius')
+    parser.add_argument('--cell', type=float, default=triangle_database.GRID_CELL, help='bin width of the grid and hash indices')
+    parser.add_argument('--noise', type=float, default=0.003, help='scatter of the query points around database triangles')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='baseline json file to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--regression-tolerance', type=float, default=0.2, help='relative change flagged as regression')
+    args = parser.parse_args(argv)
+
+    directory = triangle_database.directory_for(args.database)
+    if not triangle_database.is_valid(directory, args.database):
+        triangle_database.convert(args.database, directory)
+    arrays, _ = triangle_database.open_directory(directory)
+    triangles = np.ascontiguousarray(arrays['triangles']).reshape((-1, 2))
+    print(f'{triangles.shape[0]} triangles')
+    rng = np.random.default_rng(args.seed)
+    batches = []
+    for _ in range(args.batches):
+        points = triangles[rng.integers(0, triangles.shape[0], args.queries)] + rng.normal(0, args.noise, (args.queries, 2))
+        points[:, 1] %= 2 * np.pi
+        batches.append(points)
+
+    names = [n.strip() for n in args.indices.split(',') if n.strip()]
+    metrics = {}
+    reference = None
+    for name in names:
+        index, build_s, n_bytes = build(name, triangles, args.cell)
+        t0 = time.perf_counter()
+        results = [query(index, points, args.tolerance) for points in batches]
+        query_s = time.perf_counter() - t0
+        results = [r for batch in results for r in batch]
+        if reference is None and name == 'kdtree':
+            reference = results
+        m = {'build_s':build_s,
+             'memory_mb':n_bytes / 2**20 if n_bytes is not None else None,
+             'bytes/triangle':n_bytes / triangles.shape[0] if n_bytes is not None else None,
+             'queries/s':len(results) / query_s,
+             'matches/query':float(np.mean([len(r) for r in results]))}
+        if reference is not None:
+            m['agreement'] = float(np.mean([a == b for a, b in zip(reference, results)]))
+        metrics[name] = m
+        del index
+
+    print(f'\n{"index":8s} {"build/s":>9s} {"MB":>9s} {"B/tri":>7s} {"queries/s":>11s} {"agreement":>10s}')
+    fmt = lambda v, f: format(v, f) if v is not None else '-'
+    for name, m in metrics.items():
+        print(f'{name:8s} {m["build_s"]:9.3f} {fmt(m["memory_mb"], "9.1f"):>9s} {fmt(m["bytes/triangle"], "7.1f"):>7s} '
+              f'{m["queries/s"]:11.0f} {fmt(m.get("agreement"), "10.5f"):>10s}')
+    config = {k:v for k, v in vars(args).items() if not k in ('output', 'baseline', 'save_baseline', 'regression_tolerance')}
+    config['n_triangles'] = int(triangles.shape[0])
+    results = benchmark_util.run_info()
+    results.update({'benchmark':'triangle_index', 'config':config, 'metrics':metrics})
+    if args.output:
+        benchmark_util.save_json(args.output, results)
+    regressed = benchmark_util.check_baseline(results, args.baseline, args.save_baseline,
+                                              higher_is_better=('/s', 'agreement'), tolerance=args.regression_tolerance)
+    return 1 if regressed else 0
+
+if __name__ == '__main__':
+    profiling.configure_script()
+    sys.exit(main())
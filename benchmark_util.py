@@ -0,0 +1,91 @@
+'''
+helpers shared by the benchmark_*.py scripts: saving results and comparing against a stored baseline
+'''
+
+import json
+import platform
+import sys
+import datetime
+from MEE2024util import _version
+
+'''
+common header of every benchmark result file
+'''
+def run_info():
+    return {'version':_version(),
+            'date':datetime.datetime.now().isoformat(timespec='seconds'),
+            'python':sys.version.split()[0],
+            'platform':platform.platform(),
+            'processor':platform.processor() or platform.machine()}
+
+def save_json(path, results):
+    with open(path, 'w', encoding="utf-8") as fp:
+        json.dump(results, fp, indent=4, default=str)
+    print(f'results saved to {path}')
+
+def load_json(path):
+    with open(path, 'r', encoding="utf-8") as fp:
+        return json.load(fp)
+
+def _flatten(d, prefix=''):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(_flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool) and v is not None:
+            out[prefix + k] = float(v)
+    return out
+
+'''
+compare the (possibly nested) numeric metrics of a run against a baseline
+higher_is_better: names (or name endings, e.g. '/s') of metrics where a decrease is a regression;
+                  for all other metrics (e.g. times) an increase is a regression
+tolerance: allowed relative change before it counts as a regression
+returns list of (name, baseline, current, relative change, is_regression)
+'''
+def compare(metrics, baseline_metrics, higher_is_better=(), tolerance=0.2):
+    current = _flatten(metrics)
+    base = _flatten(baseline_metrics)
+    rows = []
+    for name in current:
+        if not name in base or base[name] == 0:
+            continue
+        change = (current[name] - base[name]) / abs(base[name])
+        higher = any(name == h or name.endswith(h) for h in higher_is_better)
+        regression = change < -tolerance if higher else change > tolerance
+        rows.append((name, base[name], current[name], change, regression))
+    return rows
+
+'''
+print the comparison table, returns True if any metric regressed
+'''
+def report_comparison(rows, tolerance=0.2):
+    print(f'{"metric":45s} {"baseline":>12s} {"current":>12s} {"change":>8s}')
+    for name, b, c, change, regression in rows:
+        print(f'{name:45s} {b:12.4g} {c:12.4g} {change*100:7.1f}%' + ('  REGRESSION' if regression else ''))
+    n_bad = sum(1 for r in rows if r[4])
+    if n_bad:
+        print(f'WARNING: {n_bad} metric(s) regressed by more than {tolerance*100:.0f}% against the baseline')
+    else:
+        print('no regressions against the baseline')
+    return n_bad > 0
+
+'''
+compare results against the baseline file (if given), and/or store them as the new baseline
+returns True if there was a regression
+'''
+def check_baseline(results, baseline_path=None, save_baseline=False, higher_is_better=(), tolerance=0.2):
+    regressed = False
+    if baseline_path and not save_baseline:
+        try:
+            baseline = load_json(baseline_path)
+        except FileNotFoundError:
+            print(f'note: baseline {baseline_path} not found, use --save-baseline to create it')
+        else:
+            if baseline.get('config') != json.loads(json.dumps(results.get('config'), default=str)):
+                print('WARNING: baseline was recorded with a different configuration')
+            print(f'comparing against baseline {baseline_path} (version {baseline.get("version")}, {baseline.get("date")})')
+            regressed = report_comparison(compare(results['metrics'], baseline['metrics'], higher_is_better, tolerance), tolerance)
+    if baseline_path and save_baseline:
+        save_json(baseline_path, results)
+    return regressed
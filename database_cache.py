@@ -3,9 +3,14 @@ import database_lookup2
 import gaia_search
 import numpy as np
 from scipy.spatial import KDTree
+import os
+import json
+import threading
 import time
 import platesolve_new
-from multiprocessing import Process, Queue
+import triangle_database
+from multiprocessing import Process
+from concurrent.futures import Future
 
 class _cache:
 
@@ -13,37 +18,204 @@ class _cache:
 
     catalogue_cache = {}
 
-    q = None
+    triangles_future = None # concurrent.futures.Future of the TriangleData, set by prepare_triangles
 
-    prepare_process = None
+    prepare_process = None # (process mode only) child process generating / converting the database
+
+    tile_cache = {} # path -> triangle_database.TileCache of the sky-tiled triangle database
+
+    local_triangles = [] # (centre, radius, fov, TriangleData or None) of the local triangle databases, most recently used last
+
+    local_lock = threading.Lock()
 
 class TriangleData:
 
-    def __init__(self, cata_data):
+    def __init__(self, cata_data, kd_tree=None, directory=None):
         self.triangles = cata_data['triangles'] # (n x T x 2 array) - radius ratio and angular seperation for each triangle (note: T = N(N-1)/2)
         self.anchors = cata_data['anchors'] # vector rep of each "anchor" star
         self.pattern_data = cata_data['pattern_data'] # (n x N x 5 array) of (dtheta, phi, star_vector) for each neighbour star
         self.pattern_ind = cata_data['pattern_ind'] # n x N array of integer : the indices of neighbouring stars
-        self.kd_tree = KDTree(self.triangles.reshape((-1, 2)), boxsize=[9999999, np.pi*2]) # use a 2-pi periodic condition for polar angle (and basically infinity for ratio)
+        if kd_tree is None:
+            kd_tree = KDTree(self.triangles.reshape((-1, 2)), boxsize=[9999999, np.pi*2]) # use a 2-pi periodic condition for polar angle (and basically infinity for ratio)
+        self.kd_tree = kd_tree # anything with a KDTree-like query_ball_point, e.g. triangle_database.GridIndex
+        self.directory = directory # set if memory-mapped from a triangle_database directory
+
+    # memory-mapped data is sent to other processes as its directory (and mapped again there) instead of being copied
+    def __reduce_ex__(self, protocol):
+        if self.directory is not None:
+            return (open_triangle_directory, (self.directory,))
+        return super().__reduce_ex__(protocol)
+
+def open_triangle_directory(directory):
+    arrays, index = triangle_database.open_directory(directory)
+    return TriangleData(arrays, kd_tree=index, directory=directory)
 
 triangles_path = "TripleTrianglePlatesolveDatabase/TripleTriangle_pattern_data.npz"
-def work(q):
-    print("working on loading triangles")
+family_path = "TripleTrianglePlatesolveDatabase/family.json" # manifest of the databases tuned to fields of view, see platesolve_new.generate_family
+
+'''
+open the triangle database (memory-mapped, see triangle_database.py), converting it from the npz on first use
+'''
+def load_triangles(path=triangles_path):
+    directory, arrays, index = triangle_database.load(path)
+    return TriangleData(arrays, kd_tree=index, directory=directory)
+
+'''
+open the triangle database, first generating it if there is none (this takes a few minutes)
+'''
+def _prepare(path=triangles_path):
     try:
-        q.put(TriangleData(np.load(triangles_path)))
+        data = load_triangles(path)
         print("preloaded triangles")
     except Exception:
         print("no triangles platesolving database found: will now generate one (this will take a few minutes)")
-        platesolve_new.generate()
-        q.put(TriangleData(np.load(triangles_path)))
+        platesolve_new.generate(output_path=path)
+        data = load_triangles(path)
     print("finished preparation work")
+    return data
+
+# (process mode) runs in the child: only makes sure the database files exist, the parent then maps them
+def _prepare_files(path):
+    _prepare(path)
+
+def _load_in_thread(future, path):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(_prepare(path))
+    except BaseException as e:
+        future.set_exception(e)
+
+def _load_after_process(future, process, path):
+    process.join() # (blocks on the process sentinel, no polling)
+    if not future.set_running_or_notify_cancel():
+        return
+    if process.exitcode != 0:
+        future.set_exception(Exception(f"triangle database preparation failed (exit code {process.exitcode})"))
+        return
+    try:
+        future.set_result(load_triangles(path))
+    except BaseException as e:
+        future.set_exception(e)
+
+'''
+start loading the triangle database in the background, open_catalogue(triangles_path) then waits until it is ready
+mode: 'thread' - load in a background thread (memory-mapping takes milliseconds)
+      'process' - generate / convert the database files in a child process (keeps the heavy one-off work
+                  out of this process), then memory-map them here: nothing is pickled between the processes
+      'auto' - thread if the converted database already exists, else process
+returns the Future of the TriangleData
+'''
+def prepare_triangles(mode='auto', path=triangles_path):
+    if _cache.triangles_future is not None:
+        return _cache.triangles_future
+    if mode == 'auto':
+        mode = 'thread' if triangle_database.is_valid(triangle_database.directory_for(path), path) else 'process'
+    print('preparing triangles ('+mode+')')
+    future = Future()
+    if mode == 'thread':
+        threading.Thread(target=_load_in_thread, args=(future, path), daemon=True, name='prepare_triangles').start()
+    elif mode == 'process':
+        _cache.prepare_process = Process(target=_prepare_files, args=(path,))
+        _cache.prepare_process.start()
+        threading.Thread(target=_load_after_process, args=(future, _cache.prepare_process, path), daemon=True, name='prepare_triangles').start()
+    else:
+        raise Exception("unknown mode for prepare_triangles: " + str(mode))
+    _cache.triangles_future = future
+    return future
+
+'''
+open the sky-tiled triangle database (see triangle_database.TileCache), splitting the database at path into tiles on first use
+'''
+def open_triangle_tiles(path=triangles_path, memory_budget_mb=1024):
+    if not path in _cache.tile_cache:
+        directory = triangle_database.tiles_directory_for(path)
+        if not triangle_database.tiles_valid(directory, path):
+            if not os.path.exists(path):
+                _prepare(path) # generates the database
+            triangle_database.build_tiles(path, directory)
+        _cache.tile_cache[path] = triangle_database.TileCache(directory, memory_budget_mb * 2**20)
+    return _cache.tile_cache[path]
+
+'''
+the available databases of the family: dictionary name -> {'path', 'fov' (min, max) in degrees}
+without a family manifest, only the standard database (which is generated on first use)
+'''
+def read_family(path=family_path):
+    standard = {'standard':{'path':triangles_path, 'fov':list(platesolve_new.DATABASE_FAMILY['standard']['fov'])}}
+    if not os.path.exists(path):
+        return standard
+    with open(path, 'r', encoding="utf-8") as fp:
+        members = json.load(fp)['members']
+    members = {name:m for name, m in members.items() if os.path.exists(m['path']) or m['path'] == triangles_path}
+    return members if members else standard
+
+'''
+paths of the triangle databases to search for an image of image_shape (pixels)
+scale: (min, max) platescale in arcsec/pixel (e.g. hint['scale']), or None if unknown
+with a platescale, the databases whose field of view band overlaps that of the image (else the closest one),
+without, all databases of the family (they are then searched concurrently), ordered by the width of their band
+'''
+def select_triangle_databases(image_shape, scale=None, family=None, verbose=True):
+    family = family if family is not None else read_family()
+    members = sorted(family.values(), key=lambda m: m['fov'][0])
+    if scale is None or image_shape is None:
+        return [m['path'] for m in members]
+    fov = (max(image_shape[:2]) * scale[0] / 3600, max(image_shape[:2]) * scale[1] / 3600)
+    selected = [m['path'] for m in members if m['fov'][0] <= fov[1] and fov[0] <= m['fov'][1]]
+    if not selected: # (outside all bands: log-distance to the nearest band)
+        distance = lambda m: max(np.log(m['fov'][0] / fov[1]), np.log(fov[0] / m['fov'][1]), 0)
+        selected = [min(members, key=distance)['path']]
+    if verbose:
+        print(f'field of view {fov[0]:.2f}-{fov[1]:.2f} degrees: using triangle database(s) {selected}')
+    return selected
+
+'''
+open a triangle database of the family (the standard one via open_catalogue, i.e. waiting for prepare_triangles)
+'''
+def open_triangle_database(path):
+    if path == triangles_path:
+        return open_catalogue(path)
+    if not path in _cache.catalogue_cache:
+        _cache.catalogue_cache[path] = load_triangles(path)
+    return _cache.catalogue_cache[path]
+
+LOCAL_MARGIN = 1.5 # a local triangle database covers this multiple of the requested radius, so nearby pointings reuse it
+LOCAL_CACHE_SIZE = 16
+
+'''
+local triangle database (see platesolve_new.generate_local) covering the stars within radius (degrees) of centre (unit vector),
+for fields fov degrees wide. Databases are cached per sky region: a cached one is reused if it covers the requested region
+and was built for (nearly) the same field of view. None if there are too few catalogue stars in the region
+'''
+def open_local_triangles(centre, radius, fov):
+    with _cache.local_lock:
+        for i, (c, r, f, data) in enumerate(_cache.local_triangles):
+            distance = np.degrees(np.arccos(np.clip(np.dot(c, centre), -1, 1)))
+            if abs(f / fov - 1) < 0.1 and distance + radius <= r:
+                _cache.local_triangles.append(_cache.local_triangles.pop(i))
+                return data
+        t0 = time.perf_counter()
+        arrays = platesolve_new.generate_local(centre, radius * LOCAL_MARGIN, fov)
+        data = TriangleData(arrays) if arrays is not None else None
+        if data is not None:
+            print(f'built local triangle database: {data.anchors.shape[0]} anchors, {data.triangles.shape[0] * data.triangles.shape[1]} triangles ({time.perf_counter() - t0:.3f} s)')
+        _cache.local_triangles.append((np.array(centre, dtype=float), radius * LOCAL_MARGIN, fov, data))
+        del _cache.local_triangles[:-LOCAL_CACHE_SIZE]
+        return data
+
+def triangles_ready():
+    return _cache.triangles_future is not None and _cache.triangles_future.done()
+
+'''
+stop a preparation which is still running (at program exit)
+'''
+def stop_preparation():
+    if _cache.prepare_process is not None and _cache.prepare_process.is_alive():
+        _cache.prepare_process.terminate()
+    if _cache.triangles_future is not None:
+        _cache.triangles_future.cancel()
 
-def prepare_triangles():
-    print('preparing')
-    _cache.q=Queue()
-    _cache.prepare_process = Process(target=work, args = (_cache.q,))
-    _cache.prepare_process.start()
-    
 def open_database(path):
     if not path in _cache.database_cache:
         _cache.database_cache[path] = tetra3.Tetra3(load_database=path)
@@ -55,17 +227,10 @@ def open_catalogue(path, debug_folder=None, **kwaargs):
         if path == 'gaia':
             _cache.catalogue_cache[path] = gaia_search.dbs_gaia(**kwaargs)
         elif path == triangles_path:
-            print(_cache.prepare_process, _cache.prepare_process.is_alive())
-            i = 1          
-            while _cache.q.empty() and not path in _cache.catalogue_cache:
-                print(f"triangles not ready yet ... waiting for them to be ready ({i})")
-                time.sleep(1)
-                i+=1
-            if not path in _cache.catalogue_cache:
-                _cache.catalogue_cache[path] = _cache.q.get()
-                _cache.prepare_process.join()
-                print("joined")
-            
+            future = prepare_triangles() # (no-op if already started)
+            if not future.done():
+                print("triangles not ready yet ... waiting for them to be ready")
+            _cache.catalogue_cache[path] = future.result()
         else:
             _cache.catalogue_cache[path] = database_lookup2.database_searcher(path, debug_folder=debug_folder, star_max_magnitude=12)
 
@@ -6,15 +6,152 @@ import itertools
 from time import perf_counter as precision_timestamp
 from datetime import datetime
 from numbers import Number
+import os
+import hashlib
 import numpy as np
+from scipy.spatial import KDTree
 # external imports
 
 import numpy as np
 
+INDEX_BAND = 0.5 # degrees: height of the declination bands of the sky index
+_KEY_STRIDE = 8 # > 2 pi: the search key of a star is band * _KEY_STRIDE + ra
+
+# the sky index of the catalogue at catalogue_path is stored beside it
+def index_path(catalogue_path):
+    root, _ = os.path.splitext(str(catalogue_path))
+    return root + '_skyindex.npz'
+
+'''
+spatial index over a star table (columns ra, dec, x, y, z, mag as in database_searcher, angles in radians):
+the sky is cut into declination bands of INDEX_BAND degrees and the stars are sorted by band, then by RA,
+so that each band and RA interval is one contiguous run of the sorted stars, found by binary search.
+A box or cone query therefore costs a binary search per band it touches plus the number of stars in the runs,
+instead of a scan of the whole table
+queries return indices into star_table in increasing order, i.e. in the order of star_table (by brightness)
+'''
+class SkyIndex:
+
+    # key: the search keys of the stars in order (computed from order if None)
+    def __init__(self, star_table, order, band_offsets, band=INDEX_BAND, key=None):
+        self.star_table = star_table
+        self.order = order
+        self.band_offsets = band_offsets
+        self.band = band
+        self.n_bands = band_offsets.shape[0] - 1
+        if key is None:
+            bands = np.repeat(np.arange(self.n_bands), np.diff(band_offsets))
+            key = bands * float(_KEY_STRIDE) + star_table[order, 0]
+        self.key = key
+
+    def _band_of(self, dec):
+        return np.clip(((np.asarray(dec) + np.pi / 2) / np.radians(self.band)).astype(int), 0, self.n_bands - 1)
+
+    @classmethod
+    def build(cls, star_table, band=INDEX_BAND):
+        n_bands = int(np.ceil(180 / band))
+        bands = np.clip(((star_table[:, 1].astype(float) + np.pi / 2) / np.radians(band)).astype(int), 0, n_bands - 1)
+        order = np.lexsort((star_table[:, 0], bands)).astype(np.int32)
+        band_offsets = np.zeros(n_bands + 1, dtype=np.int64)
+        band_offsets[1:] = np.cumsum(np.bincount(bands, minlength=n_bands))
+        return cls(star_table, order, band_offsets, band)
+
+    # identifies the star table an index file was built for
+    @staticmethod
+    def checksum(star_table):
+        return hashlib.sha1(np.ascontiguousarray(star_table[:, [0, 1, 5]]).tobytes()).hexdigest()
+
+    '''
+    the index stored at path if it was built for star_table, otherwise build it (and store it at path)
+    path: None to build it without storing it
+    '''
+    @classmethod
+    def open(cls, star_table, path=None, band=INDEX_BAND):
+        checksum = cls.checksum(star_table) if path is not None else None
+        if path is not None and os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    if str(data['checksum']) == checksum and float(data['band']) == band:
+                        return cls(star_table, data['order'], data['band_offsets'], band)
+            except (OSError, KeyError, ValueError) as e:
+                print(f'note: could not read the sky index {path} ({e})')
+        index = cls.build(star_table, band)
+        if path is not None:
+            try:
+                tmp = f'{path}.{os.getpid()}.tmp.npz'
+                np.savez(tmp, order=index.order, band_offsets=index.band_offsets, band=band, checksum=checksum)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f'note: could not store the sky index {path} ({e})')
+        return index
+
+    # indices of the stars in the given declination bands with band * _KEY_STRIDE + ra0 <= key <= band * _KEY_STRIDE + ra1
+    def _runs(self, band0, band1, ra0, ra1):
+        bands = np.arange(band0, band1 + 1) * float(_KEY_STRIDE)
+        starts = np.searchsorted(self.key, bands + ra0, side='left')
+        stops = np.searchsorted(self.key, bands + ra1, side='right')
+        return [self.order[i:j] for i, j in zip(starts, stops) if j > i]
+
+    def _candidates(self, dec_ranges, ra_ranges):
+        runs = []
+        for dec0, dec1 in dec_ranges:
+            for ra0, ra1 in ra_ranges:
+                runs += self._runs(self._band_of(dec0), self._band_of(dec1), ra0, ra1)
+        return np.concatenate(runs) if runs else np.zeros(0, dtype=self.order.dtype)
+
+    '''
+    stars with range_ra[0] < ra < range_ra[1] and range_dec[0] < dec < range_dec[1] (radians), with the same conventions
+    as database_searcher.lookup_objects: a range with range[0] > range[1] wraps around (through 360 degrees for RA),
+    a range of None is unbounded
+    '''
+    def box(self, range_ra, range_dec):
+        if range_dec is None:
+            dec_ranges = [(-np.pi / 2, np.pi / 2)]
+        elif range_dec[0] < range_dec[1]:
+            dec_ranges = [tuple(range_dec)]
+        else:
+            dec_ranges = [(range_dec[0], np.pi / 2), (-np.pi / 2, range_dec[1])]
+        if range_ra is None:
+            ra_ranges = [(0, 2 * np.pi)]
+        elif range_ra[0] < range_ra[1]:
+            ra_ranges = [tuple(range_ra)]
+        else:
+            ra_ranges = [(range_ra[0], 2 * np.pi), (0, range_ra[1])]
+        idx = np.sort(self._candidates(dec_ranges, ra_ranges))
+        ra, dec = self.star_table[idx, 0], self.star_table[idx, 1]
+        kept = np.ones(idx.shape[0], dtype=bool)
+        if range_ra is not None:
+            if range_ra[0] < range_ra[1]:
+                kept &= np.logical_and(ra > range_ra[0], ra < range_ra[1])
+            else:
+                kept &= np.logical_or(ra > range_ra[0], ra < range_ra[1])
+        if range_dec is not None:
+            if range_dec[0] < range_dec[1]:
+                kept &= np.logical_and(dec > range_dec[0], dec < range_dec[1])
+            else:
+                kept &= np.logical_or(dec > range_dec[0], dec < range_dec[1])
+        return idx[kept]
+
+    '''
+    stars within radius of (ra, dec) (radians)
+    '''
+    def cone(self, ra, dec, radius):
+        dec0, dec1 = dec - radius, dec + radius
+        if dec1 >= np.pi / 2 or dec0 <= -np.pi / 2 or radius >= np.pi / 2:
+            ra_ranges = [(0, 2 * np.pi)] # (a pole is inside the cone)
+        else:
+            half_width = np.arcsin(min(np.sin(radius) / np.cos(dec), 1)) # widest RA extent of the cone
+            ra0, ra1 = (ra - half_width) % (2 * np.pi), (ra + half_width) % (2 * np.pi)
+            ra_ranges = [(ra0, ra1)] if ra0 < ra1 else [(ra0, 2 * np.pi), (0, ra1)]
+        idx = np.sort(self._candidates([(max(dec0, -np.pi / 2), min(dec1, np.pi / 2))], ra_ranges))
+        centre = np.array([np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)])
+        return idx[self.star_table[idx, 2:5].astype(float) @ centre >= np.cos(radius)]
+
 class database_searcher:
 
     def __init__(self, catalogue_path, star_max_magnitude=12, epoch_proper_motion='now', debug_folder=None):
         self._logger = logging.getLogger('database_searcher.databasesearcher')
+        self.index_path = None
         if str(catalogue_path).endswith('.npz'):
             data = np.load(catalogue_path)
             mydata  = data['mydata']
@@ -27,6 +164,8 @@ class database_searcher:
             self.star_table[:, 4] = np.sin(self.star_table[:, 1])
             #self.star_catID = data['star_catID'] # leave out catID for now because its format is annoying
             self.star_catID = np.zeros((mydata.shape[0], 1)) # just zeros for catid
+            self.index_path = index_path(catalogue_path)
+            self.sky_index()
             return
         if not self._logger.hasHandlers():
             # Add new handlers to the logger if there are none
@@ -140,45 +279,61 @@ class database_searcher:
         self.star_table[:, 4] = np.sin(self.star_table[:, 1])
 
 
+    '''
+    searcher over an existing star table (e.g. one in shared memory, see platesolve_batch.py) instead of a catalogue file
+    index_path: where its sky index is stored (see index_path()), None to build it on first use
+    '''
+    @classmethod
+    def from_star_table(cls, star_table, index_path=None):
+        self = cls.__new__(cls)
+        self._logger = logging.getLogger('database_searcher.databasesearcher')
+        self.index_path = index_path
+        self.num_entries = star_table.shape[0]
+        self.star_table = star_table
+        self.star_catID = np.zeros((self.num_entries, 1)) # just zeros for catid
+        return self
+
+    # SkyIndex of star_table (loaded from, or built and stored at, self.index_path on first use, then cached)
+    def sky_index(self):
+        if not '_sky_index' in self.__dict__:
+            self._sky_index = SkyIndex.open(self.star_table, self.index_path)
+        return self._sky_index
+
+    def _select(self, idx, star_max_magnitude):
+        idx = idx[self.star_table[idx, 5] < star_max_magnitude]
+        return self.star_table[idx, :], self.star_catID[idx, :]
+
+    '''
+    box query: stars with RA in range_ra and DEC in range_dec (degrees, see SkyIndex.box), brighter than star_max_magnitude
+    returns (star_table, star_catID) of those stars, by brightness
+    '''
     def lookup_objects(self, range_ra, range_dec, star_max_magnitude=12):
-        if range_ra is not None:
-            range_ra = np.deg2rad(range_ra)
-            if range_ra[0] < range_ra[1]: # Range does not cross 360deg discontinuity
-                kept = np.logical_and(self.star_table[:, 0] > range_ra[0], self.star_table[:, 0] < range_ra[1])
-            else:
-                kept = np.logical_or(self.star_table[:, 0] > range_ra[0], self.star_table[:, 0] < range_ra[1])
-            star_table = self.star_table[kept, :]
-            num_entries = star_table.shape[0]
-            # Trim down catalogue ID to match
-            
-            star_catID = self.star_catID[kept, :]
-            self._logger.info('Limited to RA range ' + str(np.rad2deg(range_ra)) + ', keeping ' \
-                + str(num_entries) + ' stars.')
-        if range_dec is not None:
-            range_dec = np.deg2rad(range_dec)
-            if range_dec[0] < range_dec[1]: # Range does not cross +/-90deg discontinuity
-                kept = np.logical_and(star_table[:, 1] > range_dec[0], star_table[:, 1] < range_dec[1])
-            else:
-                kept = np.logical_or(star_table[:, 1] > range_dec[0], star_table[:, 1] < range_dec[1])
-            star_table = star_table[kept, :]
-            num_entries = star_table.shape[0]
-            # Trim down catalogue ID to match
-
-            star_catID = star_catID[kept, :]
-            self._logger.info('Limited to DEC range ' + str(np.rad2deg(range_dec)) + ', keeping ' \
-                + str(num_entries) + ' stars.')
-        # max magnitude
-        kept = star_table[:, 5] < star_max_magnitude
-        star_table = star_table[kept, :]
-        num_entries = star_table.shape[0]
-        # Trim down catalogue ID to match
-
-        star_catID = star_catID[kept, :]
-        self._logger.info('Limited to magnitude to ' + str(star_max_magnitude) + ', keeping ' \
-            + str(num_entries) + ' stars.')
-        
+        idx = self.sky_index().box(None if range_ra is None else np.deg2rad(range_ra), None if range_dec is None else np.deg2rad(range_dec))
+        star_table, star_catID = self._select(idx, star_max_magnitude)
+        self._logger.info('Limited to RA range ' + str(range_ra) + ', DEC range ' + str(range_dec) + ', magnitude ' \
+            + str(star_max_magnitude) + ', keeping ' + str(star_table.shape[0]) + ' stars.')
         return star_table, star_catID
 
+    '''
+    cone query: stars within radius of (ra, dec) (degrees), brighter than star_max_magnitude
+    returns (star_table, star_catID) of those stars, by brightness
+    '''
+    def cone_search(self, ra, dec, radius, star_max_magnitude=12):
+        idx = self.sky_index().cone(np.deg2rad(ra), np.deg2rad(dec), np.deg2rad(radius))
+        star_table, star_catID = self._select(idx, star_max_magnitude)
+        self._logger.info('Limited to ' + str(radius) + ' degrees around ' + str((ra, dec)) + ', magnitude ' \
+            + str(star_max_magnitude) + ', keeping ' + str(star_table.shape[0]) + ' stars.')
+        return star_table, star_catID
+
+    # KDTree over the 3-vectors of all stars brighter than star_max_magnitude (built on first use, then cached)
+    # returns (tree, indices of its stars in star_table)
+    def vector_tree(self, star_max_magnitude=12):
+        trees = self.__dict__.setdefault('_vector_trees', {})
+        if not star_max_magnitude in trees:
+            kept = np.nonzero(self.star_table[:, 5] < star_max_magnitude)[0]
+            trees[star_max_magnitude] = (KDTree(self.star_table[kept, 2:5].astype(float)), kept)
+        return trees[star_max_magnitude]
+
     def save_npz(self, file):
         mydata = np.zeros((self.num_entries, 3), dtype=np.float32)
         mydata[:, :2] = self.star_table[:, :2]
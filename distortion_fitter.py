@@ -26,9 +26,13 @@ import gaia_search
 from copy import copy
 import zipfile
 import refraction_correction
-import platesolve_triangle
+import platesolve_hint
+import platesolve_server
 from MEE2024util import get_bbox
 import shutil
+import pipeline_results
+import instrumentation
+import profiling
 
 def get_fitfunc(plate, target, transform_function=transforms.linear_transform, img_shape=None):
     def fitfunc(x):
@@ -129,28 +133,48 @@ def match_centroids(other_stars_df, rough_platesolve_x, dbs, corners, image_size
     return stardata, plate2, alt, az
 
 def match_and_fit_distortion(path_data, options, debug_folder=None):
+    stack_result = pipeline_results.StackResult.from_archive(path_data)
+    basename = Path(path_data).stem + stack_result.results['starttime']
+    return fit_distortion(stack_result, options, basename=basename)
+
+'''
+fit the distortion polynomial to the centroids of a stacking run
+stack_result: pipeline_results.StackResult (from do_stack, or StackResult.from_archive)
+if the stack_result already carries a successful plate solution it is reused instead of platesolving again
+archive: write distortion_results.txt, CATALOGUE_MATCHED_ERRORS.csv and the distortion_data*.zip archive
+returns a pipeline_results.DistortionResult
+'''
+def fit_distortion(stack_result, options, basename=None, archive=True):
     starttime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    
-    path_catalogue = options['catalogue']
-    
-    archive = zipfile.ZipFile(path_data, 'r')
-    try:
-        data = json.load(archive.open('results.txt'))
-        other_stars_df = pd.read_csv(archive.open('STACKED_CENTROIDS_DATA.csv'))
-    except Exception: # backwards compatibility with old format
-        data = json.load(archive.open('data/results.txt'))
-        other_stars_df = pd.read_csv(archive.open('data/STACKED_CENTROIDS_DATA.csv'))
-    other_stars_df = other_stars_df.astype({'px':float, 'py':float}) # fix datatypes
-    image_size = data['img_shape']
-    basename = Path(path_data).stem + data['starttime']
+    if basename is None:
+        basename = 'data' + stack_result.results['starttime']
 
     output_name = f'DISTORTION_OUTPUT{starttime}__'+basename
     output_dir = Path(output_path(output_name, options))
     data_dir = output_dir / 'distortion'
     os.mkdir(output_dir)
-    os.mkdir(data_dir)
+    if archive:
+        os.mkdir(data_dir)
+    recorder = instrumentation.start_run('distortion'+starttime)
+    profiling.configure(options, output_dir)
+    try:
+        with instrumentation.span('distortion'):
+            return _fit_distortion(stack_result, options, starttime, basename, output_dir, data_dir, archive, recorder)
+    finally:
+        profiling.finish()
+
+def _fit_distortion(stack_result, options, starttime, basename, output_dir, data_dir, archive, recorder):
+    path_catalogue = options['catalogue']
+    
+    data = stack_result.results
+    other_stars_df = stack_result.centroids.astype({'px':float, 'py':float}) # fix datatypes (also a copy, as we may swap columns below)
+    image_size = data['img_shape']
     
-    plate_solve_result = platesolve_triangle.platesolve(np.c_[other_stars_df['py'], other_stars_df['px']], image_size, dict(options, **{'flag_display':False}))
+    if stack_result.solution is not None and stack_result.solution.success:
+        plate_solve_result = stack_result.solution.as_dict()
+    else:
+        plate_solve_result = platesolve_server.platesolve(stack_result.centroids_yx(), image_size, dict(options, **{'flag_display':False}),
+                                                            hint=platesolve_hint.find_hint(options, results=data))
     if not plate_solve_result['success']: # failed platesolve
         raise Exception("BAD DATA - platesolve failed!")
     if plate_solve_result['mirror']:
@@ -164,7 +188,9 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
     dbs = database_cache.open_catalogue(path_catalogue, gaia_limit=options['safety_limit_mag'])
     alt, az = None, None
     lookupdate = options['DEFAULT_DATE'] if options['guess_date'] else options['observation_date']
-    stardata, plate2, alt, az = match_centroids(other_stars_df, initial_guess, dbs, corners, image_size, lookupdate, options)
+    with instrumentation.span('distortion.catalogue_match') as s:
+        stardata, plate2, alt, az = match_centroids(other_stars_df, initial_guess, dbs, corners, image_size, lookupdate, options)
+        s.items = plate2.shape[0]
     
     ### fit again 
 
@@ -178,7 +204,8 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
 
     # now recompute matches
     
-    result, plate2_corrected, _, _  = distortion_polynomial.do_cubic_fit(plate2, stardata, initial_guess, image_size, dict(options, **{'flag_display2':False}))
+    with instrumentation.span('distortion.fit', items=plate2.shape[0]):
+        result, plate2_corrected, _, _  = distortion_polynomial.do_cubic_fit(plate2, stardata, initial_guess, image_size, dict(options, **{'flag_display2':False}))
 
     transformed_final = transforms.linear_transform(result, plate2_corrected, image_size)
     mag_errors = np.linalg.norm(transformed_final - stardata.get_vectors(), axis=1)
@@ -187,7 +214,8 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
 
     # compute flag:
     flag_is_double = np.zeros(stardata.ids.shape[0], int)
-    neigh_all = gaia_search.lookup_nearby(stardata, options['double_star_cutoff'], options['double_star_mag'])
+    with instrumentation.span('distortion.double_star_lookup', items=stardata.nstars()):
+        neigh_all = gaia_search.lookup_nearby(stardata, options['double_star_cutoff'], options['double_star_mag'])
     neigh = NearestNeighbors(n_neighbors=2)
     neigh_all_data_extra2 = np.r_[neigh_all.get_ra_dec(), np.array([[-99999,-99999], [-99999, -99999]])] # ensure at least 2 "pseudo-neighbours"
     
@@ -217,7 +245,8 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
         #stardata.update_data(stardata_new)
         stardata.update_epoch(date_string_to_float(dateguess))
     
-    result, plate2_corrected, coeff_x, coeff_y = distortion_polynomial.do_cubic_fit(plate2, stardata, initial_guess, image_size, options)
+    with instrumentation.span('distortion.fit', items=plate2.shape[0]):
+        result, plate2_corrected, coeff_x, coeff_y = distortion_polynomial.do_cubic_fit(plate2, stardata, initial_guess, image_size, options)
     transformed_final = transforms.linear_transform(result, plate2_corrected, image_size)
     mag_errors = np.linalg.norm(transformed_final - stardata.get_vectors(), axis=1)
     errors_arcseconds = np.degrees(mag_errors)*3600
@@ -265,10 +294,14 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
                         'observation az (degrees)': az}
     if options['enable_corrections'] or options['enable_corrections_ref']:
         output_results.update(additional_info)
+    output_results['timing'] = recorder.summary()
+    recorder.log_summary()
+    recorder.write_jsonl(output_dir / f'TIMING{starttime}.jsonl')
 
     
-    with open(data_dir / 'distortion_results.txt', 'w', encoding="utf-8") as fp:
-        json.dump(output_results, fp, sort_keys=False, indent=4)
+    if archive:
+        with open(data_dir / 'distortion_results.txt', 'w', encoding="utf-8") as fp:
+            json.dump(output_results, fp, sort_keys=False, indent=4)
 
     marker_colors = ['red' if is_missing_pm else 'orange' if is_double else '#1f77b4' for (is_missing_pm, is_double)
                      in zip(flag_missing_pm[keep_j], flag_is_double[keep_j])] 
@@ -322,12 +355,17 @@ def match_and_fit_distortion(path_data, options, debug_folder=None):
                                'flag_missing_pm':flag_missing_pm,
                                'flag_is_outlier':flag_is_outlier,})
             
-    df_identification.to_csv(data_dir / 'CATALOGUE_MATCHED_ERRORS.csv')
-    shutil.make_archive(data_dir,
-                    'zip',
-                    Path(data_dir))
-    zipfilepath = Path(data_dir).parent / 'distortion.zip'
-    shutil.move(zipfilepath, Path(output_dir).parent / f'distortion_data{starttime}__{basename}.zip')
+    archive_path = None
+    if archive:
+        df_identification.to_csv(data_dir / 'CATALOGUE_MATCHED_ERRORS.csv')
+        shutil.make_archive(data_dir,
+                        'zip',
+                        Path(data_dir))
+        zipfilepath = Path(data_dir).parent / 'distortion.zip'
+        archive_path = Path(output_dir).parent / f'distortion_data{starttime}__{basename}.zip'
+        shutil.move(zipfilepath, archive_path)
+    return pipeline_results.DistortionResult(output_results, df_identification, list(coeff_x), list(coeff_y), x=result,
+                                             output_dir=output_dir, archive_path=archive_path)
 
 # #unused
 def show_error_coherence(positions, errors, options):
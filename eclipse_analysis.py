@@ -9,6 +9,9 @@ import scipy
 from pathlib import Path
 import datetime
 from MEE2024util import output_path, _version
+import pipeline_results
+import instrumentation
+import profiling
 
 import astropy
 from astropy.coordinates import EarthLocation,SkyCoord, Distance, get_body, AltAz
@@ -19,12 +22,28 @@ def as_unit_vector(dec, ra):
     return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]).T 
 
 def eclipse_analysis(path_data, options):
-    starttime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     print(path_data)
-    archive = zipfile.ZipFile(path_data, 'r')
-    data = json.load(archive.open('distortion_results.txt'))
+    return analyse_eclipse(pipeline_results.DistortionResult.from_archive(path_data), options, source=path_data)
+
+'''
+fit the gravitational deflection to the catalogue matched stars of a distortion fit
+distortion_result: pipeline_results.DistortionResult (from distortion_fitter.fit_distortion, or DistortionResult.from_archive)
+source: description of the input, written to the ECLIPSE_OUTPUT file
+returns a pipeline_results.EclipseResult
+'''
+def analyse_eclipse(distortion_result, options, source=None):
+    profiling.configure(options, options['output_dir'].strip() or '.')
+    try:
+        with instrumentation.span('eclipse'):
+            return _analyse_eclipse(distortion_result, options, source)
+    finally:
+        profiling.finish()
+
+def _analyse_eclipse(distortion_result, options, source):
+    starttime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    data = distortion_result.results
     #image_size = data['img_shape']
-    df = pd.read_csv(archive.open('CATALOGUE_MATCHED_ERRORS.csv'))
+    df = distortion_result.matched
     print(df)
     df = df.astype({'px':float, 'py':float, 'RA(catalog)':float, 'RA(obs)':float, 'DEC(catalog)':float, 'DEC(obs)':float, 'magV':float}) # fix datatypes
     df = df.loc[df['magV'] <= options['eclipse_limiting_mag']]
@@ -163,7 +182,7 @@ def eclipse_analysis(path_data, options):
     print(output_file)
     with open(output_file, 'w') as f:
         f.write(f"MEE2024 version: {_version()}\n")
-        f.write(f"input file: {path_data}\n\n")
+        f.write(f"input file: {source if source is not None else distortion_result.archive_path}\n\n")
         f.write(f"limiting magnitude: {options['eclipse_limiting_mag']}\n")
         f.write(f"remove double stars: {options['remove_double_stars_eclipse']}\n")
         f.write(f"number of stars used: {df.shape[0]}\n")
@@ -171,6 +190,7 @@ def eclipse_analysis(path_data, options):
         f.write(f"\na/R^b fit: a = {result2.x[0]:.3f}, b = {result2.x[1]:.3f}, rms = {result2.fun:.3f} arcsec\n\n")
         f.write("radial distances: " + str(rad_dist) + "\n\n")
         f.write("deflection (arcsec): " + str(deflection_obs)+"\n")
+    return pipeline_results.EclipseResult(result1.x[0], result1.fun, (result2.x[0], result2.x[1], result2.fun), rad_dist, deflection_obs, df.shape[0], output_file=output_file)
     
 if __name__ == '__main__':
     pass
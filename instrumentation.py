@@ -0,0 +1,193 @@
+'''
+named timing spans for the pipeline stages
+
+each span records wall time, CPU time (of the process), the peak resident memory
+seen so far and optionally an item count (e.g. number of centroids found) and
+the frame it belongs to. Spans nest, and can be summarised per name, written
+to the run log and exported as JSON lines to track performance across releases
+
+usage:
+    with instrumentation.span('stack.centroiding', frame=file) as s:
+        centroids = ...
+        s.items = len(centroids)
+'''
+
+import time
+import json
+import sys
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager, ExitStack
+from MEE2024util import _version
+
+try:
+    import resource # unix only
+except ImportError:
+    resource = None
+try:
+    import psutil # optional, needed for memory statistics under Windows
+except ImportError:
+    psutil = None
+
+'''
+peak resident set size of this process in MB (or None if it can't be determined)
+'''
+def peak_rss_mb():
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        peak = getattr(info, 'peak_wset', None) # windows keeps a true high-water mark
+        if peak is not None:
+            return peak / 2**20
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10 # bytes on macOS, kilobytes on linux
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20 # no high-water mark available: use current usage
+    return None
+
+class Span:
+
+    def __init__(self, name, frame=None, parent=None, items=None):
+        self.name = name
+        self.frame = frame # frame (file name or index) this span belongs to, None for whole-run stages
+        self.parent = parent # name of the enclosing span
+        self.items = items # number of items processed (set by the caller)
+        self.wall = None # seconds
+        self.cpu = None # seconds (process time, i.e. summed over all threads)
+        self.peak_rss_mb = None
+        self._t0 = None
+
+    def start(self):
+        self._t0 = time.perf_counter(), time.process_time()
+
+    def stop(self):
+        t1 = time.perf_counter(), time.process_time()
+        self.wall = t1[0] - self._t0[0]
+        self.cpu = t1[1] - self._t0[1]
+        self.peak_rss_mb = peak_rss_mb()
+
+    def as_dict(self):
+        d = {'name':self.name, 'wall_s':self.wall, 'cpu_s':self.cpu, 'peak_rss_mb':self.peak_rss_mb}
+        if self.frame is not None:
+            d['frame'] = str(self.frame)
+        if self.parent is not None:
+            d['parent'] = self.parent
+        if self.items is not None:
+            d['items'] = int(self.items)
+        return d
+
+class Recorder:
+
+    def __init__(self, run_id=None, max_spans=100000):
+        self.run_id = run_id
+        self.spans = deque(maxlen=max_spans) # completed spans, oldest dropped first
+        self._local = threading.local() # stack of open spans, per thread
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def span(self, name, frame=None, items=None):
+        stack = self._stack()
+        s = Span(name, frame=frame, parent=stack[-1].name if stack else None, items=items)
+        stack.append(s)
+        s.start()
+        try:
+            with ExitStack() as hook_stack:
+                for hook in list(_hooks):
+                    hook_stack.enter_context(hook(s))
+                yield s
+        finally:
+            s.stop()
+            stack.pop()
+            self.spans.append(s)
+
+    '''
+    aggregate the spans by name (in order of first appearance)
+    returns {name: {'count', 'wall_s', 'cpu_s', 'max_wall_s', 'peak_rss_mb', 'items', 'items/s'}}
+    '''
+    def summary(self):
+        out = {}
+        for s in list(self.spans):
+            if not s.name in out:
+                out[s.name] = {'count':0, 'wall_s':0., 'cpu_s':0., 'max_wall_s':0., 'peak_rss_mb':None, 'items':None}
+            agg = out[s.name]
+            agg['count'] += 1
+            agg['wall_s'] += s.wall
+            agg['cpu_s'] += s.cpu
+            agg['max_wall_s'] = max(agg['max_wall_s'], s.wall)
+            if s.peak_rss_mb is not None:
+                agg['peak_rss_mb'] = max(agg['peak_rss_mb'] or 0, s.peak_rss_mb)
+            if s.items is not None:
+                agg['items'] = (agg['items'] or 0) + int(s.items)
+        for agg in out.values():
+            if agg['items'] is not None and agg['wall_s'] > 0:
+                agg['items/s'] = agg['items'] / agg['wall_s']
+        return out
+
+    def format_summary(self):
+        lines = [f'{"stage":40s} {"n":>5s} {"wall/s":>9s} {"cpu/s":>9s} {"max/s":>9s} {"peakMB":>8s} {"items":>8s}']
+        for name, agg in self.summary().items():
+            rss = f'{agg["peak_rss_mb"]:8.0f}' if agg['peak_rss_mb'] is not None else f'{"-":>8s}'
+            items = f'{agg["items"]:8d}' if agg['items'] is not None else f'{"-":>8s}'
+            lines.append(f'{name:40s} {agg["count"]:5d} {agg["wall_s"]:9.3f} {agg["cpu_s"]:9.3f} {agg["max_wall_s"]:9.3f} {rss} {items}')
+        return '\n'.join(lines)
+
+    def log_summary(self, logger=None):
+        text = 'timing summary:\n' + self.format_summary()
+        print(text)
+        if logger is not None:
+            logger.info(text)
+
+    '''
+    export every span as one json object per line
+    append=True allows collecting many runs in a single file for regression tracking
+    '''
+    def write_jsonl(self, path, append=False, extra=None):
+        with open(path, 'a' if append else 'w', encoding="utf-8") as fp:
+            for s in list(self.spans):
+                d = {'run':self.run_id, 'version':_version()}
+                d.update(extra or {})
+                d.update(s.as_dict())
+                fp.write(json.dumps(d) + '\n')
+
+_recorder = Recorder()
+
+_hooks = [] # callables hook(span) -> context manager, entered around every span (e.g. profiling.py)
+
+def add_hook(hook):
+    if not hook in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+'''
+start recording a new run (e.g. one stacking run): spans of the previous run are discarded
+'''
+def start_run(run_id=None):
+    global _recorder
+    _recorder = Recorder(run_id)
+    return _recorder
+
+def current():
+    return _recorder
+
+def span(name, frame=None, items=None):
+    return _recorder.span(name, frame=frame, items=items)
+
+'''
+decorator: record every call of the function as a span
+'''
+def timed(name):
+    def decorator(fxn):
+        @functools.wraps(fxn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fxn(*args, **kwargs)
+        return wrapper
+    return decorator
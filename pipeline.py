@@ -0,0 +1,60 @@
+'''
+in-memory pipeline: stack -> platesolve -> distortion -> eclipse
+
+each stage returns a result object from pipeline_results which the next stage
+consumes directly, so no zip files need to be written or read in between.
+The zip archives are still written if archive=True, so that the results can
+be picked up again later by the GUI (or by pipeline_results.*.from_archive)
+
+example:
+    stack_result = pipeline.stack(files, [], [], options, archive=False)
+    distortion_result = pipeline.fit_distortion(stack_result, options, archive=False)
+    eclipse_result = pipeline.eclipse(distortion_result, options)
+'''
+
+import platesolve_hint
+import platesolve_server
+import pipeline_results
+import stacker_implementation
+import distortion_fitter
+import eclipse_analysis
+import profiling
+
+def stack(files, darkfiles, flatfiles, options, archive=True):
+    return stacker_implementation.do_stack(files, darkfiles, flatfiles, options, archive=archive)
+
+'''
+(re-)platesolve the centroids of a stacking result
+the search is restricted to the neighbourhood of a previous solution (or options['platesolve_hint']), if any
+the solution is stored on stack_result and also returned
+'''
+def platesolve(stack_result, options, **kwargs):
+    kwargs.setdefault('hint', platesolve_hint.find_hint(options, results=stack_result.results))
+    profiling.configure(options, stack_result.output_dir or options.get('output_dir', '').strip() or '.')
+    try:
+        result = platesolve_server.platesolve(stack_result.centroids_yx(), stack_result.img_shape, dict(options, **{'flag_display':False}), **kwargs)
+    finally:
+        profiling.finish()
+    stack_result.solution = pipeline_results.PlateSolution(result)
+    return stack_result.solution
+
+def fit_distortion(stack_result, options, archive=True):
+    return distortion_fitter.fit_distortion(stack_result, options, archive=archive)
+
+def eclipse(distortion_result, options):
+    return eclipse_analysis.analyse_eclipse(distortion_result, options)
+
+'''
+run all requested stages one after the other
+returns a dictionary of the results of each stage which was run
+'''
+def run(files, darkfiles, flatfiles, options, do_distortion=True, do_eclipse=False, archive=True):
+    results = {'stack': stack(files, darkfiles, flatfiles, options, archive=archive)}
+    if not do_distortion:
+        return results
+    if results['stack'].solution is None or not results['stack'].solution.success:
+        platesolve(results['stack'], options)
+    results['distortion'] = fit_distortion(results['stack'], options, archive=archive)
+    if do_eclipse:
+        results['eclipse'] = eclipse(results['distortion'], options)
+    return results
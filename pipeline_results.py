@@ -0,0 +1,100 @@
+'''
+result objects passed between the pipeline stages
+(stack -> platesolve -> distortion -> eclipse)
+
+each stage can be (re-)constructed from its zip archive on disk, so the
+in-memory objects and the archived files are interchangeable
+'''
+
+import json
+import zipfile
+import numpy as np
+import pandas as pd
+
+'''
+read a json + csv pair from one of our zip archives
+(also accept the old layout where everything lives under data/)
+'''
+def _read_archive(path, json_name, csv_name):
+    archive = zipfile.ZipFile(path, 'r')
+    try:
+        data = json.load(archive.open(json_name))
+        df = pd.read_csv(archive.open(csv_name))
+    except Exception: # backwards compatibility with old format
+        data = json.load(archive.open('data/' + json_name))
+        df = pd.read_csv(archive.open('data/' + csv_name))
+    return data, df
+
+class PlateSolution:
+
+    def __init__(self, result):
+        self.success = result['success']
+        self.x = result['x'] # (scale, ra, dec, roll) in RADIANS, as expected by transforms.linear_transform
+        self.platescale_arcsec = result['platescale/arcsec']
+        self.ra = result['ra'] # degrees
+        self.dec = result['dec'] # degrees
+        self.roll = result['roll'] # degrees
+        self.mirror = result.get('mirror', False)
+        self.matched_centroids = result['matched_centroids'] # n by 2 array (y, x)
+        self.matched_stars = result['matched_stars'] # n by 6 array (ra, dec, 3-vect, mag) (ra/dec in RADIANS)
+        self.extra = {k: v for k, v in result.items() if not k in self.as_dict()} # anything else the solver reported
+
+    def as_dict(self):
+        return {'success':self.success, 'x':self.x, 'platescale/arcsec':self.platescale_arcsec, 'ra':self.ra, 'dec':self.dec,
+                'roll':self.roll, 'mirror':self.mirror, 'matched_centroids':self.matched_centroids, 'matched_stars':self.matched_stars}
+
+    def __repr__(self):
+        if not self.success:
+            return 'PlateSolution(success=False)'
+        return f'PlateSolution(ra={self.ra:.4f}, dec={self.dec:.4f}, roll={self.roll:.4f}, platescale={self.platescale_arcsec:.4f}"/px, mirror={self.mirror})'
+
+class StackResult:
+
+    def __init__(self, centroids, results, solution=None, stacked=None, output_dir=None, archive_path=None):
+        self.centroids = centroids # DataFrame of centroids on the stacked image: px, py, area (pixels), flux (noise-normed)
+        self.results = results # the dictionary written to results.txt
+        self.solution = solution # PlateSolution of the stacked image (or None if not platesolved in this session)
+        self.stacked = stacked # stacked image (float), None if loaded from an archive
+        self.output_dir = output_dir
+        self.archive_path = archive_path # centroid_data*.zip, if one was written / read
+
+    @property
+    def img_shape(self):
+        return tuple(self.results['img_shape'])
+
+    # n by 2 array of centroids in (y, x) convention, as expected by the platesolver
+    def centroids_yx(self):
+        return np.c_[self.centroids['py'], self.centroids['px']]
+
+    @classmethod
+    def from_archive(cls, path):
+        data, df = _read_archive(path, 'results.txt', 'STACKED_CENTROIDS_DATA.csv')
+        df = df.astype({'px':float, 'py':float}) # fix datatypes
+        return cls(df, data, archive_path=path)
+
+class DistortionResult:
+
+    def __init__(self, results, matched, coeff_x, coeff_y, x=None, output_dir=None, archive_path=None):
+        self.results = results # the dictionary written to distortion_results.txt
+        self.matched = matched # DataFrame of catalogue matched stars (CATALOGUE_MATCHED_ERRORS.csv)
+        self.coeff_x = coeff_x # distortion coefficients (list, in the order of distortion_polynomial.get_coeff_names)
+        self.coeff_y = coeff_y
+        self.x = x # fitted (scale, ra, dec, roll) in radians
+        self.output_dir = output_dir
+        self.archive_path = archive_path # distortion_data*.zip, if one was written / read
+
+    @classmethod
+    def from_archive(cls, path):
+        data, df = _read_archive(path, 'distortion_results.txt', 'CATALOGUE_MATCHED_ERRORS.csv')
+        return cls(data, df, list(data['distortion coeffs x'].values()), list(data['distortion coeffs y'].values()), archive_path=path)
+
+class EclipseResult:
+
+    def __init__(self, deflection_constant, rms, power_law, rad_dist, deflection_obs, n_stars, output_file=None):
+        self.deflection_constant = deflection_constant # L in d = L / r (arcsec)
+        self.rms = rms # deflected star position rms (arcsec)
+        self.power_law = power_law # (a, b, rms) of the d = a / r^b fit
+        self.rad_dist = rad_dist # radial distance of each star (solar radii)
+        self.deflection_obs = deflection_obs # observed radial deflection of each star (arcsec)
+        self.n_stars = n_stars
+        self.output_file = output_file
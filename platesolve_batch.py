@@ -0,0 +1,168 @@
+'''
+platesolve many centroid sets (e.g. the frames of a session) in parallel
+
+the worker processes share the databases read-only: the triangle database is memory-mapped in each worker
+(a TriangleData is sent as its directory, see database_cache.TriangleData), and the star table of the catalogue and
+the arrays of its sky index are put in shared memory once, instead of every worker (or every platesolve) loading or
+building them again. (The KDTree of the catalogue's vectors, database_searcher.vector_tree, is still built in each
+worker on first use: scipy's trees can't be built over shared arrays)
+
+items whose neighbours (in the order given) are already solved are warm started: the nearest solution is
+used as their hint (see platesolve_hint.py), falling back to a blind search if that fails
+
+example:
+    for index, result, timing in platesolve_batch.solve_batch([(centroids, image_shape), ...], options):
+        print(index, result['success'], timing['solve_s'])
+'''
+
+import os
+import sys
+import time
+import pickle
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import database_cache
+import database_lookup2
+import platesolve_triangle
+import platesolve_hint
+from MEE2024util import resource_path
+
+# neighbouring frames can be further apart than repeated solutions of one image (drift, field rotation)
+WARM_RADIUS = 5 # degrees
+WARM_ROLL_TOLERANCE = 10 # degrees
+
+_worker = {}
+# does attaching to a shared memory segment register it with the resource tracker (which only exists on posix systems)
+_ATTACH_TRACKS = os.name == 'posix' and sys.version_info < (3, 13)
+
+'''
+attach to the shared memory created by solve_batch without tracking it: only the parent unlinks it. (A tracked
+segment can be unlinked, with a warning about a leak, by the resource tracker of a worker when it exits)
+'''
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    shm = shared_memory.SharedMemory(name=name)
+    if _ATTACH_TRACKS:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+'''
+copy arrays (a dictionary) into one new shared memory segment
+returns (the segment, the layout {name: (offset, shape, dtype)} to find them in it, see _views)
+'''
+def _share(arrays):
+    layout, size = {}, 0
+    for name, arr in arrays.items():
+        size = -(-size // 64) * 64 # (aligned)
+        layout[name] = (size, arr.shape, arr.dtype.str)
+        size += arr.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        for name, view in _views(shm, layout).items():
+            view[...] = arrays[name]
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm, layout
+
+def _views(shm, layout):
+    return {name:np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset) for name, (offset, shape, dtype) in layout.items()}
+
+'''
+(in each worker) register the shared databases with database_cache, so that platesolves find them already open
+'''
+def _init_worker(triangles, catalogue_path, shm_name, layout, band_offsets, band):
+    database_cache._cache.catalogue_cache[database_cache.triangles_path] = triangles
+    shm = _attach(shm_name)
+    arrays = _views(shm, layout)
+    searcher = database_lookup2.database_searcher.from_star_table(arrays['star_table'])
+    searcher._sky_index = database_lookup2.SkyIndex(arrays['star_table'], arrays['sky_order'], band_offsets, band, key=arrays['sky_key'])
+    database_cache._cache.catalogue_cache[catalogue_path] = searcher
+    _worker['shm'] = shm # (keeps the shared memory mapped)
+
+def _solve_item(index, centroids, image_shape, options, hint, output_dir):
+    t0 = time.perf_counter()
+    result = platesolve_triangle.platesolve(centroids, image_shape, options=options, output_dir=output_dir, hint=hint)
+    return index, result, time.perf_counter() - t0
+
+def _picklable(value):
+    try:
+        pickle.dumps(value)
+        return True
+    except Exception:
+        return False
+
+def _item(item):
+    if isinstance(item, dict):
+        return np.asarray(item['centroids'], dtype=float), tuple(item['image_shape']), item.get('hint'), item.get('output_dir')
+    centroids, image_shape = item[:2]
+    return np.asarray(centroids, dtype=float), tuple(image_shape), None, None
+
+'''
+the hint for item i from the closest solved item (by position in the batch), None if nothing is solved yet
+'''
+def _warm_hint(i, solved):
+    if not solved:
+        return None
+    k = min(solved, key=lambda j: (abs(j - i), j))
+    return platesolve_hint.from_solution(solved[k], radius=WARM_RADIUS, roll_tolerance=WARM_ROLL_TOLERANCE)
+
+'''
+platesolve a batch of centroid sets
+items: (centroids, image_shape) tuples, or dictionaries with 'centroids', 'image_shape' and optionally 'hint', 'output_dir'
+n_processes: number of worker processes (None: all cpus, 1: solve in this process)
+warm_start: hint items without a hint of their own with the nearest solution found so far
+yields (index of the item, platesolve result, timing) in order of completion, timing is a dictionary with
+'solve_s' (time of the platesolve) and 'elapsed_s' (since the start of the batch)
+'''
+def solve_batch(items, options, n_processes=None, warm_start=True):
+    items = [_item(item) for item in items]
+    options = {k:v for k, v in options.items() if _picklable(v)}
+    n_processes = min(n_processes or os.cpu_count() or 1, max(len(items), 1))
+    t_start = time.perf_counter()
+    solved = {} # index -> successful result
+    def hint_for(i):
+        own = items[i][2]
+        return own if own is not None or not warm_start else _warm_hint(i, solved)
+
+    if n_processes == 1:
+        for i in range(len(items)):
+            centroids, image_shape, _, output_dir = items[i]
+            _, result, solve_s = _solve_item(i, centroids, image_shape, options, hint_for(i), output_dir)
+            if result['success']:
+                solved[i] = result
+            yield i, result, {'solve_s':solve_s, 'elapsed_s':time.perf_counter() - t_start}
+        return
+
+    triangles = database_cache.open_catalogue(database_cache.triangles_path)
+    catalogue_path = resource_path("resources/compressed_tycho2024epoch.npz") # (as platesolve_triangle opens it)
+    searcher = database_cache.open_catalogue(catalogue_path)
+    sky_index = searcher.sky_index()
+    shm, layout = _share({'star_table':searcher.star_table, 'sky_order':sky_index.order, 'sky_key':sky_index.key})
+    try:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_worker,
+                                 initargs=(triangles, catalogue_path, shm.name, layout, sky_index.band_offsets, sky_index.band)) as executor:
+            pending = set()
+            next_item = 0
+            while next_item < len(items) or pending:
+                # keep every worker busy, but submit no further ahead: later items then get the newest solutions as hints
+                while next_item < len(items) and len(pending) < n_processes:
+                    centroids, image_shape, _, output_dir = items[next_item]
+                    pending.add(executor.submit(_solve_item, next_item, centroids, image_shape, options, hint_for(next_item), output_dir))
+                    next_item += 1
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, result, solve_s = future.result()
+                    if result['success']:
+                        solved[i] = result
+                    yield i, result, {'solve_s':solve_s, 'elapsed_s':time.perf_counter() - t_start}
+    finally:
+        shm.close()
+        if _ATTACH_TRACKS:
+            # (the workers unregistered the segment from the resource tracker which they share with this process,
+            # register it again so that unlinking it can unregister it)
+            resource_tracker.register(shm._name, 'shared_memory')
+        shm.unlink()
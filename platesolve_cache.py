@@ -0,0 +1,109 @@
+'''
+persistent cache of platesolve solutions, so that solving the same centroids again (e.g. when the distortion fit or
+the eclipse analysis is re-run on a stacking result) returns at once
+
+the cache is opt-in (options['platesolve_cache'], default False) and kept in options['platesolve_cache_dir']
+
+the key is a fingerprint of the brightest N_STARS centroids (rounded to 1/1000 pixel) and the number of centroids
+(the matched centroids and the acceptance threshold depend on all of them), the image shape, the options which change
+the solution, the pointing hint and the triangle databases which are searched (a solution found in one database is not
+reused for a search of another). Only successful solutions are stored, one JSON file per solution (numpy arrays as
+{'__ndarray__': nested list, 'dtype': str}: a cache file is only data, never code), and the least recently used ones
+are removed above the size cap
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+
+N_STARS = 30
+DEFAULT_DIRECTORY = 'PlatesolveCache'
+DEFAULT_SIZE_MB = 50
+SOLVER_OPTIONS = ('rough_match_threshhold', 'platesolve_progressive', 'platesolve_mirror_mode',
+                  'triangle_database_family', 'triangle_local_index', 'triangle_database_tiled')
+
+'''
+cache key of a platesolve (a hex string)
+solver: the search parameters of platesolve_triangle (f, g, TOLERANCE, SCHEDULE), so that changing them invalidates the cache
+hint: the pointing hint of the platesolve (see platesolve_hint.py), or None
+databases: the triangle databases searched, see platesolve_triangle.database_signature
+'''
+def fingerprint(centroids, image_shape, options, try_mirror_also=True, solver=None, hint=None, databases=None):
+    h = hashlib.sha1()
+    h.update(np.round(np.asarray(centroids, dtype=float)[:N_STARS], 3).tobytes())
+    config = {'n_centroids':len(centroids), 'shape':[int(v) for v in image_shape[:2]], 'mirror':bool(try_mirror_also), 'solver':solver,
+              'hint':hint, 'databases':databases, 'options':{k:options.get(k) for k in SOLVER_OPTIONS}}
+    h.update(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+def _path(key, options):
+    return os.path.join(options.get('platesolve_cache_dir') or DEFAULT_DIRECTORY, key + '.json')
+
+def _encode(obj):
+    if isinstance(obj, np.ndarray):
+        return {'__ndarray__':obj.tolist(), 'dtype':str(obj.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {k:_encode(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v) for v in obj]
+    return obj
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            dtype = np.dtype(obj['dtype'])
+            if not dtype.kind in 'biuf':
+                raise ValueError(f'unexpected array type {dtype} in the platesolve cache')
+            return np.array(obj['__ndarray__'], dtype=dtype)
+        return {k:_decode(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v) for v in obj]
+    return obj
+
+'''
+the cached solution for key, or None
+'''
+def get(key, options):
+    path = _path(key, options)
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            result = _decode(json.load(fp))
+        os.utime(path) # (the modification time orders the entries for eviction)
+    except (OSError, ValueError, TypeError):
+        return None
+    print(f'platesolve cache hit ({key[:12]})')
+    return result
+
+def put(key, result, options):
+    path = _path(key, options)
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(_encode(result), fp)
+        os.replace(tmp, path) # (atomic, concurrent platesolves may store the same key)
+        evict(os.path.dirname(path), options.get('platesolve_cache_mb', DEFAULT_SIZE_MB))
+    except OSError as e:
+        print(f'note: could not store platesolve solution in the cache ({e})')
+
+'''
+remove the least recently used entries until the cache is below size_mb
+'''
+def evict(directory, size_mb):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.json'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(e[1] for e in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= size_mb * 2**20:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,216 @@
+'''
+solver ensemble: race the triangle solver (platesolve_triangle.py) against tetra3 (options['database']), each with its
+own time budget, and return the first solution which passes the acceptance test of
+platesolve_triangle.estimate_acceptance_threshold. The triangle solver runs on the calling thread (it may draw its
+matches with pyplot, which must not be used from other threads), tetra3 in the background. The other solver is then
+cancelled: the triangle solver stops at its next database tile or candidate, and tetra3 (which only honours its own
+solve_timeout) runs in a worker process which is terminated (see _Tetra3Process). The worker loads the tetra3 database
+once and is reused by the following races until it is cancelled
+
+the installed tetra3 must support return_matches (the matched stars are needed to verify its solution); if it has no
+solve_timeout, its time budget is kept by terminating the worker
+
+each race is appended as a line of JSON to options['platesolve_ensemble_log'], so that the defaults can be tuned
+from which solver wins on which fields
+'''
+
+import json
+import time
+import inspect
+import threading
+import datetime
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import database_cache
+import platesolve_triangle
+
+DEFAULT_LOG = 'platesolve_ensemble.jsonl'
+TETRA3_BUDGET = 10 # seconds
+TETRA3_MARGIN = 2 # seconds: the worker is terminated if tetra3 overruns its budget by this
+POLL_INTERVAL = 0.05 # seconds
+
+_log_lock = threading.Lock()
+_tetra3_lock = threading.Lock()
+_idle_tetra3 = {} # database -> idle _Tetra3Process
+
+def _run_triangle(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel):
+    t0 = time.perf_counter()
+    options = dict(options, platesolve_time_budget=options.get('ensemble_triangle_budget', options.get('platesolve_time_budget', platesolve_triangle.TIME_BUDGET)))
+    result = platesolve_triangle.platesolve(centroids, image_shape, options, output_dir=output_dir, try_mirror_also=try_mirror_also, hint=hint, cancel=cancel)
+    return result, time.perf_counter() - t0
+
+'''
+worker process: load the tetra3 database, then solve each (centroids, size, arguments) received on conn
+only the arguments supported by the installed tetra3 are passed on
+'''
+def _tetra3_worker(database, conn):
+    try:
+        t3 = database_cache.open_database(database)
+        parameters = inspect.signature(t3.solve_from_centroids).parameters
+        if not 'return_matches' in parameters:
+            raise Exception("the installed tetra3 cannot return the matched stars (no return_matches), it cannot take part in the ensemble")
+        if not 'solve_timeout' in parameters:
+            print("note: the installed tetra3 has no solve_timeout, its time budget is kept by terminating it")
+    except Exception as e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready', None))
+    while True:
+        try:
+            centroids, size, arguments = conn.recv()
+        except EOFError:
+            return
+        try:
+            conn.send(('solution', t3.solve_from_centroids(centroids, size=size, **{k:v for k, v in arguments.items() if k in parameters})))
+        except Exception as e:
+            conn.send(('error', str(e)))
+
+'''
+tetra3 in a worker process (started with spawn, as the ensemble runs in threads), so that a solve can be cancelled
+'''
+class _Tetra3Process:
+
+    def __init__(self, database):
+        context = multiprocessing.get_context('spawn')
+        self.database = database
+        self.ready = False
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_tetra3_worker, args=(database, child), daemon=True)
+        self.process.start()
+        child.close()
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    # wait for the next message of the worker; None (and the worker terminated) if cancelled or past the deadline
+    def _receive(self, cancel, deadline=None):
+        while not self.conn.poll(POLL_INTERVAL):
+            if cancel.is_set() or (deadline is not None and time.perf_counter() > deadline) or not self.alive():
+                self.terminate()
+                return None
+        status, value = self.conn.recv()
+        if status == 'error':
+            self.terminate()
+            raise Exception(value)
+        return value
+
+    '''
+    the tetra3 solution (a dictionary), or None if cancelled or not solved within timeout seconds (the time to load the
+    database is not counted)
+    '''
+    def solve(self, centroids, size, arguments, timeout, cancel):
+        if not self.ready:
+            self._receive(cancel)
+            if not self.alive():
+                return None
+            self.ready = True
+        self.conn.send((centroids, size, arguments))
+        return self._receive(cancel, time.perf_counter() + timeout)
+
+def _checkout_tetra3(database):
+    with _tetra3_lock:
+        idle = _idle_tetra3.get(database, [])
+        while idle:
+            worker = idle.pop()
+            if worker.alive():
+                return worker
+    return _Tetra3Process(database)
+
+def _checkin_tetra3(worker):
+    if worker.alive():
+        with _tetra3_lock:
+            _idle_tetra3.setdefault(worker.database, []).append(worker)
+
+'''
+stop the idle tetra3 workers (at program exit)
+'''
+def stop_tetra3():
+    with _tetra3_lock:
+        workers = [w for idle in _idle_tetra3.values() for w in idle]
+        _idle_tetra3.clear()
+    for worker in workers:
+        worker.terminate()
+
+def _run_tetra3(centroids, image_shape, options, cancel):
+    t0 = time.perf_counter()
+    budget = options.get('ensemble_tetra3_budget', TETRA3_BUDGET)
+    worker = _checkout_tetra3(options['database'])
+    try:
+        solution = worker.solve(centroids, tuple(image_shape[:2]), {'pattern_checking_stars':options.get('k', 12), 'return_matches':True,
+                                'solve_timeout':1000 * budget}, budget + TETRA3_MARGIN, cancel)
+    finally:
+        _checkin_tetra3(worker)
+    if solution is None or solution.get('RA') is None or not len(solution.get('matched_centroids', [])):
+        return platesolve_triangle.failed_result(), time.perf_counter() - t0
+    stars = np.radians(np.array(solution['matched_stars'], dtype=float)[:, :2]) # (ra, dec, mag) in degrees
+    vectors = np.c_[np.cos(stars[:, 0]) * np.cos(stars[:, 1]), np.sin(stars[:, 0]) * np.cos(stars[:, 1]), np.sin(stars[:, 1])]
+    scale = np.radians(solution['FOV']) / image_shape[1] # (tetra3's FOV is the width of the image)
+    result = platesolve_triangle.verify_solution(centroids, image_shape, solution['matched_centroids'], vectors, scale, options)
+    return result, time.perf_counter() - t0
+
+def _solved(future):
+    return future.exception() is None and future.result()[0]['success']
+
+def _log(options, record):
+    path = options.get('platesolve_ensemble_log', DEFAULT_LOG)
+    if not path:
+        return
+    try:
+        with _log_lock, open(path, 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f'note: could not write the solver statistics ({e})')
+
+'''
+race the solvers, same arguments and result as platesolve_triangle.platesolve (the result has the additional key 'solver')
+without a tetra3 database (options['database']) only the triangle solver runs
+'''
+def solve_ensemble(centroids, image_shape, options, output_dir=None, try_mirror_also=True, hint=None):
+    centroids = np.asarray(centroids, dtype=float)
+    t0 = time.perf_counter()
+    cancel_triangle, cancel_tetra3 = threading.Event(), threading.Event()
+    solvers, tetra3 = ['triangle'], None
+    if options.get('database', ''):
+        solvers.append('tetra3')
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='platesolve_ensemble')
+        tetra3 = executor.submit(_run_tetra3, centroids, image_shape, options, cancel_tetra3)
+        executor.shutdown(wait=False)
+        tetra3.add_done_callback(lambda future: cancel_triangle.set() if _solved(future) else None) # (tetra3 won)
+    winner, result, solver_s = None, platesolve_triangle.failed_result(), {}
+    try:
+        r, solver_s['triangle'] = _run_triangle(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel_triangle)
+        if r['success'] and not cancel_triangle.is_set():
+            winner, result = 'triangle', r
+    except Exception as e:
+        print(f'note: triangle solver failed ({e})')
+    if winner is not None:
+        cancel_tetra3.set()
+    elif tetra3 is not None:
+        try:
+            r, solver_s['tetra3'] = tetra3.result()
+            if r['success']:
+                winner, result = 'tetra3', r
+        except Exception as e:
+            print(f'note: tetra3 solver failed ({e})')
+    elapsed = time.perf_counter() - t0
+    print(f'platesolve ensemble: {winner or "no solver"} succeeded ({elapsed:.2f} s)')
+    result['solver'] = winner
+    _log(options, {'time':datetime.datetime.now().isoformat(timespec='seconds'), 'winner':winner, 'elapsed_s':elapsed,
+                   'solver_s':solver_s, 'solvers':sorted(solvers), 'n_centroids':int(centroids.shape[0]),
+                   'image_shape':[int(v) for v in image_shape[:2]], 'hinted':hint is not None,
+                   'platescale/arcsec':float(result['platescale/arcsec']) if winner else None, 'mirror':bool(result.get('mirror', False))})
+    return result
+
+'''
+platesolve with the ensemble if options['platesolve_ensemble'], else with the triangle solver
+'''
+def platesolve(centroids, image_shape, options={}, output_dir=None, try_mirror_also=True, hint=None):
+    if options.get('platesolve_ensemble', False):
+        return solve_ensemble(centroids, image_shape, options, output_dir=output_dir, try_mirror_also=try_mirror_also, hint=hint)
+    return platesolve_triangle.platesolve(centroids, image_shape, options=options, output_dir=output_dir, try_mirror_also=try_mirror_also, hint=hint)
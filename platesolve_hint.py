@@ -0,0 +1,163 @@
+'''
+approximate pointing ("hint") for platesolve_triangle.platesolve, read from FITS headers or from a previous solution
+
+a hint is a dictionary with the keys (all optional, None if unknown):
+    'ra', 'dec': degrees, approximate centre of the field
+    'radius': degrees, how far the true centre may be from (ra, dec)
+    'scale': (min, max) platescale in arcsec/pixel
+    'roll': (min, max) in degrees, same convention as the 'roll' of the platesolve result
+    'mirror': True if the roll range is that of the mirror image of the field
+with a hint only database triangles whose anchor star is near (ra, dec) are matched, and candidate
+solutions outside the ranges are dropped. If the hinted search fails, platesolve falls back to a blind search
+'''
+
+import json
+import re
+import numpy as np
+from astropy.io import fits
+
+DEFAULT_RADIUS = 5 # degrees: mount pointings in FITS headers are usually better than this
+SCALE_TOLERANCE = 0.1 # relative: focal lengths / pixel sizes in FITS headers are only nominal values
+
+# results of a previous solution are much more precise
+RESULTS_RADIUS = 1
+RESULTS_SCALE_TOLERANCE = 0.02
+RESULTS_ROLL_TOLERANCE = 2
+
+'''
+scale: arcsec/pixel (its range is scale*(1 -/+ scale_tolerance))
+roll: degrees (its range is roll -/+ roll_tolerance)
+'''
+def make_hint(ra=None, dec=None, radius=DEFAULT_RADIUS, scale=None, scale_tolerance=SCALE_TOLERANCE, roll=None, roll_tolerance=None, mirror=False):
+    return {'ra':ra, 'dec':dec, 'radius':radius if ra is not None and dec is not None else None,
+            'scale':(scale * (1 - scale_tolerance), scale * (1 + scale_tolerance)) if scale else None,
+            'roll':((roll - roll_tolerance) % 360, (roll + roll_tolerance) % 360) if roll is not None and roll_tolerance is not None else None,
+            'mirror':bool(mirror)}
+
+'''
+angle from a FITS header value: a number (degrees, or hours if hours=True), or a sexagesimal string such as '12 34 56.7', '-05:12:30'
+returns degrees
+'''
+def parse_angle(value, hours=False):
+    if isinstance(value, (int, float)):
+        return float(value) * (15 if hours else 1)
+    parts = re.split(r'[\s:hdms]+', str(value).strip().lower())
+    parts = [p for p in parts if p]
+    if not parts:
+        raise ValueError(f"cannot parse angle {value!r}")
+    negative = parts[0].startswith('-')
+    vals = [abs(float(p)) for p in parts[:3]]
+    angle = sum(v / 60**i for i, v in enumerate(vals))
+    angle = -angle if negative else angle
+    return angle * (15 if hours else 1)
+
+# is the RA header value in hours: a sexagesimal string such as '12 34 56' is, a number (or a string of one) is in degrees
+def _ra_in_hours(value):
+    if not isinstance(value, str):
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return True
+    return False
+
+'''
+returns (ra, dec) in degrees of the pointing in the header, or None
+'''
+def _header_pointing(header):
+    if 'RA' in header and 'DEC' in header:
+        return parse_angle(header['RA'], hours=_ra_in_hours(header['RA'])), parse_angle(header['DEC'])
+    if 'OBJCTRA' in header and 'OBJCTDEC' in header:
+        return parse_angle(header['OBJCTRA'], hours=True), parse_angle(header['OBJCTDEC'])
+    if str(header.get('CTYPE1', '')).startswith('RA') and 'CRVAL1' in header and 'CRVAL2' in header:
+        return float(header['CRVAL1']), float(header['CRVAL2'])
+    return None
+
+'''
+returns the platescale in arcsec/pixel given by the header, or None
+'''
+def _header_scale(header):
+    if 'CDELT1' in header:
+        return abs(float(header['CDELT1'])) * 3600
+    if 'CD1_1' in header:
+        return np.hypot(float(header['CD1_1']), float(header.get('CD2_1', 0))) * 3600
+    if 'SCALE' in header:
+        return float(header['SCALE'])
+    if 'PIXSCALE' in header:
+        return float(header['PIXSCALE'])
+    if header.get('FOCALLEN') and header.get('XPIXSZ'):
+        # (XPIXSZ is the binned pixel size in microns, FOCALLEN in mm)
+        return 206.264806 * float(header['XPIXSZ']) / float(header['FOCALLEN'])
+    return None
+
+'''
+hint from a FITS header (astropy Header or dict), None if it has neither a pointing nor a platescale
+'''
+def from_fits_header(header, radius=DEFAULT_RADIUS, scale_tolerance=SCALE_TOLERANCE):
+    try:
+        pointing = _header_pointing(header)
+        scale = _header_scale(header)
+    except (ValueError, TypeError) as e:
+        print(f'note: could not read platesolve hint from FITS header ({e})')
+        return None
+    if pointing is None and scale is None:
+        return None
+    ra, dec = pointing if pointing is not None else (None, None)
+    return make_hint(ra, dec, radius=radius, scale=scale, scale_tolerance=scale_tolerance)
+
+def from_fits(path, radius=DEFAULT_RADIUS, scale_tolerance=SCALE_TOLERANCE):
+    return from_fits_header(fits.getheader(path), radius, scale_tolerance)
+
+'''
+hint from the results of a previous run: the results dictionary or the path of its results.txt
+None if that run was not platesolved
+'''
+def from_results(results, radius=RESULTS_RADIUS, scale_tolerance=RESULTS_SCALE_TOLERANCE, roll_tolerance=RESULTS_ROLL_TOLERANCE):
+    if not isinstance(results, dict):
+        with open(results, 'r', encoding="utf-8") as fp:
+            results = json.load(fp)
+    if not results.get('platesolved') or results.get('RA') is None:
+        return None
+    return make_hint(results['RA'], results['DEC'], radius=radius, scale=results['platescale/arcsec'], scale_tolerance=scale_tolerance,
+                     roll=results['roll'], roll_tolerance=roll_tolerance, mirror=results.get('mirror', False))
+
+'''
+hint from a platesolve_triangle.platesolve result (e.g. of a neighbouring frame), None if it did not succeed
+'''
+def from_solution(solution, radius=RESULTS_RADIUS, scale_tolerance=RESULTS_SCALE_TOLERANCE, roll_tolerance=RESULTS_ROLL_TOLERANCE):
+    if solution is None or not solution.get('success'):
+        return None
+    return make_hint(solution['ra'], solution['dec'], radius=radius, scale=solution['platescale/arcsec'], scale_tolerance=scale_tolerance,
+                     roll=solution['roll'], roll_tolerance=roll_tolerance, mirror=solution.get('mirror', False))
+
+'''
+hint from a file: a previous run's results.txt, or a FITS file (header)
+'''
+def from_file(path, options={}):
+    if str(path).lower().endswith(('.txt', '.json')):
+        return from_results(path)
+    return from_fits(path, options.get('platesolve_hint_radius', DEFAULT_RADIUS))
+
+'''
+the hint to use for a platesolve, or None for a blind search:
+    options['platesolve_hint'] (a results.txt or FITS file), if given
+    else the results of the previous solution (the results dictionary of a stacking run), if given
+    else the header of the first FITS file in files
+'''
+def find_hint(options, files=(), results=None):
+    if not options.get('platesolve_use_hint', True):
+        return None
+    hint = None
+    try:
+        if options.get('platesolve_hint', ''):
+            hint = from_file(options['platesolve_hint'], options)
+        elif results is not None:
+            hint = from_results(results)
+        elif len(files):
+            hint = from_fits(files[0], options.get('platesolve_hint_radius', DEFAULT_RADIUS))
+    except (OSError, ValueError, KeyError) as e:
+        print(f'note: no platesolve hint ({e})')
+        return None
+    if hint is not None:
+        print('platesolve hint:', hint)
+    return hint
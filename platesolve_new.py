@@ -1,156 +1,304 @@
 import numpy as np
-import scipy.ndimage
-import scipy.optimize
-import scipy.stats
 import scipy
 from scipy.spatial import KDTree
-from scipy.spatial.distance import pdist, cdist
-from sklearn.preprocessing import normalize
 import itertools
 import os
-from database_lookup2 import database_searcher
+import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from MEE2024util import resource_path
 from pathlib import Path
 import database_cache
 
-def generate():
-    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
-    print(dbs.star_table.shape)
-
-    # parameters for step 1
-    a = 80000
-    b = 120000
-    theta_sep = np.radians(0.65) # 0.65 degrees
-    theta_double_star = np.radians(0.01) # 36 arcsec
-    # parameters for step 2
-    c = 0
-    d = 700000
-    if a+b >= d:
-        raise Exception("weird choice for paramters a,b,d")
-    e = 18
-    theta_pat = np.radians(1.7)
+LOCAL_PATTERN_STARS = 10 # pattern stars of each anchor of a local database (see generate_local)
+LOCAL_DOUBLE_STAR = 0.02 # double star separation of a local database, relative to its pattern radius
 
-    vectors = dbs.star_table[:d, 2:5].astype(np.float32)
-    print(f'keeping down to mag {dbs.star_table[a, 5]}')
-    kd_tree1 = KDTree(vectors)
+'''
+prints the progress of a long running step (at most every `interval` seconds) with an estimated time remaining
+can be replaced by any callable progress(stage, done, total)
+'''
+class PrintProgress:
+
+    def __init__(self, interval=2):
+        self.interval = interval
+        self.stage = None
+        self.t_start = None
+        self.t_last = None
+
+    def __call__(self, stage, done, total):
+        now = time.time()
+        if stage != self.stage:
+            self.stage, self.t_start, self.t_last = stage, now, 0
+        if now - self.t_last < self.interval and done < total:
+            return
+        self.t_last = now
+        eta = (now - self.t_start) / done * (total - done) if done else float('nan')
+        print(f'{stage}: {done}/{total} ({100*done/max(total, 1):.0f}%), ETA {eta:.0f} s')
+
+'''
+step 1 helper: sequentially choose the anchors among the first n1 (brightest) stars
+a star is an anchor if no brighter anchor is within theta_sep (or, for the #a brightest, within theta_double_star)
+returns kept (anchor), kept2 (usable as pattern star) for the first n1 stars
+'''
+def _choose_anchors(vectors, a, theta_sep, theta_double_star, progress):
+    n1 = vectors.shape[0]
+    pairs = KDTree(vectors).query_pairs(theta_sep, output_type='ndarray') # (i, j) with i < j, i.e. i is brighter
+    dist = np.linalg.norm(vectors[pairs[:, 0]].astype(float) - vectors[pairs[:, 1]], axis=1)
+    order = np.lexsort((pairs[:, 0], pairs[:, 1])) # group by the fainter star
+    brighter = pairs[order, 0]
+    double = dist[order] <= theta_double_star
+    indptr = np.r_[0, np.cumsum(np.bincount(pairs[:, 1], minlength=n1))]
+
+    kept = np.zeros(n1, dtype=bool)
+    kept2 = np.zeros(n1, dtype=bool)
+    for i in range(n1):
+        nb = brighter[indptr[i]:indptr[i+1]]
+        no_double = not np.any(kept[nb[double[indptr[i]:indptr[i+1]]]])
+        if i < a:
+            kept[i] = no_double
+        else:
+            kept[i] = not np.any(kept[nb])
+        kept2[i] = kept[i] or no_double
+        if i % 10000 == 0:
+            progress('choosing anchor stars', i, n1)
+    progress('choosing anchor stars', n1, n1)
+    return kept, kept2
+
+_worker = {}
+
+def _init_worker(vectors2):
+    _worker['vectors2'] = vectors2
+    _worker['tree'] = KDTree(vectors2)
+
+'''
+step 2 for a chunk of anchors: find the #c closest and then the #e brightest other pattern stars within theta_pat
+anchors_ind2: index of each anchor in vectors2 (to exclude itself)
+returns pattern_ind (m x (c+e), indices into vectors2), pattern_data (m x (c+e) x 5), ok (False if insufficient neighbours)
+'''
+def _patterns_chunk(anchors_ind2, c, e, theta_pat, workers=1):
+    vectors2, tree = _worker['vectors2'], _worker['tree']
+    anchors = vectors2[anchors_ind2]
+    m = anchors.shape[0]
+    neighbours = tree.query_ball_point(anchors, theta_pat, workers=workers, return_sorted=True)
+    lengths = np.fromiter((len(x) for x in neighbours), dtype=int, count=m)
+    # padded (m x L) array of neighbour indices, sorted by index i.e. by brightness, -1 for padding
+    padded = -np.ones((m, max(lengths.max(initial=0), 1)), dtype=int)
+    rows = np.repeat(np.arange(m), lengths)
+    cols = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded[rows, cols] = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=int, count=lengths.sum())
+    valid = (padded >= 0) & (padded != anchors_ind2[:, None]) # don't match self
+    ok = np.sum(valid, axis=1) >= c+e
+
+    chosen = np.zeros((m, c+e), dtype=int)
+    if c:
+        delta = vectors2[np.maximum(padded, 0)] - anchors[:, None, :]
+        dist = np.where(valid, np.linalg.norm(delta, axis=2), np.inf)
+        nearest = np.argsort(dist, axis=1, kind='stable')[:, :c]
+        chosen[:, :c] = nearest
+        valid[np.arange(m)[:, None], nearest] = False
+    # the e brightest of the rest: valid entries keep their (brightness) order
+    chosen[:, c:] = np.argsort(~valid, axis=1, kind='stable')[:, :e]
+    pattern_ind = np.take_along_axis(padded, chosen, axis=1)
+    pattern_ind[~ok] = -1
+
+    delta = vectors2[np.maximum(pattern_ind, 0)] - anchors[:, None, :]
+    dtheta = 2 * np.arcsin(.5 * np.linalg.norm(delta, axis=2))
+    # dphi calculation: angle in the tangent plane, measured from spherical polar "theta_hat" towards "phi_hat"
+    z = np.array([0, 0, 1])
+    tangent_vector_phi = np.cross(z, anchors)
+    tangent_vector_phi /= np.linalg.norm(tangent_vector_phi, axis=1)[:, None]
+    tangent_vector_theta = np.cross(tangent_vector_phi, anchors)
+    tangent_vector_theta /= np.linalg.norm(tangent_vector_theta, axis=1)[:, None]
+    x = np.einsum('mk,mnk->mn', tangent_vector_theta, delta)
+    y = np.einsum('mk,mnk->mn', tangent_vector_phi, delta)
+    pattern_data = np.zeros((m, c+e, 5), dtype=np.float32)
+    pattern_data[:, :, 0] = dtheta
+    pattern_data[:, :, 1] = np.arctan2(y, x)
+    pattern_data[:, :, 2:5] = vectors2[np.maximum(pattern_ind, 0)] # technically this information is redundant, but it's convenient to have
+    return pattern_ind, pattern_data, ok
+
+'''
+ratio and angle of each of the n(n-1)/2 triangles formed by the anchor and two of its n pattern stars
+pattern_data: (m x n x 5) array
+returns (m x n(n-1)/2 x 2) array
+'''
+def compute_triangles(pattern_data):
+    j, k = np.array(list(itertools.combinations(range(pattern_data.shape[1]), 2))).T
+    ratio = pattern_data[:, k, 0] / pattern_data[:, j, 0]
+    dphi = pattern_data[:, k, 1] - pattern_data[:, j, 1]
+    flip = ratio > 1
+    ratio[flip] = 1 / ratio[flip]
+    dphi[flip] = -dphi[flip]
+    triangles = np.zeros(ratio.shape + (2,), dtype=np.float32)
+    triangles[:, :, 0] = ratio
+    triangles[:, :, 1] = dphi % (2 * np.pi)
+    return triangles
 
-    kept = np.zeros(d, dtype=bool)
-    kept2 = np.zeros(d, dtype=bool)
+'''
+anchors, patterns and triangles of the stars with unit vectors `vectors` (sorted by brightness, brightest first)
+parameters for step 1 (anchors): a, b, theta_sep, theta_double_star (angles in degrees)
+parameters for step 2 (patterns): c, e, theta_pat (degrees)
+returns a dictionary with the arrays of the database (anchors, pattern_ind, pattern_data, triangles)
+'''
+def build_arrays(vectors, a, b, theta_sep, theta_double_star, c, e, theta_pat, n_processes=None, chunk_size=2000, progress=None):
+    progress = progress or PrintProgress()
+    theta_sep = np.radians(theta_sep)
+    theta_double_star = np.radians(theta_double_star)
+    theta_pat = np.radians(theta_pat)
+    n = d = vectors.shape[0]
     '''
     step 1: find set of "anchor" stars
         (1.1) #a brightest stars (exclude double stars)
         (1.2) any of the #b next-brightest stars which are further than theta_sep
         away from any brighter star than themselves
+        the other stars down to #d are used as pattern stars unless they are within theta_double_star of an anchor
     '''
-    
-    for i in range(d):
-        neighbours = kd_tree1.query_ball_point(vectors[i], theta_sep)    
-        neighbours2 = kd_tree1.query_ball_point(vectors[i], theta_double_star)
-            
-        if not np.any(kept[neighbours]):
-            if i < a+b:
-                kept[i] = 1
-            kept2[i] = 1
-        elif not np.any(kept[neighbours2]):
-            if i < a:
-                kept[i] = 1
-            kept2[i] = 1
+    n1 = min(a+b, n)
+    kept = np.zeros(n, dtype=bool)
+    kept2 = np.zeros(n, dtype=bool)
+    kept[:n1], kept2[:n1] = _choose_anchors(vectors[:n1], a, theta_sep, theta_double_star, progress)
+    if n > n1:
+        kept2[n1:] = KDTree(vectors[kept]).query_ball_point(vectors[n1:], theta_double_star, return_length=True, workers=-1) == 0
     print(f'note kept {np.sum(kept[:a])} of first {a} stars as anchors')
     print(f'note kept {np.sum(kept[:a+b])} of first {a+b} stars as anchors')
     print(f'note kept {np.sum(kept2)} of first {d} stars as legs')
-    
-    vectors_kept = vectors[kept, :]
-    kept_vectors_ind = np.nonzero(kept)[0] # np.nonzero returns tuples
-    kept_vectors_ind2 = np.nonzero(kept)[0] # np.nonzero returns tuples
-
-    
-    
-    nkept = vectors_kept.shape[0]
-
-    for i in range(a+b):
-        if (np.abs(np.degrees(dbs.star_table[i, 0]) - 34.5154) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 14.4667) < 0.01) \
-        or (np.abs(np.degrees(dbs.star_table[i, 0]) - 35.4465) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 15.51918) < 0.01) \
-        or (np.abs(np.degrees(dbs.star_table[i, 0]) - 35.50254) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 15.9911) < 0.01) \
-        or (np.abs(np.degrees(dbs.star_table[i, 0]) - 142.989) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 9.715665) < 0.01) \
-        or (np.abs(np.degrees(dbs.star_table[i, 0]) - 143.3175) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 9.1684) < 0.01) \
-        or (np.abs(np.degrees(dbs.star_table[i, 0]) - 143.7188) < 0.01 and np.abs(np.degrees(dbs.star_table[i, 1]) - 9.6767) < 0.01) \
-        :           
-            print(i, dbs.star_table[i, 5], kept[i])
-            
+
     '''
     step 2: (2.1) find the #c closest stars (within theta_pat) (among the #d brightest)
             to each anchor star
             (2.2) find the #e brightest stars (within theta_pat) of each anchor
             anchor star which have not yet been accounted for in (2.1)
-            (2.3) if insufficient stars found, make a note of it
+            (2.3) if insufficient stars found, make a note of it and leave out that anchor
                   statistically, this should be improbable for a good
                   choice of parameters
     '''
     vectors2 = vectors[kept2, :]
-    kd_tree2 = KDTree(vectors2)
-    temp_dict1 = dict(enumerate(kept_vectors_ind))
-    temp_dict2 = dict(map(reversed, enumerate(kept_vectors_ind2)))
-    cumsum = np.cumsum(np.logical_not(kept2).astype(int))
-    pattern_ind = np.ones((nkept, c+e), dtype=int)*-1
-    pattern_data = np.zeros((nkept, c+e, 5), dtype=np.float32) # store r and phi of patterns
-    z = np.array([0, 0, 1])
-    for i in range(nkept):
-        neighbours = kd_tree2.query_ball_point(vectors_kept[i], theta_pat)
-        #neighbours.remove(i) # don't match self
-        ind = kept_vectors_ind[i]
-        neighbours.remove(ind - cumsum[ind]) # don't match self
-        if i == 1661:#31633:
-            print(neighbours)
-        if len(neighbours) < c+e:
-            print(f'note: insufficient neighbours found on index {i}')
-            raise Exception('edge case handling unimplemented!')
-        # delta vectors
-        delta = vectors2[neighbours] - vectors_kept[i]
-        
-        #dtheta
-        dtheta = 2 * np.arcsin(.5 * np.linalg.norm(delta, axis=1))
-        #dphi calculation
-        tangent_vector_phi = np.cross(z, vectors_kept[i]) # spherical polar "phi_hat"
-        tangent_vector_phi /= np.linalg.norm(tangent_vector_phi)
-        tangent_vector_theta = np.cross(tangent_vector_phi, vectors_kept[i]) # spherical polar "theta_hat"
-        tangent_vector_theta /= np.linalg.norm(tangent_vector_theta)
-        x = np.dot(tangent_vector_theta, delta.T)
-        y = np.dot(tangent_vector_phi, delta.T)
-        phi = np.arctan2(y, x)
-
-        # get the c nearest neighbours
-        chosen_c = list(np.argsort(dtheta)[:c])
-        chosen_c_ind = list(np.array(neighbours)[chosen_c])
-        # get the e brightest unselected stars
-        # note that this following line makes use of python set's order-preserving behaviour
-        chosen_e = [x for x in np.argsort(neighbours) if x not in chosen_c_ind][:e]
-        chosen_e_ind = list(np.array(neighbours)[chosen_e])              
-
-        pattern_ind[i, :] = chosen_c_ind + chosen_e_ind
-        pattern_data[i, :, 0] = dtheta[chosen_c+chosen_e]
-        pattern_data[i, :, 1] = phi[chosen_c+chosen_e]
-        pattern_data[i, :, 2:5] = vectors2[chosen_c_ind + chosen_e_ind] # technically this information is redundant, but it's convenient to have
+    anchors_ind2 = np.nonzero(kept[kept2])[0] # index of each anchor among the pattern stars
+    nkept = anchors_ind2.shape[0]
+    if nkept == 0:
+        raise Exception("no anchor stars found")
+    chunks = [anchors_ind2[i:i+chunk_size] for i in range(0, nkept, chunk_size)]
+    n_processes = n_processes or os.cpu_count() or 1
+    results = []
+    if n_processes == 1 or len(chunks) == 1:
+        _init_worker(vectors2)
+        for chunk in chunks:
+            results.append(_patterns_chunk(chunk, c, e, theta_pat, workers=-1))
+            progress('finding patterns', sum(r[0].shape[0] for r in results), nkept)
+    else:
+        with ProcessPoolExecutor(max_workers=n_processes, initializer=_init_worker, initargs=(vectors2,)) as executor:
+            for r in executor.map(_patterns_chunk, chunks, itertools.repeat(c), itertools.repeat(e), itertools.repeat(theta_pat)):
+                results.append(r)
+                progress('finding patterns', sum(r[0].shape[0] for r in results), nkept)
+    pattern_ind = np.concatenate([r[0] for r in results])
+    pattern_data = np.concatenate([r[1] for r in results])
+    ok = np.concatenate([r[2] for r in results])
+    if not np.all(ok):
+        print(f'note: insufficient neighbours found for {np.sum(~ok)} anchor stars (indices {np.nonzero(~ok)[0][:20]}...), leaving them out')
     '''
     step 3: compute all (c+e)*(c+e-1)/2 desired triangles for each anchor star. One of the vertices
             of each pattern is the anchor star
-
     '''
     print('starting to find patterns...')
-    triangles = np.zeros((nkept, (c+e)*(c+e-1)//2, 2), dtype=np.float32)
-
-    for i in range(nkept):
-        for n, (j, k) in enumerate(itertools.combinations(range(c+e), 2)):
-            ratio = pattern_data[i, k, 0] / pattern_data[i, j, 0]
-            dphi  = pattern_data[i, k, 1] - pattern_data[i, j, 1]
-            if ratio > 1:
-                ratio = 1/ratio
-                dphi = -dphi
-            dphi = dphi % (2 * np.pi)
-            triangles[i, n, 0] = ratio
-            triangles[i, n, 1] = dphi
-    Path("TripleTrianglePlatesolveDatabase").mkdir(exist_ok=True)
-    np.savez_compressed("TripleTrianglePlatesolveDatabase/TripleTriangle_pattern_data.npz", anchors = vectors_kept, pattern_ind=pattern_ind, pattern_data=pattern_data, triangles=triangles)
-    print(f"completed generating triangle database -- {triangles.size//2} triangles saved")        
-            
+    triangles = compute_triangles(pattern_data[ok])
+    return {'anchors':vectors2[anchors_ind2[ok]], 'pattern_ind':pattern_ind[ok], 'pattern_data':pattern_data[ok], 'triangles':triangles}
+
+'''
+generate the triple triangle platesolving database from the catalogue
+parameters for step 1 (anchors): a, b, theta_sep, theta_double_star (angles in degrees)
+parameters for step 2 (patterns): c, d, e, theta_pat (degrees)
+output_path: default database_cache.triangles_path
+n_processes: number of processes for step 2 (None: all cpus, 1: in this process)
+progress: callable progress(stage, done, total), default prints progress and ETA
+returns the path of the saved database
+'''
+def generate(a=80000, b=120000, theta_sep=0.65, theta_double_star=0.01, c=0, d=700000, e=18, theta_pat=1.7,
+             output_path=None, n_processes=None, chunk_size=2000, progress=None):
+    output_path = output_path or database_cache.triangles_path
+    t_start = time.time()
+    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
+    if a+b >= d:
+        raise Exception("weird choice for paramters a,b,d")
+    vectors = dbs.star_table[:d, 2:5].astype(np.float32)
+    print(f'keeping down to mag {dbs.star_table[min(a, vectors.shape[0]-1), 5]}')
+    arrays = build_arrays(vectors, a, b, theta_sep, theta_double_star, c, e, theta_pat, n_processes, chunk_size, progress)
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(output_path, **arrays)
+    print(f"completed generating triangle database -- {arrays['triangles'].size//2} triangles saved ({time.time()-t_start:.0f} s)")
+    return output_path
+
+'''
+local triangle database of the catalogue stars within `radius` (degrees) of `centre` (unit vector), built in memory
+for an image `fov` degrees wide (along its longer side): every star (but close doubles) is an anchor, and its pattern
+is the e brightest stars within half the field, so a narrow field has far more anchors than in the global database
+returns the arrays of the database (as build_arrays), or None if there are too few stars
+'''
+def generate_local(centre, radius, fov, e=LOCAL_PATTERN_STARS, star_max_magnitude=12):
+    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
+    tree, kept = dbs.vector_tree(star_max_magnitude)
+    ind = kept[tree.query_ball_point(centre, 2 * np.sin(np.radians(min(radius, 180)) / 2))]
+    ind = ind[np.argsort(dbs.star_table[ind, 5], kind='stable')] # brightest first
+    vectors = dbs.star_table[ind, 2:5].astype(np.float32)
+    if vectors.shape[0] <= e:
+        print(f'note: only {vectors.shape[0]} catalogue stars within {radius:.2f} degrees, no local triangle database')
+        return None
+    theta_pat = fov / 2
+    theta_double_star = theta_pat * LOCAL_DOUBLE_STAR
+    try:
+        return build_arrays(vectors, vectors.shape[0], 0, theta_double_star, theta_double_star, 0, e, theta_pat,
+                            n_processes=1, progress=lambda stage, done, total: None)
+    except Exception as ex:
+        print(f'note: no local triangle database ({ex})')
+        return None
+
+'''
+family of triangle databases, each tuned to a band of fields of view (degrees, along the longer side of the image)
+smaller fields need smaller patterns (theta_pat), more closely spaced anchors (theta_sep) and fainter stars (d),
+larger fields are served by a much smaller database of bright stars. 'standard' is the database generate() makes by default
+'''
+DATABASE_FAMILY = {
+    'narrow':{'fov':(0.5, 2.5), 'params':dict(a=250000, b=350000, theta_sep=0.2, theta_double_star=0.003, d=2000000, e=18, theta_pat=0.5)},
+    'standard':{'fov':(2.5, 10), 'params':dict(a=80000, b=120000, theta_sep=0.65, theta_double_star=0.01, d=700000, e=18, theta_pat=1.7)},
+    'wide':{'fov':(10, 40), 'params':dict(a=8000, b=12000, theta_sep=2.5, theta_double_star=0.04, d=70000, e=12, theta_pat=6)},
+}
+
+def family_member_path(name):
+    if name == 'standard':
+        return database_cache.triangles_path
+    return str(Path(database_cache.triangles_path).parent / f'TripleTriangle_{name}.npz')
+
+'''
+generate the databases of the family (all of DATABASE_FAMILY by default, existing ones are kept unless overwrite)
+and write the family manifest (database_cache.family_path) which database_cache.select_triangle_databases reads
+returns the manifest
+'''
+def generate_family(names=None, overwrite=False, n_processes=None, progress=None):
+    names = names or list(DATABASE_FAMILY.keys())
+    for name in names:
+        if not name in DATABASE_FAMILY:
+            raise Exception("unknown database of the family: " + name)
+    manifest = {'format':1, 'members':{}}
+    if os.path.exists(database_cache.family_path):
+        with open(database_cache.family_path, 'r', encoding="utf-8") as fp:
+            manifest = json.load(fp)
+    for name in names:
+        path = family_member_path(name)
+        if overwrite or not os.path.exists(path):
+            print(f'generating triangle database {name} (field of view {DATABASE_FAMILY[name]["fov"]} degrees)')
+            generate(output_path=path, n_processes=n_processes, progress=progress, **DATABASE_FAMILY[name]['params'])
+        manifest['members'][name] = {'path':path, 'fov':list(DATABASE_FAMILY[name]['fov']), 'params':DATABASE_FAMILY[name]['params']}
+    Path(database_cache.family_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(database_cache.family_path, 'w', encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+    return manifest
+
 if __name__ == '__main__':
-    generate()
+    parser = argparse.ArgumentParser(description='generate the triangle platesolving database')
+    parser.add_argument('--family', nargs='*', default=None, help='generate the family of databases tuned to fields of view (all, or the named ones: ' + ', '.join(DATABASE_FAMILY) + ')')
+    parser.add_argument('--overwrite', action='store_true', help='regenerate existing databases of the family')
+    args = parser.parse_args()
+    if args.family is None:
+        generate()
+    else:
+        generate_family(args.family, overwrite=args.overwrite)
@@ -0,0 +1,285 @@
+'''
+local platesolving service: keeps the triangle database, the star catalogue and its search trees loaded
+between runs, so that a platesolve does not pay for loading them again in every process
+
+start the server (it listens on localhost only):
+    python platesolve_server.py --port 47024 --output-root D:/output
+
+and solve through it with the client function platesolve() below, which has the same arguments and result as
+platesolve_triangle.platesolve. It is used with options['platesolve_server'] = True, and if no server
+is running it solves locally in this process instead
+
+requests are JSON over HTTP:
+    POST /platesolve {'centroids', 'image_shape', 'options', 'hint', 'try_mirror_also', 'output_dir'} -> result dictionary
+    GET /status -> {'ready', 'pid', 'solves'}
+    POST /shutdown (with the header TOKEN_HEADER: the token which the server writes to token_path(port), readable by its user only)
+numpy arrays are sent as {'__ndarray__': nested list, 'dtype': str}
+the server only writes a platesolve's output (output_dir) into the directories given with --output-root, a request
+with any other output_dir is refused (and the client then solves locally). Of the options of a request only the
+solver parameters (REQUEST_OPTIONS) are used: the paths which the platesolve reads or writes (the solution cache,
+the ensemble log, the tetra3 database) are the server's own (see main), and it never displays anything.
+Requests must have the Content-Type application/json and no Origin header (which browsers send), so a web page
+can't post to the server
+'''
+
+import os
+import sys
+import hmac
+import json
+import secrets
+import tempfile
+import time
+import argparse
+import threading
+import traceback
+import urllib.request
+import urllib.error
+import numpy as np
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import database_cache
+import platesolve_triangle
+import platesolve_ensemble
+from MEE2024util import resource_path
+
+DEFAULT_PORT = 47024
+HOST = '127.0.0.1'
+STATUS_TIMEOUT = 1 # seconds to wait for the status of the server
+SOLVE_TIMEOUT_MARGIN = 30 # seconds: a solve request times out after the platesolve time budget plus this
+TOKEN_HEADER = 'X-Platesolve-Token'
+# the options of a request which are passed on to the platesolve
+REQUEST_OPTIONS = ('rough_match_threshhold', 'platesolve_progressive', 'platesolve_mirror_mode', 'platesolve_time_budget',
+                   'platesolve_ensemble', 'ensemble_triangle_budget', 'ensemble_tetra3_budget', 'k',
+                   'triangle_database_family', 'triangle_local_index', 'triangle_database_tiled')
+# the server's own options (main sets the paths from its arguments)
+SERVER_OPTIONS = {'flag_display':False, 'flag_display2':False, 'flag_debug':False, 'platesolve_cache':False, 'platesolve_cache_dir':None,
+                  'platesolve_ensemble_log':'', 'database':''}
+
+# file holding the shutdown token of the server on port
+def token_path(port=DEFAULT_PORT):
+    return os.path.join(tempfile.gettempdir(), f'MEE2024_platesolve_server_{port}.token')
+
+def _encode(obj):
+    if isinstance(obj, np.ndarray):
+        return {'__ndarray__':obj.tolist(), 'dtype':str(obj.dtype)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {k:_encode(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v) for v in obj]
+    return obj
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        if '__ndarray__' in obj:
+            return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+        return {k:_decode(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v) for v in obj]
+    return obj
+
+def dumps(obj):
+    return json.dumps(_encode(obj)).encode('utf-8')
+
+def loads(data):
+    return _decode(json.loads(data.decode('utf-8')))
+
+'''
+load everything a platesolve needs: the triangle database, the catalogue and its vector tree
+'''
+def warm_up():
+    t0 = time.perf_counter()
+    database_cache.prepare_triangles()
+    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
+    dbs.vector_tree(star_max_magnitude=12)
+    database_cache.open_catalogue(database_cache.triangles_path)
+    print(f'platesolve server: databases loaded ({time.perf_counter() - t0:.1f} s)')
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, obj):
+        body = dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, {'ready':self.server.ready.is_set(), 'pid':os.getpid(), 'solves':self.server.solves})
+        else:
+            self._reply(404, {'error':'unknown request ' + self.path})
+
+    def do_POST(self):
+        if self.headers.get('Content-Type', '').split(';')[0].strip() != 'application/json':
+            self._reply(415, {'error':'requests must be application/json'})
+            return
+        if self.headers.get('Origin') is not None:
+            self._reply(403, {'error':'requests from web pages are not accepted'})
+            return
+        try:
+            request = loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except (ValueError, UnicodeDecodeError) as e:
+            self._reply(400, {'error':f'bad request ({e})'})
+            return
+        if self.path == '/shutdown':
+            if not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.server.token):
+                self._reply(403, {'error':'shutdown needs the token of the server'})
+                return
+            self._reply(200, {})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        elif self.path == '/platesolve':
+            output_dir = request.get('output_dir')
+            if output_dir is not None and not self.server.output_allowed(output_dir):
+                self._reply(403, {'error':f'output_dir {output_dir} is outside the output roots of the server'})
+                return
+            self.server.ready.wait()
+            try:
+                result = platesolve_ensemble.platesolve(np.array(request['centroids'], dtype=float), tuple(request['image_shape']),
+                                                        options=self.server.solve_options(request.get('options', {})), output_dir=Path(output_dir) if output_dir is not None else None,
+                                                        try_mirror_also=request.get('try_mirror_also', True), hint=request.get('hint'))
+            except Exception as e:
+                traceback.print_exc()
+                self._reply(500, {'error':str(e)})
+                return
+            self.server.solves += 1
+            self._reply(200, result)
+        else:
+            self._reply(404, {'error':'unknown request ' + self.path})
+
+    def log_message(self, format, *args):
+        pass # (the platesolve prints its own progress)
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port, output_roots=(), options={}):
+        super().__init__((HOST, port), _Handler)
+        self.ready = threading.Event()
+        self.solves = 0
+        self.output_roots = [os.path.realpath(root) for root in output_roots]
+        self.options = dict(SERVER_OPTIONS, **options)
+        self.token = secrets.token_hex(16)
+
+    # the options of a platesolve: the solver parameters of the request (scalars only), and the server's own for the rest
+    def solve_options(self, requested):
+        kept = {k:v for k, v in requested.items() if k in REQUEST_OPTIONS and isinstance(v, (bool, int, float, str))}
+        return dict(kept, **self.options)
+
+    # is output_dir (an absolute path) inside one of the output roots
+    def output_allowed(self, output_dir):
+        if not isinstance(output_dir, str) or not os.path.isabs(output_dir):
+            return False
+        path = os.path.realpath(output_dir)
+        return any(os.path.commonpath([path, root]) == root for root in self.output_roots)
+
+# write the token readable (and writable) by this user only
+def _write_token(path, token):
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(token)
+
+'''
+run the server until it is sent /shutdown (or interrupted)
+output_roots: directories below which the server writes the output of a platesolve (output_dir), none by default
+options: the server's own options, overriding SERVER_OPTIONS (see main)
+'''
+def serve(port=DEFAULT_PORT, output_roots=(), options={}):
+    server = _Server(port, output_roots, options)
+    _write_token(token_path(port), server.token)
+    def _warm():
+        warm_up()
+        server.ready.set()
+    threading.Thread(target=_warm, daemon=True, name='warm_up').start()
+    print(f'platesolve server listening on {HOST}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        database_cache.stop_preparation()
+        platesolve_ensemble.stop_tetra3()
+        try:
+            os.remove(token_path(port))
+        except OSError:
+            pass
+
+def _request(path, payload=None, port=DEFAULT_PORT, timeout=STATUS_TIMEOUT, headers={}):
+    data = dumps(payload) if payload is not None else None
+    req = urllib.request.Request(f'http://{HOST}:{port}{path}', data=data, headers=dict(headers, **{'Content-Type':'application/json'}))
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        return loads(response.read())
+
+'''
+status of the server on port, or None if none is running
+'''
+def status(port=DEFAULT_PORT):
+    try:
+        return _request('/status', port=port)
+    except (OSError, ValueError):
+        return None
+
+'''
+stop the server on port (run as the user who started it: the token is read from token_path(port))
+'''
+def shutdown(port=DEFAULT_PORT):
+    with open(token_path(port), 'r', encoding='utf-8') as fp:
+        token = fp.read().strip()
+    return _request('/shutdown', {}, port=port, headers={TOKEN_HEADER:token})
+
+'''
+client: same arguments and result as platesolve_triangle.platesolve (solving with the ensemble of platesolve_ensemble.py
+if options['platesolve_ensemble'])
+with options['platesolve_server'] the solve is sent to the server on options['platesolve_server_port'],
+falling back to solving in this process if there is no server (or it fails)
+'''
+def platesolve(centroids, image_shape, options={}, output_dir=None, try_mirror_also=True, hint=None):
+    if options.get('platesolve_server', False):
+        port = options.get('platesolve_server_port', DEFAULT_PORT)
+        payload = {'centroids':np.asarray(centroids, dtype=float), 'image_shape':[int(v) for v in image_shape[:2]],
+                   'options':{k:v for k, v in options.items() if k in REQUEST_OPTIONS and _is_json(v)}, 'hint':hint,
+                   'try_mirror_also':try_mirror_also, 'output_dir':os.path.abspath(output_dir) if output_dir is not None else None}
+        timeout = options.get('platesolve_time_budget', platesolve_triangle.TIME_BUDGET) + SOLVE_TIMEOUT_MARGIN
+        try:
+            return _request('/platesolve', payload, port=port, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            print(f'platesolve server failed ({e}) ... solving locally')
+        except (OSError, ValueError) as e:
+            print(f'no platesolve server on port {port} ({e}) ... solving locally')
+    return platesolve_ensemble.platesolve(centroids, image_shape, options=options, output_dir=output_dir, try_mirror_also=try_mirror_also, hint=hint)
+
+# (options such as open file handles or functions can't be sent, and are not needed by the platesolve)
+def _is_json(value):
+    try:
+        json.dumps(_encode(value))
+        return True
+    except (TypeError, ValueError):
+        return False
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='local platesolving server')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--stop', action='store_true', help='stop the server running on port')
+    parser.add_argument('--output-root', action='append', default=[], help='directory into which platesolves may write their output (repeatable)')
+    parser.add_argument('--cache-dir', default=None, help='keep a cache of platesolve solutions in this directory (default: no cache)')
+    parser.add_argument('--ensemble-log', default='', help='file to which the solver ensemble appends its statistics (default: none)')
+    parser.add_argument('--database', default='', help='tetra3 database for the solver ensemble (default: triangle solver only)')
+    args = parser.parse_args(argv)
+    if args.stop:
+        shutdown(args.port)
+        return 0
+    if status(args.port) is not None:
+        print(f'a platesolve server is already running on port {args.port}')
+        return 1
+    serve(args.port, args.output_root, {'platesolve_cache':args.cache_dir is not None, 'platesolve_cache_dir':args.cache_dir,
+                                        'platesolve_ensemble_log':args.ensemble_log, 'database':args.database})
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
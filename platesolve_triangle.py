@@ -12,20 +12,25 @@ from scipy.spatial import KDTree
 from scipy.spatial.distance import pdist, cdist
 from sklearn.preprocessing import normalize
 import itertools
+import os
 import zipfile
 import pandas as pd
 from collections import defaultdict
 import transforms
+import transform_kernels
 import itertools
 import json
 import matplotlib.pyplot as plt
 import cProfile
 import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import connected_components
 import database_cache
-from MEE2024util import resource_path, get_bbox
+import platesolve_cache
+import instrumentation
+from MEE2024util import resource_path
 from sklearn.neighbors import NearestNeighbors
 import math
 
@@ -40,6 +45,14 @@ TOL_ROLL = np.radians(0.025) # 0.025 degrees for roll tolerances
 log_TOL_SCALE = 0.01      # 1 part in 100 for platescale
 MAX_MATCH = 100 # maximum number of verification stars
 
+'''
+progressive search: (f, g, TOLERANCE) of each stage, tried in turn until a solution is accepted
+the cheap first stages solve most fields, the last one is wider than the previous fixed (7, 12, 0.01) search
+'''
+SCHEDULE = ((3, 8, 0.005), (5, 10, 0.0075), (7, 12, 0.01), (10, 16, 0.015))
+TIME_BUDGET = 60 # seconds: no further stage is started after this
+LOCAL_INDEX_FOV = 1 # degrees: (with a hint) narrower fields are matched against a local triangle database, see database_sources
+
 '''
 statistically estimate how many stars need to be matched to a given accuracy in order to accept a platesolve
 n_obs: how many stars were observed
@@ -48,18 +61,20 @@ threshold_match: radians: all matched stars are within this limit of each other
 g: how many oberserved stars are used to platesolve
 addon: empirical integer to add to threshold to get a "significant" value. For the limit as N_stars -> infinity, addon=2 already
 will provide an assurance approaching certainty that the match is correct. Default: 3
+parities: how many parities of the field (1, or 2 if its mirror image was searched as well) the candidates were drawn from:
+the number of chance triangle matches, and so the threshold, grows with it
 
 note: not taken into account that stars dimmer than the dimmest star in the catalog should be excluded from the observed stars
 note2: we assume stars are isotropically distributed in the sky
 '''
-def estimate_acceptance_threshold(n_obs, N_stars_catalog, threshold_match, g, addon=3):
+def estimate_acceptance_threshold(n_obs, N_stars_catalog, threshold_match, g, addon=3, tolerance=TOLERANCE, parities=1):
     p = N_stars_catalog * threshold_match**2 / 4 # propability that a randomly chosen point will be with threshold of a star.
     # the factor of 4 comes from the ratio of the surface area of a sphere to a circle of a given radius
 
     poisson_lambda = p*(n_obs-3) # for a single random match, the number of matches can be approximated by a Poisson distribution
     # the minus three is because three of the observed stars are used to platesolve a match
     
-    N = math.comb(N_stars_catalog, 3) * math.comb(g, 3) * TOLERANCE**2
+    N = math.comb(N_stars_catalog, 3) * math.comb(g, 3) * tolerance**2 * parities
     # number of "attempts" at sampling the Poisson distribution we have by matching a triangle of
     # observed stars to a triangle of catalogue stars
     # note that this is quite a vast overestimate - since almost all triangles will not
@@ -83,8 +98,12 @@ def estimate_acceptance_threshold(n_obs, N_stars_catalog, threshold_match, g, ad
 
 def match_centroids(centroids, platescale_fit, image_size, options):
     dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
-    corners = transforms.to_polar(transforms.linear_transform(platescale_fit, np.array([[0,0], [image_size[0]-1., image_size[1]-1.], [0, image_size[1]-1.], [image_size[0]-1., 0]]) - np.array([image_size[0]/2, image_size[1]/2])))
-    stardata = dbs.lookup_objects(*get_bbox(corners), star_max_magnitude=12)[0]
+    # catalogue stars in the cone around the centre of the image through its corners (also right across a pole)
+    corners = transforms.linear_transform(platescale_fit, np.array([[0,0], [image_size[0]-1., image_size[1]-1.], [0, image_size[1]-1.], [image_size[0]-1., 0]]) - np.array([image_size[0]/2, image_size[1]/2]))
+    centre = transforms.linear_transform(platescale_fit, np.zeros((1, 2)))
+    radius = np.degrees(np.arccos(np.clip(np.min(corners @ centre[0]), -1, 1)))
+    centre_dec, centre_ra = transforms.to_polar(centre)[0]
+    stardata = dbs.cone_search(centre_ra, centre_dec, radius, star_max_magnitude=12)[0]
     all_star_plate = centroids - np.array([image_size[0]/2, image_size[1]/2])
     all_vectors = transforms.linear_transform(platescale_fit, all_star_plate)
     transformed_all = transforms.to_polar(all_vectors)
@@ -142,6 +161,71 @@ def match_centroids(centroids, platescale_fit, image_size, options):
     max_error = np.max(errors) if errors.size else match_threshhold
     return stardata, plate2, max_error
 
+'''
+batched rough verification of K candidate attitudes at once
+star_plate: n by 2 array of zero-centred pixel coordinates of the observed stars (as in match_centroids)
+plates: K by 4 array of (scale, ra, dec, roll) in radians (linear_transform convention)
+all stars are transformed under all attitudes in one go, and the catalogue tree (stars brighter than magnitude 12)
+is queried once for all of them
+returns: array of length K, the number of observed stars with an unambiguous catalogue star within rough_match_threshhold
+         (the full match_centroids additionally requires the match to be reflexive, so it finds at most about as many)
+'''
+def rough_match_counts(star_plate, plates, options):
+    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
+    tree, _ = dbs.vector_tree(star_max_magnitude=12)
+    plates = np.asarray(plates, dtype=float).reshape((-1, 4))
+    K, n = plates.shape[0], star_plate.shape[0]
+    if n == 0:
+        return np.zeros(K, dtype=int)
+    all_vectors = transform_kernels.forward(plates, star_plate, dtype=np.float64) # (K x n x 3)
+    distances, _ = tree.query(all_vectors.reshape((-1, 3)), k=2, workers=-1)
+    distances = distances.reshape((K, n, 2))
+    match_threshhold = np.radians(options['rough_match_threshhold']/3600)
+    confusion_ratio = 2
+    keep = np.logical_and(distances[:, :, 0] < match_threshhold, distances[:, :, 1] > confusion_ratio * distances[:, :, 0])
+    return np.sum(keep, axis=1)
+
+'''
+ra, dec, roll (degrees, same convention as the platesolve result) of the rotation matrix from image to catalogue vectors
+'''
+def attitude_from_rotation(rotation_matrix):
+    acc_ra = np.rad2deg(np.arctan2(rotation_matrix[0, 1],
+                                       rotation_matrix[0, 0])) % 360
+    acc_dec = np.rad2deg(np.arctan2(rotation_matrix[0, 2],
+                                        np.linalg.norm(rotation_matrix[1:3, 2])))
+    acc_roll = np.rad2deg(np.arctan2(rotation_matrix[1, 2],
+                                         rotation_matrix[2, 2])) % 360
+    acc_roll = (acc_roll + 180) % 360 # ???
+    return acc_ra, acc_dec, acc_roll
+
+def failed_result():
+    return {'success':False, 'x':None, 'platescale':None, 'matched_centroids':None, 'matched_stars':None, 'platescale/arcsec':None, 'ra':None, 'dec':None, 'roll':None, 'mirror':False}
+
+'''
+verify a solution found by other means (e.g. by tetra3) the same way as the candidates of the triangle search:
+fit the attitude to the matched pairs, match all centroids under it and accept it if at least estimate_acceptance_threshold
+stars match
+matched_centroids: n by 2 array (y, x) of centroids, matched_vectors: n by 3 array of the unit vectors of their catalogue stars
+scale: platescale in radians per pixel
+returns a platesolve result dictionary (success False if rejected)
+'''
+def verify_solution(centroids, image_size, matched_centroids, matched_vectors, scale, options, g=g, tolerance=TOLERANCE):
+    dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
+    centre = np.array([image_size[0]/2, image_size[1]/2])
+    if len(matched_centroids) < 3:
+        return failed_result()
+    ivects = transforms.icoord_to_vector((np.asarray(matched_centroids, dtype=float) - centre) * scale)
+    ra, dec, roll = attitude_from_rotation(_find_rotation_matrix(ivects, np.asarray(matched_vectors, dtype=float)))
+    platescale = (np.degrees(scale), ra, dec, roll+180)
+    stardata, plate2, max_error = match_centroids(centroids[:MAX_MATCH, :], np.radians(platescale), image_size, options)
+    thresh = estimate_acceptance_threshold(min(centroids.shape[0], MAX_MATCH), dbs.star_table.shape[0], max_error, g, addon=3, tolerance=tolerance)
+    if stardata.shape[0] < thresh:
+        print(f"note: solution rejected (nstars matched = {stardata.shape[0]}, thresh = {thresh})")
+        return failed_result()
+    print(f"MATCH ACCEPTED (nstars matched = {stardata.shape[0]}, thresh = {thresh})")
+    return {'success':True, 'x':np.radians(platescale), 'platescale/arcsec':3600*np.degrees(scale), 'ra':ra, 'dec':dec, 'roll':roll,
+            'matched_centroids':plate2+centre, 'matched_stars':stardata, 'mirror':False}
+
 # note: lifted from tetra
 def _find_rotation_matrix(image_vectors, catalog_vectors):
     """Calculate the least squares best rotation matrix between the two sets of vectors.
@@ -185,77 +269,239 @@ def compute_platescale(triangles, pattern_data, anchors, match_cand, match_data,
     roll = np.arctan2(rmatrix[:, 1, 2], rmatrix[:, 2, 2]) % (2*np.pi)
     return scale, roll, center_vect, rmatrix, target
 
+'''
+all observed triangles formed by one of the #f brightest stars (the "anchor") and two of the #g brightest stars, as arrays
+vectors: (n x 2) zero-centred pixel vectors in (x, y) convention
+returns ratio, dphi (the triangle features, as in the database), r1, phi1 (the longer side and its polar angle),
+        v (m x 3 x 2 array of the anchor and the two other stars in pixel space), triplet (m x 3 array of star indices)
+'''
+def observed_triangles(vectors, f=f, g=g):
+    combos = np.array(list(itertools.combinations(range(g), 2))).reshape((-1, 2))
+    i = np.repeat(np.arange(f), combos.shape[0])
+    j = np.tile(combos[:, 0], f)
+    k = np.tile(combos[:, 1], f)
+    keep = (j != i) & (k != i) & (np.maximum(i, k) < vectors.shape[0])
+    i, j, k = i[keep], j[keep], k[keep]
+    v0 = vectors[i, :]
+    v1 = vectors[j, :] - v0
+    v2 = vectors[k, :] - v0
+    r1 = np.linalg.norm(v1, axis=1)
+    r2 = np.linalg.norm(v2, axis=1)
+    phi1 = np.arctan2(v1[:, 1], v1[:, 0])
+    phi2 = np.arctan2(v2[:, 1], v2[:, 0])
+    ratio = r2 / r1
+    dphi = phi2 - phi1
+    # order the two legs so that the ratio is <= 1
+    swap = ratio > 1
+    ratio[swap] = 1 / ratio[swap]
+    dphi[swap] = -dphi[swap]
+    dphi = dphi % (2 * np.pi)
+    r1, phi1 = np.where(swap, r2, r1), np.where(swap, phi2, phi1)
+    v1, v2 = np.where(swap[:, None], v2, v1), np.where(swap[:, None], v1, v2)
+    triplet = np.c_[i, np.where(swap, k, j), np.where(swap, j, k)]
+    return ratio, dphi, r1, phi1, np.stack([v0, v1 + v0, v2 + v0], axis=1), triplet
+
+'''
+look up all observed triangles of one or more sets of vectors in the database with a single batched ball query
+vector_sets: list of (n x 2) arrays, e.g. the field and its mirror image
+kd_tree: KDTree (or triangle_database.GridIndex / HashIndex) over the database triangles, T: number of triangles per anchor
+pairs: helper array to convert triangle index -> pattern star pair (j, k)
+returns for each set of vectors: match_cand (index of the matched database triangle), match_data ([r, phi] of the longer side of the observed triangle),
+        match_vect (v0, v1, v2 of the observed triangle in pixel space), match_info (observed star indices), triangle_info (database pattern star pair)
+'''
+def query_triangles_multi(vector_sets, kd_tree, T, pairs, f=f, g=g, tolerance=TOLERANCE):
+    observed = [observed_triangles(vectors, f, g) for vectors in vector_sets]
+    features = np.concatenate([np.c_[o[0], o[1]] for o in observed]).reshape((-1, 2))
+    if hasattr(kd_tree, 'query_flat'): # (GridIndex / HashIndex: directly as flat arrays)
+        lengths, all_cand = kd_tree.query_flat(features, tolerance)
+    else:
+        cand = kd_tree.query_ball_point(features, tolerance, workers=-1, return_sorted=True) if features.shape[0] else []
+        lengths = np.fromiter((len(c) for c in cand), dtype=int, count=len(cand))
+        all_cand = np.fromiter(itertools.chain.from_iterable(cand), dtype=np.int64, count=lengths.sum())
+    out = []
+    i0 = j0 = 0 # position of this set's triangles in features, and of their matches in all_cand
+    for ratio, dphi, r1, phi1, v, triplet in observed:
+        i1 = i0 + ratio.shape[0]
+        j1 = j0 + lengths[i0:i1].sum()
+        match_cand = all_cand[j0:j1]
+        obs = np.repeat(np.arange(i1 - i0), lengths[i0:i1]) # observed triangle of each match
+        match_data = np.c_[r1, phi1][obs].reshape((-1, 2))
+        match_vect = v[obs].reshape((-1, 3, 2))
+        match_info = triplet[obs].reshape((-1, 3))
+        triangle_info = pairs[match_cand % T].reshape((-1, 2))
+        out.append((match_cand, match_data, match_vect, match_info, triangle_info))
+        i0, j0 = i1, j1
+    return out
+
+def query_triangles(vectors, kd_tree, T, pairs, f=f, g=g, tolerance=TOLERANCE):
+    return query_triangles_multi([vectors], kd_tree, T, pairs, f, g, tolerance)[0]
+
 def load():
     data = database_cache.open_catalogue("TripleTrianglePlatesolveDatabase/TripleTriangle_pattern_data.npz")
     return data.kd_tree, data.anchors, data.pattern_ind, data.pattern_data, data.triangles
     
-def match_triangles(centroids, image_shape, options):
-    t0 = time.perf_counter(), time.process_time()
-    kd_tree, anchors, pattern_ind, pattern_data, triangles = load()
+'''
+the (tiles of the) triangle databases to search: a list of (kd_tree, anchors, pattern_data, triangles), or with
+options['triangle_database_tiled'] a generator streaming the sky tiles near the hinted pointing (all tiles without a hint)
+with options['triangle_database_family'] the databases of the family are chosen by the field of view, see database_cache.select_triangle_databases
+with a hinted pointing and platescale, options['triangle_local_index'] (True, or 'auto' for fields narrower than LOCAL_INDEX_FOV)
+searches only a local database built from the catalogue stars around the hinted centre instead
+'''
+def database_sources(options, hint=None, image_shape=None):
+    fov = _local_index_fov(options, hint, image_shape)
+    if fov is not None:
+        data = database_cache.open_local_triangles(_hint_vector(hint), np.degrees(hint_anchor_radius(hint, image_shape)), fov)
+        if data is not None:
+            return [(data.kd_tree, data.anchors, data.pattern_data, data.triangles)]
+    paths = _database_paths(options, hint, image_shape)
+    if not options.get('triangle_database_tiled', False):
+        sources = []
+        for path in paths:
+            data = database_cache.open_triangle_database(path)
+            sources.append((data.kd_tree, data.anchors, data.pattern_data, data.triangles))
+        return sources
+    return itertools.chain.from_iterable(_tile_sources(path, options, hint, image_shape) for path in paths)
+
+# field of view (degrees) of the local database to search instead of the database files, None if none is to be used
+def _local_index_fov(options, hint, image_shape):
+    local = options.get('triangle_local_index', 'auto')
+    if local and hint is not None and hint.get('ra') is not None and hint.get('scale') is not None:
+        fov = max(image_shape[:2]) * np.mean(hint['scale']) / 3600
+        if local is True or (local == 'auto' and fov < LOCAL_INDEX_FOV):
+            return fov
+    return None
+
+def _database_paths(options, hint, image_shape, verbose=True):
+    if options.get('triangle_database_family', True):
+        return database_cache.select_triangle_databases(image_shape, hint.get('scale') if hint is not None else None, verbose=verbose)
+    return [database_cache.triangles_path]
+
+'''
+the triangle databases which the hinted search (if there is a hint) and the blind search would use, without opening them:
+a list of ('local', ra, dec, fov) or (path, modification time) entries, so that a cached solution is only reused for the
+same databases (see platesolve_cache.fingerprint)
+'''
+def database_signature(options, hint=None, image_shape=None):
+    signature = []
+    for h in ([hint, None] if hint is not None else [None]):
+        fov = _local_index_fov(options, h, image_shape)
+        if fov is not None:
+            signature.append(('local', h['ra'], h['dec'], round(fov, 6)))
+        signature += [(path, os.path.getmtime(path) if os.path.exists(path) else None) for path in _database_paths(options, h, image_shape, verbose=False)]
+    return signature
+
+def _tile_sources(path, options, hint, image_shape):
+    tiles = database_cache.open_triangle_tiles(path, memory_budget_mb=options.get('triangle_tile_memory_mb', 1024))
+    if hint is not None and hint.get('ra') is not None:
+        names = tiles.tiles_near(_hint_vector(hint), hint_anchor_radius(hint, image_shape))
+    else:
+        names = tiles.tiles_near()
+    print(f'searching {len(names)} of {len(tiles.tiles)} sky tiles of the triangle database')
+    return ((index, arrays['anchors'], arrays['pattern_data'], arrays['triangles'])
+            for name, arrays, index in tiles.stream(names, options.get('triangle_tile_threads', 4)))
+
+'''
+match the observed triangles of vector_sets in one database (or tile) source
+returns for each set of vectors (scale, roll, center_vect, match_info, triangle_info, target)
+'''
+def _match_source(source, vector_sets, image_shape, f, g, tolerance, hint):
+    kd_tree, anchors, pattern_data, triangles = source
     pairs = np.array(list(itertools.combinations(range(pattern_data.shape[1]), r=2))) # helper array to convert index i -> pairs (j, k)
+    with instrumentation.span('platesolve.triangle_query') as s:
+        found = query_triangles_multi(vector_sets, kd_tree, triangles.shape[1], pairs, f, g, tolerance)
+        s.items = sum(m[0].shape[0] for m in found)
+    if hint is not None and hint.get('ra') is not None:
+        near = hint_anchor_mask(anchors, hint, image_shape)
+        n_before = sum(m[0].shape[0] for m in found)
+        found = [tuple(a[near[m[0] // triangles.shape[1]]] for a in m) for m in found]
+        print(f'hint: kept {sum(m[0].shape[0] for m in found)} of {n_before} triangle matches with an anchor star near the hinted centre')
+    #find_matching_triangles(matches, triangles, pattern_data, anchors, given_scale)
+    #cProfile.runctx('compute_platescale(triangles, pattern_data, anchors, match_cand, match_data, match_vect)', globals(), locals())
+    match_cand, match_data, match_vect = [np.concatenate([m[i] for m in found]) for i in range(3)]
+    with instrumentation.span('platesolve.compute_platescale', items=match_cand.shape[0]):
+        scale, roll, center_vect, matrix, target = compute_platescale(triangles, pattern_data, anchors, match_cand, match_data, match_vect)
+    out = []
+    j0 = 0
+    for match_cand, match_data, match_vect, match_info, triangle_info in found:
+        j1 = j0 + match_cand.shape[0]
+        out.append((scale[j0:j1], roll[j0:j1], center_vect[j0:j1], match_info, triangle_info, target[j0:j1]))
+        j0 = j1
+    return out
+
+'''
+find the database triangles matching the observed ones, and the platescale / attitude each match implies
+mirror_also: also (in the same search) match the mirror image of the field, i.e. with the centroid axes swapped
+hint: only keep the matches which agree with the hinted centre and platescale (see platesolve_hint.py)
+returns a list with (scale, roll, center_vect, match_info, triangle_info, vectors, target) for the field (and its mirror image)
+'''
+def match_triangles(centroids, image_shape, options, f=f, g=g, tolerance=TOLERANCE, mirror_also=False, hint=None, cancel=None):
+    with instrumentation.span('platesolve.load_database'):
+        sources = database_sources(options, hint, image_shape)
     print('loaded database')
     vectors = np.c_[centroids[:, 1], centroids[:, 0]] - np.array([image_shape[1], image_shape[0]]) / 2 # zero-centre pixel vectors, also (for some reason) use (x, y) convention
     #vectors = np.c_[df['px'], df['py']] - np.array([meta_data['img_shape'][1], meta_data['img_shape'][0]]) / 2
     #plt.scatter(vectors[:, 0], vectors[:, 1])
     #plt.show()
     print('mean:', np.mean(vectors, axis=0))
-    #matches = [defaultdict(list) for _ in range(f)]
-    match_cand = [] # index of triangle matches
-    match_data = [] # [r, phi] the longer side and polar angle of the matched triangles
-    match_vect = [] # [v1, v2, v3]
-                    # v0: coordinate of the center star in 2D-pixel space,
-                    # v1, v2: vectors from center star to the two neighbouring stars
-    match_info = []
-    triangle_info = []
-    t1 = time.perf_counter(), time.process_time()
-    print(f" Real time loading: {t1[0] - t0[0]:.2f} seconds")
-    for i in range(f):
-        for n, (j, k) in enumerate(itertools.combinations(range(g), 2)):
-            if j == i or k == i or max(i, k) >= vectors.shape[0]:
-                continue            
-            v0 = vectors[i, :]
-            v1 = vectors[j, :] - v0
-            v2 = vectors[k, :] - v0
-            r1 = np.linalg.norm(v1)
-            r2 = np.linalg.norm(v2)
-            ratio = r2 / r1
-            phi1 = np.arctan2(v1[1], v1[0])
-            phi2 = np.arctan2(v2[1], v2[0])
-            dphi = phi2 - phi1
-            triplet = (i, j, k)
-            if ratio > 1:
-                ratio = 1/ratio
-                dphi = -dphi
-                phi1, phi2 = phi2, phi1
-                r1, r2 = r2, r1
-                v1, v2 = v2, v1
-                triplet = (i, k, j)
-            dphi = dphi % (2 * np.pi)
-            cand = kd_tree.query_ball_point([ratio, dphi], TOLERANCE)
-            ind = np.array(cand) // triangles.shape[1]
-            array_vect = np.c_[v0, v1 + v0, v2 + v0]
-            for ind_, cand_ in zip(ind, cand):              
-                #matches[i][ind_].append((cand_, r1, phi1, array_vect))
-                match_cand.append(cand_)
-                match_data.append([r1, phi1])
-                match_vect.append(array_vect.T)
-                match_info.append(triplet)
-                rem = cand_ % triangles.shape[1]
-                triangle_info.append(pairs[rem])
-    t2 = time.perf_counter(), time.process_time()
-    #print(f" CPU time: {t2[1] - t1[1]:.2f} seconds")
-    match_cand = np.array(match_cand)
-    match_data = np.array(match_data)
-    match_vect = np.array(match_vect)
-    print(f" Real time prepare: {t2[0] - t1[0]:.2f} seconds")
-    #find_matching_triangles(matches, triangles, pattern_data, anchors, given_scale)
-    t3 = time.perf_counter(), time.process_time()
-    print(f" Real time match: {t3[0] - t2[0]:.2f} seconds")
-    #cProfile.runctx('compute_platescale(triangles, pattern_data, anchors, match_cand, match_data, match_vect)', globals(), locals())
-    scale, roll, center_vect, matrix, target = compute_platescale(triangles, pattern_data, anchors, match_cand, match_data, match_vect)
-    t4 = time.perf_counter(), time.process_time()
-    print(f" Real time platescale compute: {t4[0] - t3[0]:.2f} seconds")
-    return scale, roll, center_vect, match_info, triangle_info, vectors, target
+    # a mirrored triangle has the same ratio and the opposite dphi, so both parities are found by the same query
+    vector_sets = [vectors, vectors[:, ::-1]] if mirror_also else [vectors]
+    if isinstance(sources, list) and len(sources) > 1: # (several databases of the family: search them concurrently)
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            per_source = list(executor.map(lambda source: _match_source(source, vector_sets, image_shape, f, g, tolerance, hint), sources))
+    else:
+        per_source = []
+        for source in sources: # (the tiles of a tiled database are streamed: stop between them when cancelled)
+            if _cancelled(cancel):
+                break
+            per_source.append(_match_source(source, vector_sets, image_shape, f, g, tolerance, hint))
+    out = []
+    for p, vecs in enumerate(vector_sets):
+        parts = [m[p] for m in per_source]
+        if parts:
+            scale, roll, center_vect, match_info, triangle_info, target = [np.concatenate([part[i] for part in parts]) for i in range(6)]
+        else:
+            scale, roll, center_vect, match_info, triangle_info, target = np.zeros(0), np.zeros(0), np.zeros((0, 3)), np.zeros((0, 3), dtype=int), np.zeros((0, 2), dtype=int), np.zeros((0, 3, 3))
+        matches = (scale, roll, center_vect, match_info, triangle_info, vecs, target)
+        if hint is not None:
+            keep = hint_match_mask(matches[0], matches[2], hint)
+            matches = tuple(a if a is vecs else a[keep] for a in matches)
+        out.append(matches)
+    return out
+
+def _hint_vector(hint):
+    ra, dec = np.radians(hint['ra']), np.radians(hint['dec'])
+    return np.array([np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)])
+
+# is the angle (degrees) in the range (lo, hi), which may wrap around 360
+def _in_range(angle, angle_range):
+    lo, hi = angle_range
+    return (angle - lo) % 360 <= (hi - lo) % 360
+
+'''
+boolean mask of the database anchor stars which can be on the field if its centre is within the hinted radius (and that radius)
+an anchor can be anywhere on the field, so the radius is widened by half the field diagonal at the largest hinted
+platescale (without a hinted platescale, the hinted radius has to include the whole field)
+'''
+def hint_anchor_mask(anchors, hint, image_shape):
+    return np.asarray(anchors) @ _hint_vector(hint) >= np.cos(min(hint_anchor_radius(hint, image_shape), np.pi))
+
+def hint_anchor_radius(hint, image_shape):
+    radius = np.radians(hint['radius'])
+    if hint.get('scale') is not None:
+        radius += np.hypot(image_shape[0], image_shape[1]) / 2 * np.radians(hint['scale'][1] / 3600)
+    return radius
+
+'''
+boolean mask of the matches whose platescale (radians per pixel) and field centre (3-vector) agree with the hint
+'''
+def hint_match_mask(scale, center_vect, hint):
+    keep = np.ones(scale.shape[0], dtype=bool)
+    if hint.get('scale') is not None:
+        arcsec = np.degrees(scale) * 3600
+        keep &= (arcsec >= hint['scale'][0]) & (arcsec <= hint['scale'][1])
+    if hint.get('ra') is not None:
+        keep &= center_vect @ _hint_vector(hint) >= np.cos(min(np.radians(hint['radius']), np.pi))
+    return keep
 
 '''
 input:
@@ -263,139 +509,262 @@ input:
     image_shape: shape of image in pixels
     options: dictionary of other parameters
     try_mirror_also: tolerate a mirrored input by also trying to platesolve the mirrored image
+    hint: approximate pointing, platescale and roll (see platesolve_hint.py) to restrict the search to,
+          if the hinted search fails a blind search follows
 output: dictionary
         "success": True or False
+        "mirror": True if the solution is for the mirror image of the field (centroid axes swapped)
         "platescale", "ra", "dec", "roll": (scale, ra, dec, roll) in arcsec/degrees
         "x": tuple of the above but in RADIANS, and with a 180 degree (pi) flip in roll for some convention consistency (TODO: fix?)
         "matched_centroids": n by 2 array
         "matched_stars": n by 6 array (ra, dec, 3-vect, mag) (but with ra/dec in RADIANS)
+        "stage": (f, g, tolerance) of the search stage which found the solution (or of the last one tried)
+options (optional keys):
+        "platesolve_progressive": search in the stages of SCHEDULE (default True), else in a single stage (f, g, TOLERANCE)
+        "platesolve_time_budget": seconds after which no further stage is started (default TIME_BUDGET)
+        "platesolve_mirror_mode": 'single_pass' (default): the mirror image is matched in the same triangle search as the field,
+                                  'second_pass': the whole search is repeated for the mirror image if the field could not be solved
+        "platesolve_cache": reuse the solution of the same centroids from the cache in options['platesolve_cache_dir']
+                            (default False, see platesolve_cache.py)
 '''
-def platesolve(centroids, image_shape, options={'flag_display':False, 'rough_match_threshhold':36, 'flag_display2':False, 'flag_debug':False}, output_dir=None, try_mirror_also=True):
+def platesolve(centroids, image_shape, options={'flag_display':False, 'rough_match_threshhold':36, 'flag_display2':False, 'flag_debug':False}, output_dir=None, try_mirror_also=True, hint=None, cancel=None):
+    with instrumentation.span('platesolve', items=len(centroids)):
+        if not options.get('platesolve_cache', False):
+            return _platesolve(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel)
+        key = platesolve_cache.fingerprint(centroids, image_shape, options, try_mirror_also, solver=(f, g, TOLERANCE, SCHEDULE),
+                                           hint=hint, databases=database_signature(options, hint, image_shape))
+        result = platesolve_cache.get(key, options) if not options.get('flag_display', False) else None # (displaying the matches needs the search)
+        if result is None:
+            result = _platesolve(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel)
+            if result['success']:
+                platesolve_cache.put(key, result, options)
+        return result
+
+def _platesolve(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel=None):
     centroids = np.array(centroids)
     if not len(centroids.shape)==2 or not centroids.shape[1] == 2:
         raise Exception("ERROR: expected an n by 2 array for centroids")
-    result = _platesolve_helper(centroids, image_shape, options, output_dir=output_dir)
+    deadline = time.time() + options.get('platesolve_time_budget', TIME_BUDGET)
+    if hint is not None:
+        result = _solve(centroids, image_shape, options, output_dir, try_mirror_also, deadline, hint, cancel)
+        if result['success'] or _cancelled(cancel):
+            return result
+        print('hinted platesolve failed ... trying blind search')
+    return _solve(centroids, image_shape, options, output_dir, try_mirror_also, deadline, None, cancel)
+
+def _cancelled(cancel):
+    return cancel is not None and cancel.is_set()
+
+def _solve(centroids, image_shape, options, output_dir, try_mirror_also, deadline, hint, cancel=None):
+    mirror_mode = options.get('platesolve_mirror_mode', 'single_pass')
+    if not mirror_mode in ('single_pass', 'second_pass'):
+        raise Exception("unknown platesolve_mirror_mode: " + str(mirror_mode))
+    single_pass = try_mirror_also and mirror_mode == 'single_pass'
+    result = _solve_progressive(centroids, image_shape, options, output_dir, deadline, mirror_also=single_pass, hint=hint, cancel=cancel)
     # if we are friendly, could mirror (x, y) and try again if failed
-    result['mirror'] = False
-    if result['success'] or not try_mirror_also:
+    if result['success'] or not try_mirror_also or single_pass or _cancelled(cancel):
         return result
     print('platesolve failed ... trying mirror image of field')
     centroids = np.copy(centroids)
     centroids[:, [0, 1]] = centroids[:, [1, 0]]
     image_shape = (image_shape[1], image_shape[0])
-    result = _platesolve_helper(centroids, image_shape, options, output_dir=output_dir)
+    result = _solve_progressive(centroids, image_shape, options, output_dir, deadline, hint=None if hint is None else dict(hint, mirror=not hint.get('mirror', False)), cancel=cancel)
     if result['success']:
         result['mirror'] = True
         result['matched_centroids'][:, [0, 1]] = result['matched_centroids'][:, [1, 0]]
     return result
 
-def _platesolve_helper(centroids, image_size, options, output_dir=None):
+'''
+try the stages of the search from small to large (f, g, tolerance), and return as soon as one finds an accepted solution
+stages which would search exactly the same triangles as the previous one (too few stars) are skipped,
+and no stage is started after the deadline (time.time()), but the first stage always runs
+cancel: (optional threading.Event) once it is set no further stage is started, and the running stage stops at its next
+database tile or candidate (returning a failed result)
+'''
+def _solve_progressive(centroids, image_size, options, output_dir, deadline, mirror_also=False, hint=None, cancel=None):
+    schedule = SCHEDULE if options.get('platesolve_progressive', True) else ((f, g, TOLERANCE),)
+    n_obs = centroids.shape[0]
+    previous = None
+    result = failed_result()
+    for stage in schedule:
+        if _cancelled(cancel):
+            print('platesolve cancelled')
+            break
+        effective = (min(stage[0], n_obs), min(stage[1], n_obs), stage[2])
+        if effective == previous:
+            continue
+        if previous is not None and time.time() > deadline:
+            print(f'platesolve time budget used up, not trying (f, g, tolerance) = {stage}')
+            break
+        previous = effective
+        print(f'platesolve stage (f, g, tolerance) = {stage}')
+        with instrumentation.span('platesolve.stage'):
+            result = _platesolve_helper(centroids, image_size, options, output_dir=output_dir, f=stage[0], g=stage[1], tolerance=stage[2], mirror_also=mirror_also, hint=hint, cancel=cancel)
+        result['stage'] = stage
+        if result['success']:
+            break
+    return result
+
+'''
+one search: match the triangles (of the field, and if mirror_also of its mirror image), then verify the candidates
+of both parities together (see _verify_matches)
+'''
+def _platesolve_helper(centroids, image_size, options, output_dir=None, f=f, g=g, tolerance=TOLERANCE, mirror_also=False, hint=None, cancel=None):
+    parities = match_triangles(centroids, image_size, options, f, g, tolerance, mirror_also, hint, cancel)
+    if _cancelled(cancel):
+        print('platesolve cancelled')
+        return failed_result()
+    return _verify_matches(centroids, image_size, options, output_dir, parities, g, tolerance, hint, cancel)
+
+'''
+candidate attitudes of one parity: cluster its triangle matches, one candidate per cluster of at least 3 agreeing
+(non-redundant) triangles
+centroids, image_size: those of the parity (i.e. with swapped axes for the mirror image)
+returns (list of candidates, number of agreeing pairs of triangle matches)
+'''
+def _candidates(centroids, image_size, options, matches, hint=None, mirror=False):
+    scale, roll, center_vect, match_info, triangle_info, vectors, target_vectors = matches
+    print(f'initial triangle matches{" (mirror image)" if mirror else ""}: {scale.shape[0]}')
+    all_star_plate = centroids - np.array([image_size[0]/2, image_size[1]/2])
+
+    with instrumentation.span('platesolve.clustering', items=scale.shape[0]):
+        vector_plates = np.c_[np.log(scale) / log_TOL_SCALE, roll / TOL_ROLL, center_vect / TOL_CENT]
+        tree_matches = KDTree(vector_plates)
+        candidate_pairs = tree_matches.query_pairs(1, output_type='ndarray') # efficiently find all pairs of agreeing triangles
+        N = vector_plates.shape[0]
+        graph = csr_matrix((np.ones(candidate_pairs.shape[0], dtype=np.int8), (candidate_pairs[:, 0], candidate_pairs[:, 1])), shape=(N, N))
+        n_components, labels = connected_components(csgraph=graph, directed=False, return_labels=True)
+        counts = np.bincount(labels, minlength=n_components)
+        # members of each component, in order of their index
+        members = np.argsort(labels, kind='stable')
+        starts = np.r_[0, np.cumsum(counts)]
+    hypotheses = []
+    for i in np.flatnonzero(counts >= 3):
+        indices = members[starts[i]:starts[i+1]]
+        # remove redundant triangles (a, b, c), (b, a, c) etc.: keep the first of each set of observed stars
+        _, first = np.unique(np.sort(match_info[indices], axis=1), axis=0, return_index=True)
+        non_redundant = list(indices[np.sort(first)])
+        if len(non_redundant) >= 3:
+            matchset = dict()
+            for ind in non_redundant:
+                matchset.update(zip(match_info[ind], target_vectors[ind].T))
+
+            el = non_redundant[0]
+            radec = transforms.to_polar(center_vect[el])
+            print('triangle match:', len(non_redundant), [tuple(match_info[_].tolist()) for _ in non_redundant])
+            #print(counts[i], radec, scale[el], roll[el], match_info[el])
+            #print(matchset)
+            if options['flag_debug']:
+                # show platesolve
+                plt.scatter(vectors[:, 0], vectors[:, 1])
+                for t in non_redundant:
+                    tri = match_info[t]
+                    v = np.array([vectors[_] for _ in tri]+[vectors[tri[0]]])
+                    plt.plot(v[:, 0], v[:, 1], color='red')
+                plt.gca().invert_yaxis()
+                plt.title(f"{len(non_redundant)} triangles matched\nplatescale={np.degrees(scale[el])*3600:.4f} arcsec/pixel\nra={radec[0][1]:.4f}, dec={radec[0][0]:.4f}")
+                plt.show()
+            plate = (np.degrees(scale[el]), radec[0][1], radec[0][0], np.degrees(roll[el])+90) # this plus 90 is very weird and probably is need because of a coordinate bug
+            #print('scale/degrees, ra, dec, roll', plate)
+
+            ivects = transforms.icoord_to_vector(np.array([all_star_plate[_] for _ in matchset])*scale[el])
+            catvects = np.array([_ for _ in matchset.values()])
+            #print(ivects)
+            #print(catvects)
+            rotation_matrix = _find_rotation_matrix(ivects, catvects)
+            acc_ra, acc_dec, acc_roll = attitude_from_rotation(rotation_matrix)
+            if hint is not None and hint.get('roll') is not None and hint.get('mirror', False) == mirror and not _in_range(acc_roll, hint['roll']):
+                print(f'note: candidate match outside the hinted roll range (roll = {acc_roll:.2f})')
+                continue
+
+            #print((rotation_matrix.T @ ivects.T).T)
+            platescale = (np.degrees(scale[el]), acc_ra, acc_dec, acc_roll+180) # do weird +180 roll thing as usual
+            hypotheses.append({'el':el, 'non_redundant':non_redundant, 'platescale':platescale, 'ra':acc_ra, 'dec':acc_dec, 'roll':acc_roll,
+                               'rotation_matrix':rotation_matrix, 'ivects':ivects, 'catvects':catvects,
+                               'platescale/arcsec':3600*np.degrees(scale[el]), 'mirror':mirror, 'vectors':vectors, 'match_info':match_info})
+    return hypotheses, len(candidate_pairs)
+
+'''
+verify the candidate solutions of the field, and (if there are matches of the mirror image in parities) of its mirror image:
+the candidates of both parities are ranked together by their rough number of matched stars (rough_match_counts), so the
+parity is chosen by that score, and the full match_centroids only runs on the top-ranked candidate. If it is rejected,
+the next candidate in rank order is tried, and so on. The acceptance threshold accounts for the number of parities searched
+parities: the matches of match_triangles, [field] or [field, mirror image]
+'''
+def _verify_matches(centroids, image_size, options, output_dir, parities, g, tolerance, hint=None, cancel=None):
     dbs = database_cache.open_catalogue(resource_path("resources/compressed_tycho2024epoch.npz"))
     N_stars_catalog = dbs.star_table.shape[0]
-    t00 = time.perf_counter(), time.process_time()
-    scale, roll, center_vect, match_info, triangle_info, vectors, target_vectors = match_triangles(centroids, image_size, options)
-    print(f'initial triangle matches: {scale.shape[0]}')
     n_obs = centroids.shape[0]
-    all_star_plate = centroids - np.array([image_size[0]/2, image_size[1]/2])
-    t2 = time.perf_counter(), time.process_time()
-
-    vector_plates = np.c_[np.log(scale) / log_TOL_SCALE, roll / TOL_ROLL, center_vect / TOL_CENT] 
-    tree_matches = KDTree(vector_plates)
-    t3 = time.perf_counter(), time.process_time()
-    candidate_pairs = tree_matches.query_pairs(1) # efficiently find all pairs of agreeing triangles
-    N = vector_plates.shape[0]
-    graph = csr_matrix(([1 for _ in candidate_pairs], ([x[0] for x in candidate_pairs], [x[1] for x in candidate_pairs])), shape=(N, N))
-    n_components, labels = connected_components(csgraph=graph, directed=False, return_labels=True)
-    unique, counts = np.unique(labels, return_counts=True)
-    counts = dict(zip(unique, counts))
-    best=-1
-    best_result = {'success':False, 'x':None, 'platescale':None, 'matched_centroids':None, 'matched_stars':None, 'platescale/arcsec':None, 'ra':None, 'dec':None, 'roll':None}
-    n_matches = 0
-    for i in range(n_components):
-        if counts[i] >= 3:
-            indices = np.nonzero(labels==i)[0]
-            # remove redundant triangles (a, b, c), (b, a, c) etc.
-            seen = set()
-            non_redundant = []
-            for ind in indices:
-                if match_info[ind] in seen:
-                    continue
-                seen.update(list(itertools.permutations(match_info[ind])))
-                non_redundant.append(ind)
-            if len(non_redundant) >= 3:
-                matchset = dict()
-                for ind in non_redundant:
-                    matchset.update(zip(match_info[ind], target_vectors[ind].T))
-
-                el = non_redundant[0]
-                radec = transforms.to_polar(center_vect[el])
-                print('triangle match:', len(non_redundant), [match_info[_] for _ in non_redundant])
-                #print(counts[i], radec, scale[el], roll[el], match_info[el])
-                #print(matchset)
-                if options['flag_debug']:
-                    # show platesolve
-                    plt.scatter(vectors[:, 0], vectors[:, 1])
-                    for t in non_redundant:
-                        tri = match_info[t]
-                        v = np.array([vectors[_] for _ in tri]+[vectors[tri[0]]])
-                        plt.plot(v[:, 0], v[:, 1], color='red')
-                    plt.gca().invert_yaxis()
-                    plt.title(f"{len(non_redundant)} triangles matched\nplatescale={np.degrees(scale[el])*3600:.4f} arcsec/pixel\nra={radec[0][1]:.4f}, dec={radec[0][0]:.4f}")
-                    plt.show()
-                plate = (np.degrees(scale[el]), radec[0][1], radec[0][0], np.degrees(roll[el])+90) # this plus 90 is very weird and probably is need because of a coordinate bug
-                #print('scale/degrees, ra, dec, roll', plate)
-                
-                ivects = transforms.icoord_to_vector(np.array([all_star_plate[_] for _ in matchset])*scale[el])
-                catvects = np.array([_ for _ in matchset.values()])
-                #print(ivects)
-                #print(catvects)
-                rotation_matrix = _find_rotation_matrix(ivects, catvects)
-                acc_ra = np.rad2deg(np.arctan2(rotation_matrix[0, 1],
-                                                   rotation_matrix[0, 0])) % 360
-                acc_dec = np.rad2deg(np.arctan2(rotation_matrix[0, 2],
-                                                    np.linalg.norm(rotation_matrix[1:3, 2])))
-                acc_roll = np.rad2deg(np.arctan2(rotation_matrix[1, 2],
-                                                     rotation_matrix[2, 2])) % 360
-                acc_roll = (acc_roll + 180) % 360 # ???
-                
-                #print((rotation_matrix.T @ ivects.T).T)
-                platescale = (np.degrees(scale[el]), acc_ra, acc_dec, acc_roll+180) # do weird +180 roll thing as usual
-                stardata, plate2, max_error = match_centroids(centroids[:MAX_MATCH, :], np.radians(platescale), image_size, options)
-                #print('max_error', max_error)
-                thresh = estimate_acceptance_threshold(min(n_obs, MAX_MATCH), N_stars_catalog, max_error, g, addon=3)
-                
-                if stardata.shape[0] >= thresh:
-                    n_matches += 1
-                    print(f"MATCH ACCEPTED (nstars matched = {stardata.shape[0]}, thresh = {thresh})")
-                    rms = 3600*np.degrees(np.linalg.norm(catvects - (rotation_matrix.T @ ivects.T).T) / catvects.shape[0])
-                    print('accurate ra dec roll', acc_ra, acc_dec, acc_roll, 'rough rms=', rms, 'arcsec')
-                    if stardata.shape[0] > best:
-                        best = stardata.shape[0]
-                        best_non_redundant = non_redundant
-                        best_result = {'success':True, 'x': np.radians(platescale), 'platescale/arcsec':3600*np.degrees(scale[el]), 'ra':acc_ra, 'dec':acc_dec, 'roll':acc_roll, 'matched_centroids':plate2+np.array([image_size[0]/2, image_size[1]/2]), 'matched_stars':stardata}
-                else:
-                    print(f"note: candidate match rejected (nstars matched = {stardata.shape[0]}, thresh = {thresh})")         
-    print(f'npairs = {len(candidate_pairs)}')
-    t4 = time.perf_counter(), time.process_time()
-    print(f" Real star matching: {t4[0] - t2[0]:.2f} seconds")
-    tff = time.perf_counter(), time.process_time()
-    print(f" TOTAL TIME: {tff[0] - t00[0]:.2f} seconds")
+    # the centroids and image size of each parity (axes swapped for the mirror image)
+    views = [(centroids, image_size), (centroids[:, [1, 0]], (image_size[1], image_size[0]))][:len(parities)]
+
+    with instrumentation.span('platesolve.verification') as s_verify:
+        # step 1: candidate attitudes of each parity
+        hypotheses, rough, n_pairs = [], [], 0
+        for mirror, matches, (c, size) in zip((False, True), parities, views):
+            h, n = _candidates(c, size, options, matches, hint, mirror)
+            n_pairs += n
+            if h:
+                star_plate = c[:MAX_MATCH, :] - np.array([size[0]/2, size[1]/2])
+                rough.append(rough_match_counts(star_plate, np.radians([_['platescale'] for _ in h]), options))
+                hypotheses += h
+        s_verify.items = len(hypotheses)
+
+        # step 2: rank all candidates (of both parities) at once by their (rough) number of matched stars
+        best_result = failed_result()
+        n_matches = 0
+        if hypotheses:
+            rough = np.concatenate(rough)
+            ranking = np.argsort(-rough, kind='stable')
+            print('rough number of matched stars per candidate (best first):', rough[ranking].tolist(),
+                  '' if len(parities) == 1 else f'(mirror image: {[hypotheses[k]["mirror"] for k in ranking]})')
+        else:
+            ranking = []
+
+        # step 3: full (reflexive nearest neighbour) match of the top-ranked candidate only, falling back to the next one if it is rejected
+        for k in ranking:
+            if _cancelled(cancel):
+                print('platesolve cancelled')
+                break
+            h = hypotheses[k]
+            c, size = views[int(h['mirror'])]
+            stardata, plate2, max_error = match_centroids(c[:MAX_MATCH, :], np.radians(h['platescale']), size, options)
+            #print('max_error', max_error)
+            thresh = estimate_acceptance_threshold(min(n_obs, MAX_MATCH), N_stars_catalog, max_error, g, addon=3, tolerance=tolerance, parities=len(parities))
+
+            if stardata.shape[0] >= thresh:
+                n_matches = int(np.count_nonzero(rough >= thresh)) # (candidates which would likely also be accepted)
+                print(f"MATCH ACCEPTED (nstars matched = {stardata.shape[0]}, thresh = {thresh}{', mirror image' if h['mirror'] else ''})")
+                catvects, ivects = h['catvects'], h['ivects']
+                rms = 3600*np.degrees(np.linalg.norm(catvects - (h['rotation_matrix'].T @ ivects.T).T) / catvects.shape[0])
+                print('accurate ra dec roll', h['ra'], h['dec'], h['roll'], 'rough rms=', rms, 'arcsec')
+                best = h
+                matched_centroids = plate2 + np.array([size[0]/2, size[1]/2])
+                if h['mirror']:
+                    matched_centroids[:, [0, 1]] = matched_centroids[:, [1, 0]]
+                best_result = {'success':True, 'x': np.radians(h['platescale']), 'platescale/arcsec':h['platescale/arcsec'], 'ra':h['ra'], 'dec':h['dec'], 'roll':h['roll'], 'matched_centroids':matched_centroids, 'matched_stars':stardata, 'mirror':h['mirror']}
+                break
+            else:
+                print(f"note: candidate match rejected (nstars matched = {stardata.shape[0]}, thresh = {thresh})")
+    print(f'npairs = {n_pairs}')
     if n_matches > 1:
-        print(f"WARNING: multiple ({n_matches}) platesolves were successful, returning best one")
+        print(f"WARNING: multiple ({n_matches}) candidate platesolves have enough roughly matched stars, returning the best ranked one")
     elif n_matches == 0:
         print("Platesolve FAILED")
     elif n_matches == 1:
         print("Platescale SUCCESS")
     if (options['flag_display'] or not output_dir is None) and n_matches >= 1:
         # show platesolve
-        plt.scatter(vectors[:, 0]+image_size[1], vectors[:, 1]+image_size[0])
-        for t in best_non_redundant:
+        vectors, match_info = best['vectors'], best['match_info']
+        size = views[int(best['mirror'])][1]
+        plt.scatter(vectors[:, 0]+size[1], vectors[:, 1]+size[0])
+        for t in best['non_redundant']:
             tri = match_info[t]
             v = np.array([vectors[_] for _ in tri]+[vectors[tri[0]]])
-            plt.plot(v[:, 0]+image_size[1], v[:, 1]+image_size[0], color='red')
+            plt.plot(v[:, 0]+size[1], v[:, 1]+size[0], color='red')
         plt.gca().invert_yaxis()
         plt.gca().set_aspect('equal')
-        plt.title(f"{len(best_non_redundant)} triangles matched\nplatescale={best_result['platescale/arcsec']:.4f} arcsec/pixel\nra={best_result['ra']:.4f}, dec={best_result['dec']:.4f}, roll={best_result['roll']:.4f}")
+        plt.title(f"{len(best['non_redundant'])} triangles matched\nplatescale={best_result['platescale/arcsec']:.4f} arcsec/pixel\nra={best_result['ra']:.4f}, dec={best_result['dec']:.4f}, roll={best_result['roll']:.4f}")
         plt.tight_layout()
         if not output_dir is None:
             plt.savefig(output_dir / 'triangle_matches.png', dpi=600)
@@ -0,0 +1,164 @@
+'''
+opt-in profiling of named pipeline stages
+
+any instrumentation span (e.g. 'stack.centroiding', 'platesolve', 'platesolve.triangle_query',
+'distortion', 'eclipse') can be profiled without editing code, by listing it in
+options['profile_stages'] or in the MEE2024_PROFILE environment variable, e.g.
+
+    MEE2024_PROFILE="platesolve.triangle_query,stack.*"
+
+('all' or '*' profiles every stage). While a selected stage runs it is profiled with
+cProfile and also sampled by a background thread. For each stage this writes
+    PROFILE_<stage>.pstats     (open with pstats / snakeviz)
+    PROFILE_<stage>.collapsed  (collapsed stacks, for flamegraph.pl / speedscope)
+into the run's output directory, and logs the top functions to the run log.
+Repeated calls of a stage (e.g. once per frame) are accumulated into one profile
+'''
+
+import os
+import io
+import sys
+import atexit
+import cProfile
+import pstats
+import fnmatch
+import threading
+from collections import Counter
+from contextlib import contextmanager
+import instrumentation
+
+ENV_VAR = 'MEE2024_PROFILE'
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+N_TOP = 15 # number of functions listed in the log summary
+
+class _state:
+
+    patterns = [] # fnmatch patterns of stage names to profile
+
+    output_dir = '.'
+
+    logger = None
+
+    profiles = {} # stage name -> _StageProfile
+
+    local = threading.local() # (per thread) is a profiled stage already active?
+
+class _StageProfile:
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.has_profile = False # False if cProfile could not be enabled (e.g. another profiler was active)
+        self.stacks = Counter() # collapsed stack -> number of samples
+        self.calls = 0
+
+'''
+samples the call stack of one thread at regular intervals
+'''
+class _Sampler(threading.Thread):
+
+    def __init__(self, thread_id, stacks, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = stacks
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}')
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def _parse(stages):
+    if not stages:
+        return []
+    if not isinstance(stages, str):
+        stages = ','.join(stages)
+    patterns = [x.strip() for x in stages.replace(';', ',').split(',') if x.strip()]
+    return ['*' if x.lower() == 'all' else x for x in patterns]
+
+def is_profiled(name):
+    return any(fnmatch.fnmatchcase(name, p) for p in _state.patterns)
+
+@contextmanager
+def _profile_hook(span):
+    if not is_profiled(span.name) or getattr(_state.local, 'active', False): # nested stages are included in the outer profile
+        yield
+        return
+    if not span.name in _state.profiles:
+        _state.profiles[span.name] = _StageProfile(span.name)
+    prof = _state.profiles[span.name]
+    _state.local.active = True
+    sampler = _Sampler(threading.get_ident(), prof.stacks)
+    sampler.start()
+    try:
+        enabled = True
+        try:
+            prof.profile.enable()
+            prof.has_profile = True
+        except ValueError: # another profiler is already active
+            enabled = False
+        try:
+            yield
+        finally:
+            if enabled:
+                prof.profile.disable()
+    finally:
+        sampler.stop()
+        prof.calls += 1
+        _state.local.active = False
+
+'''
+select the stages to profile for a run (from options['profile_stages'] and the MEE2024_PROFILE environment variable)
+output_dir: where the profiles are written; logger: run log for the summaries
+any profiles of a previous run are written out first
+'''
+def configure(options, output_dir, logger=None):
+    finish()
+    _state.patterns = _parse(options.get('profile_stages', '')) + _parse(os.environ.get(ENV_VAR, ''))
+    _state.output_dir = str(output_dir)
+    _state.logger = logger
+    if _state.patterns:
+        print('profiling stages:', _state.patterns)
+        instrumentation.add_hook(_profile_hook)
+    else:
+        instrumentation.remove_hook(_profile_hook)
+
+'''
+write out the collected profiles (.pstats and .collapsed) and log the top functions of each stage
+'''
+def finish():
+    for name, prof in _state.profiles.items():
+        base = os.path.join(_state.output_dir, 'PROFILE_' + name.replace('/', '_'))
+        text = f'profile of stage {name} ({prof.calls} calls, {sum(prof.stacks.values())} samples)\n'
+        if prof.has_profile:
+            prof.profile.dump_stats(base + '.pstats')
+            stream = io.StringIO()
+            pstats.Stats(prof.profile, stream=stream).sort_stats('cumulative').print_stats(N_TOP)
+            text += stream.getvalue()
+        with open(base + '.collapsed', 'w', encoding="utf-8") as fp:
+            for stack, count in prof.stacks.most_common():
+                fp.write(f'{stack} {count}\n')
+        print(text)
+        if _state.logger is not None:
+            _state.logger.info(text)
+    _state.profiles = {}
+
+'''
+set up profiling for a whole script (MEE2024Stacker, the benchmarks): the stages selected in options or the
+MEE2024_PROFILE environment variable are profiled into output_dir (unless a stage configures its own run),
+and the profiles are written out when the script exits
+'''
+def configure_script(options={}, output_dir='.'):
+    configure(options, output_dir)
+    atexit.register(finish)
@@ -33,10 +33,14 @@ import os
 import shutil
 import json
 import logging
-import platesolve_triangle
+import platesolve_hint
+import platesolve_server
 import multiprocessing
 import cProfile
 import warnings
+import pipeline_results
+import instrumentation
+import profiling
 
 # return fit file image as np array
 def open_image(file):
@@ -173,7 +177,9 @@ and that you have chosen appropriate centroid detection threshholds")
     print(vec1.shape)
     return result.x, matches1, matches2, result2.x, (result2.fun/vec1.shape[0])**0.5
 
-def do_loop_with_progress_bar(items, fxn, message='Progress', **kwargs):
+def do_loop_with_progress_bar(items, fxn, message='Progress', show=True, **kwargs):
+    if not show: # headless (e.g. benchmarks)
+        return [fxn(item, **kwargs) for item in items]
     layout = [[sg.Text(message)], [sg.ProgressBar(max_value=len(items), orientation='h', size=(20, 20), key='progress')]]
     window = sg.Window('Progress Meter', layout, finalize=True)
     progress_bar = window['progress']
@@ -285,56 +291,58 @@ def filter_edgy_centroids(centroids_data, img, f=3, d=16, thresh=2, edge_thresho
     
 
 def get_centroids_blur(img_mask2, ksize=17, r_max=10, options={}, gauss=False, debug_display=False):
-    t_start = time.time()
     img, mask, mask2 = img_mask2
     if not options['centroid_gaussian_subtract']:
-        centroids = tetra3.get_centroids_from_image(img)
+        with instrumentation.span('centroids.tetra3') as s:
+            centroids = tetra3.get_centroids_from_image(img)
+            s.items = len(centroids)
         return [(-1, -1, x) for x in centroids] # return tetra centroids
-    if options['background_subtraction_mode'] =='Gaussian':
-        blur = cv2.GaussianBlur(img, (ksize, ksize), 0)
-    else:
-        inner = 3
-        blur = (cv2.blur(img, (ksize, ksize)) - cv2.blur(img, (inner, inner)) * (inner**2/ksize**2)) * (ksize**2 / (ksize**2-inner**2))
-    sub = img-blur
-    sub[mask2] = 0
-
-    squared = sub*sub
-    large = np.percentile(squared, 95)
-    squared[mask2] = large
-    squared[squared > large*10] = large*10
-    local_variance = scipy.ndimage.filters.uniform_filter(squared, size=(50, 50))
-
-    #plt.imshow(local_variance)
-    #plt.show()
-
-    data = np.maximum(sub / np.sqrt(local_variance) - options['sigma_subtract'], 0)
-
-    passed = data > options['centroid_gaussian_thresh']
-    passed[expand_mask(mask2, 8)] = 0 # TODO: reflect on this quick fix to edge problems
-    #plt.imshow(data, cmap='gray_r', vmin=4, vmax=5)
-    #plt.show()
-    print("--- %s seconds for centroid finding (prepare)---" % (time.time() - t_start))
-    centroid_labels = measure.label(passed, connectivity=1)
-    centroid_labels_exp = expand_labels(centroid_labels) # expand by one more ring of pixels
-    properties = measure.regionprops(centroid_labels, data)
-    with warnings.catch_warnings():
-        warnings.filterwarnings(action='ignore', message='Mean of empty slice') # RuntimeWarning: invalid value encountered in scalar divide
-        warnings.filterwarnings(action='ignore', message='invalid value encountered in scalar divide')
-        properties_exp = measure.regionprops(centroid_labels_exp, data)
-
-    print("--- %s seconds for centroid finding (labelling)---" % (time.time() - t_start))
+    with instrumentation.span('centroids.prepare'):
+        if options['background_subtraction_mode'] =='Gaussian':
+            blur = cv2.GaussianBlur(img, (ksize, ksize), 0)
+        else:
+            inner = 3
+            blur = (cv2.blur(img, (ksize, ksize)) - cv2.blur(img, (inner, inner)) * (inner**2/ksize**2)) * (ksize**2 / (ksize**2-inner**2))
+        sub = img-blur
+        sub[mask2] = 0
+
+        squared = sub*sub
+        large = np.percentile(squared, 95)
+        squared[mask2] = large
+        squared[squared > large*10] = large*10
+        local_variance = scipy.ndimage.filters.uniform_filter(squared, size=(50, 50))
+
+        #plt.imshow(local_variance)
+        #plt.show()
+
+        data = np.maximum(sub / np.sqrt(local_variance) - options['sigma_subtract'], 0)
+
+        passed = data > options['centroid_gaussian_thresh']
+        passed[expand_mask(mask2, 8)] = 0 # TODO: reflect on this quick fix to edge problems
+        #plt.imshow(data, cmap='gray_r', vmin=4, vmax=5)
+        #plt.show()
+    with instrumentation.span('centroids.labelling') as s:
+        centroid_labels = measure.label(passed, connectivity=1)
+        centroid_labels_exp = expand_labels(centroid_labels) # expand by one more ring of pixels
+        properties = measure.regionprops(centroid_labels, data)
+        with warnings.catch_warnings():
+            warnings.filterwarnings(action='ignore', message='Mean of empty slice') # RuntimeWarning: invalid value encountered in scalar divide
+            warnings.filterwarnings(action='ignore', message='invalid value encountered in scalar divide')
+            properties_exp = measure.regionprops(centroid_labels_exp, data)
+        s.items = len(properties)
 
     
-    areas = [region.area for region in properties]
-    centroids = [region.centroid_weighted for region in properties_exp]
-    fluxes = []
-    for i in range(len(centroids)):
-        if np.isnan(centroids[i][0]):
-            fluxes.append(None)
-            continue
-        around_data = data[int(centroids[i][0])-r_max:int(centroids[i][0])+r_max+1, int(centroids[i][1])-r_max:int(centroids[i][1])+r_max+1]
-        around_labels = centroid_labels_exp[int(centroids[i][0])-r_max:int(centroids[i][0])+r_max+1, int(centroids[i][1])-r_max:int(centroids[i][1])+r_max+1]
-        fluxes.append(np.sum(around_data[around_labels==i+1]))
+    with instrumentation.span('centroids.measure'):
+        areas = [region.area for region in properties]
+        centroids = [region.centroid_weighted for region in properties_exp]
+        fluxes = []
+        for i in range(len(centroids)):
+            if np.isnan(centroids[i][0]):
+                fluxes.append(None)
+                continue
+            around_data = data[int(centroids[i][0])-r_max:int(centroids[i][0])+r_max+1, int(centroids[i][1])-r_max:int(centroids[i][1])+r_max+1]
+            around_labels = centroid_labels_exp[int(centroids[i][0])-r_max:int(centroids[i][0])+r_max+1, int(centroids[i][1])-r_max:int(centroids[i][1])+r_max+1]
+            fluxes.append(np.sum(around_data[around_labels==i+1]))
 
 
     if debug_display:
@@ -391,13 +399,12 @@ def get_centroids_blur(img_mask2, ksize=17, r_max=10, options={}, gauss=False, d
                 return False
         return True
     if options['sanity_check_centroids']:
-        with warnings.catch_warnings():
+        with warnings.catch_warnings(), instrumentation.span('centroids.sanity_check', items=len(sorted_c)):
             warnings.filterwarnings(action='ignore', message='Mean of empty slice') # RuntimeWarning: invalid value encountered in scalar divide
             warnings.filterwarnings(action='ignore', message='invalid value encountered in scalar divide')
             sorted_c = [cc for cc in sorted_c if sanity_check(cc[2])]
             print(f"n centroids sanity-filtered {len(sorted_c)}")
     #sorted_c = [(f, c) for f,c in zip(fluxes, centroids)], reverse=True)
-    print("--- %s seconds for centroid finding (all)---" % (time.time() - t_start))
     print('found:', sorted_c)
     return sorted_c
     
@@ -452,23 +459,34 @@ def add_img_to_stack(data, output_array=None, count_array=None):
     count_array += roll_fillzero(a1, shift)
 
 def open_img_and_preprocess(file, options = {}, dark=0, flat=1):
-    img = open_image(file)
-    desatblob_img, mask, mask2 = remove_saturated_blob(img, sat_val=None, radius = options['blob_radius_extra'], radius2 = options['blob_radius_extra']+options['centroid_gap_blob'], blob_saturation=options['blob_saturation_level']/100, perform=options['delete_saturated_blob'])
-    reg_img = (desatblob_img - dark) / flat
+    frame = os.path.basename(str(file))
+    with instrumentation.span('stack.io', frame=frame):
+        img = open_image(file)
+    with instrumentation.span('stack.blob_removal', frame=frame):
+        desatblob_img, mask, mask2 = remove_saturated_blob(img, sat_val=None, radius = options['blob_radius_extra'], radius2 = options['blob_radius_extra']+options['centroid_gap_blob'], blob_saturation=options['blob_saturation_level']/100, perform=options['delete_saturated_blob'])
+        reg_img = (desatblob_img - dark) / flat
     return reg_img, mask, mask2
 
 def open_img_and_find_centroids(file, options = {}, dark=0, flat=1):
     reg_img, mask, mask2 = open_img_and_preprocess(file, options, dark, flat)
-    centroids = get_centroids_blur((reg_img, mask, mask2), options=options)
-    centroids_filtered = filter_bad_centroids(centroids, mask2, reg_img.shape)
+    with instrumentation.span('stack.centroiding', frame=os.path.basename(str(file))) as s:
+        centroids = get_centroids_blur((reg_img, mask, mask2), options=options)
+        centroids_filtered = filter_bad_centroids(centroids, mask2, reg_img.shape)
+        s.items = len(centroids_filtered)
     return centroids_filtered
 
 def open_img_and_add_to_stack(data, output_array=None, count_array=None, options = {}, dark=0, flat=1):
     file, shift = data # unpack tuple
     reg_img, _, _ = open_img_and_preprocess(file, options, dark, flat)
-    add_img_to_stack((reg_img, shift), output_array, count_array)
+    with instrumentation.span('stack.accumulation', frame=os.path.basename(str(file))):
+        add_img_to_stack((reg_img, shift), output_array, count_array)
     
-def do_stack(files, darkfiles, flatfiles, options):
+'''
+stack the light frames, find centroids on the stacked image and platesolve it
+returns a pipeline_results.StackResult, which can be handed directly to distortion_fitter.fit_distortion
+archive: also write the centroid_data*.zip archive (needed for running the later stages from disk)
+'''
+def do_stack(files, darkfiles, flatfiles, options, archive=True):
     starttime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
     output_name = f'CENTROID_OUTPUT{starttime}'
     output_dir = Path(output_path(output_name, options))
@@ -478,6 +496,14 @@ def do_stack(files, darkfiles, flatfiles, options):
     os.mkdir(data_dir)
     print(f'logpath {logpath}')
     logger = setup_logger('logger'+starttime, logpath)
+    recorder = instrumentation.start_run('stack'+starttime)
+    profiling.configure(options, output_dir, logger)
+    try:
+        return _do_stack(files, darkfiles, flatfiles, options, archive, starttime, output_dir, data_dir, logger, recorder)
+    finally:
+        profiling.finish()
+
+def _do_stack(files, darkfiles, flatfiles, options, archive, starttime, output_dir, data_dir, logger, recorder):
     logger.info('start time: ' + str(datetime.datetime.now()) + '\n')
     logger.info('using version:'+_version())
     logger.info('using options:'+str(options))
@@ -505,10 +531,9 @@ def do_stack(files, darkfiles, flatfiles, options):
             fits.writeto(output_dir / ('DARK_STACK'+starttime+'.fit'), dark.astype(np.float32))
         if flatfiles:
             fits.writeto(output_dir / ('FLAT_STACK'+starttime+'.fit'), flat.astype(np.float32))
-    t_start_c = time.time()
     #cProfile.runctx("do_loop_with_progress_bar(files, open_img_and_find_centroids, message='Finding all centroids...', dark = dark, flat=flat, options=options)", globals(), locals(), sort='cumtime')
-    centroids_data = do_loop_with_progress_bar(files, open_img_and_find_centroids, message='Finding all centroids...', dark = dark, flat=flat, options=options)
-    print("--- %s seconds for centroid finding---" % (time.time() - t_start_c))
+    with instrumentation.span('stack.find_all_centroids', items=len(files)):
+        centroids_data = do_loop_with_progress_bar(files, open_img_and_find_centroids, message='Finding all centroids...', show=options.get('show_progress', True), dark = dark, flat=flat, options=options)
     centroids = [np.array([x[2] for x in y]) for y in centroids_data]
     
     # simple stacking: use the first image as the "key" and fit all others to it
@@ -518,7 +543,9 @@ def do_stack(files, darkfiles, flatfiles, options):
     prev = (0, 0)
     used_stars_stacking = Counter()
     for i in range(1, len(files)):
-        shift, matches1, matches2, shift2, fun2 = attempt_align(centroids[0], centroids[i], options, guess=prev, framenum=i)
+        with instrumentation.span('stack.alignment', frame=os.path.basename(str(files[i]))) as s:
+            shift, matches1, matches2, shift2, fun2 = attempt_align(centroids[0], centroids[i], options, guess=prev, framenum=i)
+            s.items = len(matches1)
         print(shift, shift2, fun2)
         shifts.append(shift2)
         if shift2 is None:
@@ -593,23 +620,27 @@ def do_stack(files, darkfiles, flatfiles, options):
     stack_array = np.zeros(imgs_0.shape)
     count_array = np.zeros(imgs_0.shape, dtype=int)
     #do_loop_with_progress_bar(list(zip(reg_imgs, shifts)), add_img_to_stack, message='Stacking images...', output_array=stack_array, count_array=count_array)
-    do_loop_with_progress_bar(list(zip(files, shifts)), open_img_and_add_to_stack, message='Stacking images...',
-                              output_array=stack_array, count_array=count_array, options = options, dark=dark, flat=flat)
+    with instrumentation.span('stack.stacking', items=len(files)):
+        do_loop_with_progress_bar(list(zip(files, shifts)), open_img_and_add_to_stack, message='Stacking images...', show=options.get('show_progress', True),
+                                  output_array=stack_array, count_array=count_array, options = options, dark=dark, flat=flat)
     stacked = stack_array / count_array
     
-    # rescale stacked to 16 bit integers
-    stacked16 = ((stacked-np.min(stacked)) / (np.max(stacked) - np.min(stacked)) * 65535).astype(np.uint16)
-    fits.writeto(output_dir / ('STACKED'+starttime+'.fit'), stacked16)
-    if options['float_fits']:
-        fits.writeto(output_dir / ('STACKED_FLOAT'+starttime+'.fit'), stacked.astype(np.float32))
+    with instrumentation.span('stack.output'):
+        # rescale stacked to 16 bit integers
+        stacked16 = ((stacked-np.min(stacked)) / (np.max(stacked) - np.min(stacked)) * 65535).astype(np.uint16)
+        fits.writeto(output_dir / ('STACKED'+starttime+'.fit'), stacked16)
+        if options['float_fits']:
+            fits.writeto(output_dir / ('STACKED_FLOAT'+starttime+'.fit'), stacked.astype(np.float32))
     # find centroids on the stacked image
-    centroids_stacked_data = get_centroids_blur((stacked, masks_0, masks2_0),
-                        options=dict(options, **{'centroid_gaussian_subtract':options['centroid_gaussian_subtract'] or options['sensitive_mode_stack']}), # use sensitive mode if requested only for the stack
-                        debug_display=False)
-    centroids_stacked_data = filter_bad_centroids(centroids_stacked_data, masks2_0, imgs_0.shape) # use 0th mask here
-    centroids_stacked_data = filter_very_edgy_centroids(centroids_stacked_data, stacked, f=options['img_edge_distance'])
-    if options['remove_edgy_centroids']:
-        centroids_stacked_data = filter_edgy_centroids(centroids_stacked_data, stacked)
+    with instrumentation.span('stack.centroiding_stacked') as s:
+        centroids_stacked_data = get_centroids_blur((stacked, masks_0, masks2_0),
+                            options=dict(options, **{'centroid_gaussian_subtract':options['centroid_gaussian_subtract'] or options['sensitive_mode_stack']}), # use sensitive mode if requested only for the stack
+                            debug_display=False)
+        centroids_stacked_data = filter_bad_centroids(centroids_stacked_data, masks2_0, imgs_0.shape) # use 0th mask here
+        centroids_stacked_data = filter_very_edgy_centroids(centroids_stacked_data, stacked, f=options['img_edge_distance'])
+        if options['remove_edgy_centroids']:
+            centroids_stacked_data = filter_edgy_centroids(centroids_stacked_data, stacked)
+        s.items = len(centroids_stacked_data)
     centroids_stacked = np.array([x[2] for x in centroids_stacked_data])
 
     df_detection = pd.DataFrame({'px': np.array(centroids_stacked)[:, 1],
@@ -624,12 +655,13 @@ def do_stack(files, darkfiles, flatfiles, options):
     df_identification = None
     solution = {'ra':None, 'dec':None, 'roll':None, 'FOV':None, 'platescale/arcsec':None}
     #if options['database'] and options['do_tetra_platesolve']:
-    if 1:
+    if options.get('do_platesolve', True):
         #t3 = database_cache.open_database(options['database'])
         #t3 = tetra3.Tetra3(load_database=options['database']) #tyc_dbase_test3 #hip_database938
         #solution = t3.solve_from_centroids(centroids_stacked, size=stacked.shape, pattern_checking_stars=options['k'], return_matches=True)
         #solution = t3.solve_from_centroids(centroids_stacked, size=stacked.shape, pattern_checking_stars=options['k'], return_matches=True, fov_estimate=5, fov_max_error=1, distortion = (-0.0020, -0.0005))
-        solution = platesolve_triangle.platesolve(centroids_stacked, stacked.shape, options = options, output_dir = output_dir)
+        hint = platesolve_hint.find_hint(options, files=files)
+        solution = platesolve_server.platesolve(centroids_stacked, stacked.shape, options = options, output_dir = output_dir, hint = hint)
         print(solution)
         logger.info(str(solution))
         # TODO identify stars using catalogue
@@ -682,6 +714,7 @@ def do_stack(files, darkfiles, flatfiles, options):
                          'DEC' : solution['dec'],
                          'roll' : solution['roll'],
                          'platescale/arcsec' : solution['platescale/arcsec'],#solution['FOV'] / max(imgs_0.shape) if flag_found_IDs else None,
+                         'mirror' : solution.get('mirror', False),
                          '#frames stacked':len(files),
                          'source_files' : str(files),
                          'starttime':starttime,
@@ -695,16 +728,24 @@ def do_stack(files, darkfiles, flatfiles, options):
                     }
     if options['centroid_gaussian_subtract'] or options['sensitive_mode_stack']:
         results_dict.update({'sigma threshold detection':options['centroid_gaussian_thresh'], 'min_area':options['min_area'], 'sigma_subtract':options['sigma_subtract']})
+    results_dict['timing'] = recorder.summary()
+    recorder.log_summary(logger)
+    recorder.write_jsonl(output_dir / f'TIMING{starttime}.jsonl')
     with open(data_dir / 'results.txt', 'w', encoding="utf-8") as fp:
             json.dump(results_dict, fp, sort_keys=False, indent=4)
     
-    print('making archive', output_dir, Path(output_dir).parent)                                           
-    shutil.make_archive(data_dir,
-                    'zip',
-                    Path(data_dir))
-                    #'data')
-    zipfilepath = Path(data_dir).parent / 'data.zip'
-    shutil.move(zipfilepath, Path(output_dir).parent / f'centroid_data{starttime}.zip')
+    archive_path = None
+    if archive:
+        print('making archive', output_dir, Path(output_dir).parent)                                           
+        shutil.make_archive(data_dir,
+                        'zip',
+                        Path(data_dir))
+                        #'data')
+        zipfilepath = Path(data_dir).parent / 'data.zip'
+        archive_path = Path(output_dir).parent / f'centroid_data{starttime}.zip'
+        shutil.move(zipfilepath, archive_path)
     
     logger.info('end time: ' + str(datetime.datetime.now()) + '\n')
     print('Done!')
+    return pipeline_results.StackResult(df_detection, results_dict, solution=pipeline_results.PlateSolution(solution) if 'success' in solution else None,
+                                        stacked=stacked, output_dir=output_dir, archive_path=archive_path)
@@ -0,0 +1,216 @@
+'''
+synthetic star fields, for benchmarking and checking the stacking / centroiding code
+
+a sequence of frames shows the same random star field, drifting by config['drift']
+pixels per frame (plus random jitter), optionally with a saturated Moon/Sun blob
+with a corona, a background gradient, hot pixels and Poisson + read noise.
+The true star positions are returned (and written to truth.json by write_sequence),
+so measured centroids and alignment shifts can be compared against them.
+
+pixel convention: the centre of pixel [i, j] is at (y, x) = (i, j)
+'''
+
+import os
+import json
+import numpy as np
+from scipy.special import erf
+from astropy.io import fits
+import transforms
+
+# default values for all settings, override any of them with the config dict
+defaults = {
+    'shape':(1000, 1500), # (height, width) in pixels
+    'n_frames':10,
+    'star_density':150, # stars per megapixel (brighter than mag_range[1])
+    'mag_range':(5, 12), # magnitude of brightest / faintest stars
+    'flux_brightest':3e5, # total flux in ADU of a star of magnitude mag_range[0]
+    'psf':'gaussian', # gaussian or moffat
+    'psf_sigma':1.5, # pixels (for moffat: sigma of the gaussian of the same FWHM)
+    'moffat_beta':3,
+    'background':1000, # ADU
+    'gradient':0, # relative increase of the background from left to right edge
+    'gain':1, # electrons per ADU (for Poisson noise), 0 to disable
+    'read_noise':10, # ADU rms
+    'hot_pixels':0, # number of hot pixels (at fixed sensor positions)
+    'drift':(0.7, 1.3), # (dy, dx) pixels per frame
+    'jitter':0.3, # pixels rms per frame
+    'blob_radius':0, # radius in pixels of saturated Moon/Sun, 0 for none
+    'blob_centre':None, # (y, x), None for the image centre
+    'blob_corona':5000, # ADU just outside the blob limb, falls off as r^-3
+    'saturation':65535,
+    'seed':0,
+}
+
+def make_config(config=None, **kwargs):
+    out = dict(defaults)
+    out.update(config or {})
+    out.update(kwargs)
+    return out
+
+'''
+random star field in the coordinates of frame 0
+stars are also placed outside the frame by the total drift, so that they can drift into view
+returns y, x, mag (arrays, sorted brightest first)
+'''
+def make_stars(config, rng):
+    h, w = config['shape']
+    total = np.abs(np.array(config['drift'])) * config['n_frames'] + 4 * config['jitter']
+    y0, y1 = -total[0], h + total[0]
+    x0, x1 = -total[1], w + total[1]
+    n = rng.poisson(config['star_density'] * (y1-y0) * (x1-x0) / 1e6)
+    # star counts grow roughly as 10^(0.35 m): sample magnitudes from that distribution
+    m0, m1 = config['mag_range']
+    u = rng.uniform(0, 1, n)
+    mag = np.log10(10**(0.35*m0) + u * (10**(0.35*m1) - 10**(0.35*m0))) / 0.35
+    mag = np.sort(mag)
+    return rng.uniform(y0, y1, n), rng.uniform(x0, x1, n), mag
+
+def mag_to_flux(mag, config):
+    return config['flux_brightest'] * 10**(-0.4 * (mag - config['mag_range'][0]))
+
+'''
+pixel-integrated psf stamps of all stars, shape (n, k, k), and the pixel index of their top-left corner
+'''
+def _psf_stamps(y, x, flux, config):
+    sigma = config['psf_sigma']
+    half = int(np.ceil(5 * sigma)) if config['psf'] == 'gaussian' else int(np.ceil(10 * sigma))
+    k = 2*half + 1
+    iy = np.round(y).astype(int) - half
+    ix = np.round(x).astype(int) - half
+    offsets = np.arange(k)
+    if config['psf'] == 'gaussian':
+        # integrate the gaussian exactly over each pixel (separable)
+        def edges(c, i0):
+            lo = (i0[:, None] + offsets[None, :] - 0.5 - c[:, None]) / (sigma * 2**0.5)
+            return 0.5 * (erf(lo + 1 / (sigma * 2**0.5)) - erf(lo))
+        stamps = edges(y, iy)[:, :, None] * edges(x, ix)[:, None, :]
+    elif config['psf'] == 'moffat':
+        beta = config['moffat_beta']
+        alpha = sigma * 2.3548 / (2 * np.sqrt(2**(1/beta) - 1)) # same FWHM as the gaussian
+        dy = iy[:, None] + offsets[None, :] - y[:, None]
+        dx = ix[:, None] + offsets[None, :] - x[:, None]
+        r2 = dy[:, :, None]**2 + dx[:, None, :]**2
+        stamps = (1 + r2 / alpha**2) ** -beta
+        stamps /= np.sum(stamps, axis=(1, 2))[:, None, None]
+    else:
+        raise Exception("unknown psf: " + str(config['psf']))
+    return stamps * flux[:, None, None], iy, ix
+
+'''
+add the stars to img (in place), stars off the image are clipped
+'''
+def add_stars(img, y, x, flux, config):
+    stamps, iy, ix = _psf_stamps(y, x, flux, config)
+    k = stamps.shape[1]
+    yy = (iy[:, None] + np.arange(k)[None, :])[:, :, None] + np.zeros((1, 1, k), dtype=int)
+    xx = (ix[:, None] + np.arange(k)[None, :])[:, None, :] + np.zeros((1, k, 1), dtype=int)
+    ok = (yy >= 0) & (yy < img.shape[0]) & (xx >= 0) & (xx < img.shape[1])
+    np.add.at(img, (yy[ok], xx[ok]), stamps[ok])
+    return img
+
+def add_blob(img, config):
+    if not config['blob_radius']:
+        return img
+    h, w = img.shape
+    cy, cx = config['blob_centre'] if config['blob_centre'] is not None else (h/2, w/2)
+    r = np.hypot(*np.meshgrid(np.arange(h) - cy, np.arange(w) - cx, indexing='ij'))
+    R = config['blob_radius']
+    img += np.where(r < R, config['saturation'], config['blob_corona'] * (R / np.maximum(r, R))**3)
+    return img
+
+def background(config):
+    h, w = config['shape']
+    return config['background'] * (1 + config['gradient'] * np.linspace(0, 1, w))[None, :] * np.ones((h, 1))
+
+'''
+render one frame: stars at (y, x) (in this frame's pixel coordinates) with the given magnitudes
+hot: (ys, xs) of hot pixels, or None
+returns uint16 image
+'''
+def render_frame(y, x, mag, config, rng, hot=None):
+    img = background(config)
+    add_stars(img, y, x, mag_to_flux(mag, config), config)
+    add_blob(img, config)
+    if config['gain']:
+        img = rng.poisson(np.clip(img, 0, None) * config['gain']) / config['gain']
+    img = img + rng.normal(0, config['read_noise'], img.shape)
+    if hot is not None:
+        img[hot] = config['saturation']
+    return np.clip(np.round(img), 0, config['saturation']).astype(np.uint16)
+
+'''
+generate the frames of a synthetic sequence
+yields (image, truth) with truth = {'offset': (dy, dx) of this frame relative to frame 0,
+                                    'y', 'x', 'mag': star positions in this frame (all stars, also those off the image)}
+'''
+def render_sequence(config=None, **kwargs):
+    config = make_config(config, **kwargs)
+    rng = np.random.default_rng(config['seed'])
+    y, x, mag = make_stars(config, rng)
+    h, w = config['shape']
+    hot = (rng.integers(0, h, config['hot_pixels']), rng.integers(0, w, config['hot_pixels'])) if config['hot_pixels'] else None
+    for i in range(config['n_frames']):
+        offset = np.array(config['drift']) * i + (rng.normal(0, config['jitter'], 2) if i else 0)
+        fy, fx = y + offset[0], x + offset[1]
+        yield render_frame(fy, fx, mag, config, rng, hot=hot), {'offset':tuple(float(o) for o in offset), 'y':fy, 'x':fx, 'mag':mag}
+
+'''
+write a synthetic sequence as FITS files into directory, plus truth.json with the config,
+the frame offsets and the star list of frame 0
+returns the list of FITS file paths
+'''
+def write_sequence(directory, config=None, **kwargs):
+    config = make_config(config, **kwargs)
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    truth = {'config':config, 'offsets':[], 'stars':None}
+    for i, (img, t) in enumerate(render_sequence(config)):
+        path = os.path.join(directory, f'SYNTH_{i:04d}.fit')
+        header = fits.Header()
+        header['SYNTHETC'] = (True, 'synthetic star field (synthetic_data.py)')
+        header['FRAME'] = i
+        fits.writeto(path, img, header, overwrite=True)
+        files.append(path)
+        truth['offsets'].append(t['offset'])
+        if i == 0:
+            truth['stars'] = {'y':t['y'].tolist(), 'x':t['x'].tolist(), 'mag':t['mag'].tolist()}
+    with open(os.path.join(directory, 'truth.json'), 'w', encoding="utf-8") as fp:
+        json.dump(truth, fp, default=list)
+    return files
+
+'''
+synthetic centroid list for a given pointing, as seen by the platesolver
+
+star_table: catalogue star table (ra, dec, x, y, z, mag) e.g. database_searcher.star_table
+x: true plate solution (platescale in radians/pixel, ra, dec, roll) in radians, in the
+   convention of transforms.linear_transform (pixel offsets from the image centre as (y, x))
+image_shape: (height, width)
+n_stars: keep this many (brightest) centroids
+distortion: radial distortion coefficient k: r -> r (1 + k (r/r_max)^2), with r_max the half diagonal
+contamination: fraction of spurious centroids (hot pixels, satellites...) inserted at random ranks
+mirror: swap the x and y axes (as for a mirror-imaged optical system)
+centroid_noise: pixels rms, mag_noise: magnitudes rms (perturbs the brightness ranking)
+returns centroids (n x 2 array of (y, x), brightest first), is_star (bool array: False for spurious ones)
+'''
+def synthetic_centroids(star_table, x, image_shape, rng, n_stars=100, distortion=0., contamination=0., mirror=False, centroid_noise=0.3, mag_noise=0.2):
+    h, w = image_shape
+    half_diag = 0.5 * np.hypot(h, w)
+    centre_vect = transforms.linear_transform(x, np.zeros((1, 2)))[0]
+    near = star_table[star_table[:, 2:5] @ centre_vect > np.cos(1.2 * half_diag * x[0])]
+    q = transforms.detransform_vectors(x, near[:, 2:5].astype(float))
+    r2 = np.sum(q**2, axis=1) / half_diag**2
+    q = q * (1 + distortion * r2)[:, None]
+    q = q + rng.normal(0, centroid_noise, q.shape)
+    centroids = q + np.array([h/2, w/2])
+    inside = (centroids[:, 0] >= 0) & (centroids[:, 0] < h) & (centroids[:, 1] >= 0) & (centroids[:, 1] < w)
+    centroids = centroids[inside]
+    mag = near[inside, 5] + rng.normal(0, mag_noise, centroids.shape[0])
+    centroids = centroids[np.argsort(mag)][:n_stars]
+    n_fake = int(round(contamination * centroids.shape[0]))
+    fake = rng.uniform(0, 1, (n_fake, 2)) * np.array([h, w])
+    pos = np.sort(rng.integers(0, centroids.shape[0] + 1, n_fake))
+    is_star = np.insert(np.ones(centroids.shape[0], dtype=bool), pos, False)
+    centroids = np.insert(centroids, pos, fake, axis=0)
+    if mirror:
+        centroids = centroids[:, [1, 0]]
+    return centroids, is_star
@@ -0,0 +1,50 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+'''
+random star catalogue as a database_lookup2 star table (ra, dec, x, y, z, mag; sorted by brightness)
+'''
+def make_star_table(n, seed=0):
+    rng = np.random.default_rng(seed)
+    v = rng.normal(size=(n, 3))
+    v /= np.linalg.norm(v, axis=1)[:, None]
+    ra = np.arctan2(v[:, 1], v[:, 0]) % (2 * np.pi)
+    dec = np.arcsin(v[:, 2])
+    mag = np.sort(rng.uniform(0, 12, n))
+    return np.c_[ra, dec, v, mag].astype(np.float32)
+
+@pytest.fixture(scope='session')
+def star_table():
+    return make_star_table(30000)
+
+'''
+platesolve_triangle set up to solve against star_table: the catalogue and a triangle database generated from it
+(for fields of about 10 degrees) are registered with database_cache
+'''
+@pytest.fixture(scope='session')
+def solver(star_table, tmp_path_factory):
+    pytest.importorskip('tetra3')
+    pytest.importorskip('astroquery')
+    import database_cache
+    import database_lookup2
+    import platesolve_new
+    import platesolve_triangle
+    from MEE2024util import resource_path
+    directory = tmp_path_factory.mktemp('triangles')
+    arrays = platesolve_new.build_arrays(star_table[:, 2:5], a=300, b=1200, theta_sep=3.0, theta_double_star=0.5, c=0, e=10, theta_pat=9,
+                                         n_processes=1, chunk_size=500, progress=lambda *args: None)
+    path = str(directory / 'triangles.npz')
+    np.savez_compressed(path, **arrays)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(directory) # (no family manifest: only the standard database)
+        catalogue_path = resource_path("resources/compressed_tycho2024epoch.npz")
+        mp.setattr(database_cache._cache, 'catalogue_cache', {
+            catalogue_path:database_lookup2.database_searcher.from_star_table(star_table),
+            database_cache.triangles_path:database_cache.load_triangles(path)})
+        yield platesolve_triangle
+
+OPTIONS = {'flag_display':False, 'rough_match_threshhold':36, 'flag_display2':False, 'flag_debug':False}
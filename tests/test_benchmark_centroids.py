@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+for module in ('tetra3', 'cv2', 'PySimpleGUI', 'skimage'): # (benchmark_centroids imports stacker_implementation)
+    pytest.importorskip(module)
+import benchmark_centroids
+
+def test_match_is_one_to_one_closest_first():
+    truth = np.array([[10., 10.], [10., 13.], [50., 50.]])
+    detected = np.array([[10., 11.2], [10.2, 10.], [30., 30.], [50., 51.5]])
+    owner, dist = benchmark_centroids.match(detected, truth, 2.)
+    assert owner.tolist() == [1, 0, -1, 2] # (the first detection loses star 0 to the closer second one)
+    assert np.allclose(dist[[0, 1, 3]], [1.8, 0.2, 1.5]) and np.isinf(dist[2])
+    owner, dist = benchmark_centroids.match(np.zeros((0, 2)), truth, 2.)
+    assert owner.shape == (0,)
+    assert benchmark_centroids.match(detected, np.zeros((0, 2)), 2.)[0].tolist() == [-1] * 4
+
+def test_evaluate():
+    runs = [{'time_s':2., 'n_detected':10, 'n_false':2, 'true_mag':np.array([5.5, 6.5, 9.5, 11.5]),
+             'true_found':np.array([True, True, False, False]), 'true_err':np.array([0.1, 0.3, np.nan, np.nan])},
+            {'time_s':3., 'n_detected':5, 'n_false':1, 'true_mag':np.array([5.2, 10.5]),
+             'true_found':np.array([True, True]), 'true_err':np.array([0.2, 0.4])}]
+    metrics = benchmark_centroids.evaluate(runs, np.arange(5., 13.), recall_mag=10.)
+    assert metrics['candidates/s'] == 3. and metrics['time_per_image_s'] == 2.5
+    assert metrics['recall'] == 0.75 and metrics['false_positive_rate'] == 0.2
+    assert np.isclose(metrics['rms_px'], np.sqrt((0.01 + 0.09 + 0.04) / 3))
+    assert metrics['per_mag']['5-6'] == {'n':2, 'recall':1., 'rms_px':pytest.approx(np.sqrt(0.025))}
+    assert metrics['per_mag']['7-8'] == {'n':0, 'recall':None, 'rms_px':None}
+    assert metrics['per_mag']['11-12']['recall'] == 0.
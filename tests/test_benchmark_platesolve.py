@@ -0,0 +1,35 @@
+import argparse
+import numpy as np
+import pytest
+
+pytest.importorskip('tetra3') # (benchmark_platesolve imports database_cache, which imports tetra3)
+import benchmark_platesolve
+
+def _args(**kwargs):
+    args = dict(fov_min=5, fov_max=10, shape=[1000, 1500], mirror_fraction=0.5, max_distortion=0.01, max_contamination=0.1)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+def test_random_trials():
+    rng = np.random.default_rng(0)
+    trials = [benchmark_platesolve.random_trial(rng, _args()) for _ in range(200)]
+    assert all(5 <= t['fov'] <= 10 and abs(t['scale'] * 1500 - np.radians(t['fov'])) < 1e-12 for t in trials)
+    assert 0.3 < np.mean([t['mirror'] for t in trials]) < 0.7
+    assert all(abs(t['dec']) <= np.pi / 2 and 0 <= t['contamination'] <= 0.1 for t in trials)
+
+def test_solution_error():
+    trial = {'scale':1e-4, 'ra':1.0, 'dec':0.3, 'roll':2.0, 'mirror':False}
+    exact = {'x':np.array([1e-4, 1.0, 0.3, 2.0]), 'mirror':False}
+    assert benchmark_platesolve.solution_error(exact, trial, (1000, 1500)) < 1e-9
+    off = {'x':np.array([1e-4, 1.0 + np.radians(0.1), 0.3, 2.0]), 'mirror':False}
+    assert abs(benchmark_platesolve.solution_error(off, trial, (1000, 1500)) - 0.1 * np.cos(0.3)) < 0.01
+    assert benchmark_platesolve.solution_error(dict(exact, mirror=True), trial, (1000, 1500)) > 0.01 # (wrong parity)
+
+def test_summarise():
+    records = [{'latency_s':1., 'solved':True, 'correct':True}, {'latency_s':3., 'solved':True, 'correct':False},
+               {'latency_s':2., 'solved':False, 'correct':False}, {'latency_s':0., 'solved':False, 'correct':False, 'skipped':True}]
+    summary = benchmark_platesolve.summarise(records)
+    assert summary['n_trials'] == 3 and summary['n_skipped'] == 1
+    assert summary['latency_s']['p50'] == 2. and summary['latency_s']['max'] == 3.
+    assert np.allclose([summary['success_rate'], summary['false_positive_rate'], summary['failure_rate']], [1/3, 1/3, 1/3])
+    assert benchmark_platesolve.summarise([])['latency_s'] == {}
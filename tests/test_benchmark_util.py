@@ -0,0 +1,19 @@
+import benchmark_util
+
+def test_compare_flags_regressions_in_the_right_direction():
+    baseline = {'time_s':{'p50':1.0, 'p90':2.0}, 'items/s':100., 'success_rate':0.9, 'n':10, 'flag':True, 'name':'x'}
+    current = {'time_s':{'p50':1.1, 'p90':3.0}, 'items/s':70., 'success_rate':0.95, 'n':10, 'flag':False, 'name':'y', 'new':1.}
+    rows = {row[0]:row for row in benchmark_util.compare(current, baseline, higher_is_better=('/s', 'success_rate'), tolerance=0.2)}
+    assert sorted(rows) == ['items/s', 'n', 'success_rate', 'time_s.p50', 'time_s.p90'] # (only numbers present in both)
+    assert sorted(name for name, row in rows.items() if row[4]) == ['items/s', 'time_s.p90']
+    assert abs(rows['time_s.p90'][3] - 0.5) < 1e-12
+
+def test_check_baseline(tmp_path, capsys):
+    path = str(tmp_path / 'baseline.json')
+    results = dict(benchmark_util.run_info(), config={'shape':(10, 10)}, metrics={'time_s':1.0})
+    assert not benchmark_util.check_baseline(results, path) # (no baseline yet)
+    assert not benchmark_util.check_baseline(results, path, save_baseline=True)
+    assert not benchmark_util.check_baseline(dict(results, metrics={'time_s':1.1}), path)
+    assert 'different configuration' not in capsys.readouterr().out
+    assert benchmark_util.check_baseline(dict(results, metrics={'time_s':1.5}, config={'shape':(20, 20)}), path)
+    assert 'different configuration' in capsys.readouterr().out
@@ -0,0 +1,175 @@
+import os
+import json
+import pickle
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('tetra3') # (database_cache imports tetra3)
+import database_cache
+import triangle_database
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database_cache._cache, 'triangles_future', None)
+    monkeypatch.setattr(database_cache._cache, 'prepare_process', None)
+    monkeypatch.setattr(database_cache._cache, 'catalogue_cache', {})
+    monkeypatch.setattr(database_cache._cache, 'local_triangles', [])
+    return database_cache._cache
+
+def _write_triangles(path=database_cache.triangles_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rng = np.random.default_rng(0)
+    np.savez(path, anchors=np.arange(100), pattern_ind=np.arange(200).reshape((100, 2)), pattern_data=np.arange(300),
+             triangles=np.c_[rng.uniform(0.01, 1, 400), rng.uniform(0, 2 * np.pi, 400)].reshape((100, 4, 2)).astype(np.float32))
+
+class _FakeProcess:
+
+    def __init__(self, target, args, exitcode=0):
+        self.exitcode = exitcode
+        self.terminated = False
+        self.release = threading.Event()
+
+    def start(self):
+        pass
+
+    def join(self):
+        self.release.wait(10)
+
+    def is_alive(self):
+        return not self.release.is_set()
+
+    def terminate(self):
+        self.terminated = True
+
+def test_prepare_in_a_thread(cache):
+    _write_triangles()
+    future = database_cache.prepare_triangles('thread')
+    assert database_cache.prepare_triangles('process') is future # (already started)
+    data = database_cache.open_catalogue(database_cache.triangles_path)
+    assert data is future.result(10) and database_cache.triangles_ready()
+    assert isinstance(data.kd_tree, triangle_database.GridIndex) and data.directory is not None
+    assert cache.prepare_process is None
+
+def test_auto_mode_uses_a_process_until_the_database_is_converted(cache, monkeypatch):
+    _write_triangles()
+    processes = []
+    monkeypatch.setattr(database_cache, 'Process', lambda target, args: processes.append(_FakeProcess(target, args)) or processes[-1])
+    future = database_cache.prepare_triangles()
+    assert processes and not future.done()
+    triangle_database.convert(database_cache.triangles_path) # (the work of the child process)
+    processes[0].release.set()
+    assert future.result(10).triangles.shape == (100, 4, 2)
+    monkeypatch.setattr(cache, 'triangles_future', None)
+    database_cache.prepare_triangles().result(10)
+    assert len(processes) == 1 # (converted: loaded in a thread)
+
+def test_failed_process(cache, monkeypatch):
+    process = _FakeProcess(None, None, exitcode=1)
+    process.release.set()
+    monkeypatch.setattr(database_cache, 'Process', lambda target, args: process)
+    future = database_cache.prepare_triangles('process')
+    with pytest.raises(Exception, match='exit code 1'):
+        future.result(10)
+
+def test_stop_preparation_cancels(cache, monkeypatch):
+    process = _FakeProcess(None, None)
+    monkeypatch.setattr(database_cache, 'Process', lambda target, args: process)
+    future = database_cache.prepare_triangles('process')
+    database_cache.stop_preparation()
+    assert process.terminated and future.cancelled()
+    process.release.set() # (the waiting thread then leaves the cancelled future alone)
+    for thread in threading.enumerate():
+        if thread.name == 'prepare_triangles':
+            thread.join(10)
+    assert future.cancelled()
+
+def test_unknown_mode(cache):
+    with pytest.raises(Exception, match='unknown mode'):
+        database_cache.prepare_triangles('fibre')
+    assert cache.triangles_future is None
+
+FAMILY = {'narrow':{'path':'narrow.npz', 'fov':[0.5, 2.5]}, 'wide':{'path':'wide.npz', 'fov':[10, 40]},
+          'standard':{'path':'standard.npz', 'fov':[2.5, 10]}}
+
+def test_select_by_field_of_view():
+    select = lambda shape, scale: database_cache.select_triangle_databases(shape, scale, family=FAMILY, verbose=False)
+    assert select((1000, 1500), (20, 22)) == ['standard.npz'] # (8.3 - 9.2 degrees)
+    assert select((1500, 1000), (20, 22)) == ['standard.npz'] # (the larger side counts)
+    assert select((1000, 1500), (20, 30)) == ['standard.npz', 'wide.npz'] # (8.3 - 12.5 degrees)
+    assert select((1000, 1500), (2, 3)) == ['narrow.npz']
+    assert select((1000, 1500), (0.1, 0.2)) == ['narrow.npz'] # (outside all bands: the nearest)
+    assert select((1000, 1500), (200, 300)) == ['wide.npz']
+
+def test_select_everything_without_a_scale():
+    assert database_cache.select_triangle_databases((1000, 1500), None, family=FAMILY) == ['narrow.npz', 'standard.npz', 'wide.npz']
+    assert database_cache.select_triangle_databases(None, (20, 22), family=FAMILY) == ['narrow.npz', 'standard.npz', 'wide.npz']
+
+def test_read_family(cache):
+    assert database_cache.read_family() == {'standard':{'path':database_cache.triangles_path, 'fov':[2.5, 10]}} # (no manifest)
+    os.makedirs(os.path.dirname(database_cache.family_path))
+    members = {'narrow':{'path':'narrow.npz', 'fov':[0.5, 2.5]}, 'wide':{'path':'wide.npz', 'fov':[10, 40]},
+               'standard':{'path':database_cache.triangles_path, 'fov':[2.5, 10]}}
+    with open(database_cache.family_path, 'w', encoding="utf-8") as fp:
+        json.dump({'format':1, 'members':members}, fp)
+    open('wide.npz', 'wb').close()
+    family = database_cache.read_family()
+    assert sorted(family) == ['standard', 'wide'] # (narrow.npz does not exist, the standard database is generated on demand)
+    assert database_cache.select_triangle_databases((1000, 1500), (20, 30), verbose=False) == [database_cache.triangles_path, 'wide.npz']
+
+def _unit(ra, dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+@pytest.fixture
+def generated(cache, monkeypatch):
+    calls = []
+    def generate_local(centre, radius, fov):
+        calls.append((tuple(centre), radius, fov))
+        if centre[2] > 0.99: # (no stars near the pole)
+            return None
+        return {'anchors':np.zeros((5, 3)), 'pattern_ind':np.zeros((5, 2), dtype=int), 'pattern_data':np.zeros((5, 2, 5)),
+                'triangles':np.random.default_rng(len(calls)).uniform(0, 1, (5, 4, 2))}
+    monkeypatch.setattr(database_cache.platesolve_new, 'generate_local', generate_local)
+    return calls
+
+def test_local_database_is_reused_nearby(generated):
+    data = database_cache.open_local_triangles(_unit(10, 20), 5, 8)
+    assert generated[0][1] == 5 * database_cache.LOCAL_MARGIN
+    assert database_cache.open_local_triangles(_unit(11, 20), 5, 8) is data # (within the covered 7.5 degrees)
+    assert database_cache.open_local_triangles(_unit(10, 20), 5, 8.5) is data # (nearly the same field of view)
+    assert len(generated) == 1
+    assert database_cache.open_local_triangles(_unit(14, 20), 5, 8) is not data # (not covered any more)
+    assert database_cache.open_local_triangles(_unit(10, 20), 5, 12) is not data # (other field of view)
+    assert database_cache.open_local_triangles(_unit(10, 20), 7, 8) is data # (still within 7.5 degrees)
+    assert database_cache.open_local_triangles(_unit(10, 20), 8, 8) is not data # (larger than covered)
+    assert len(generated) == 4
+
+def test_empty_regions_are_cached(generated):
+    assert database_cache.open_local_triangles(_unit(0, 89.5), 2, 8) is None
+    assert database_cache.open_local_triangles(_unit(0, 89.5), 2, 8) is None
+    assert len(generated) == 1
+
+def test_least_recently_used_local_database_is_dropped(generated, monkeypatch):
+    monkeypatch.setattr(database_cache, 'LOCAL_CACHE_SIZE', 3)
+    first = database_cache.open_local_triangles(_unit(0, 0), 2, 8)
+    for ra in (30, 60):
+        database_cache.open_local_triangles(_unit(ra, 0), 2, 8)
+    assert database_cache.open_local_triangles(_unit(0, 0), 2, 8) is first # (now the most recently used)
+    database_cache.open_local_triangles(_unit(90, 0), 2, 8) # (drops ra 30)
+    assert len(generated) == 4
+    assert database_cache.open_local_triangles(_unit(0, 0), 2, 8) is first
+    database_cache.open_local_triangles(_unit(30, 0), 2, 8)
+    assert len(generated) == 5
+
+def test_memory_mapped_triangles_are_pickled_as_their_directory(cache):
+    _write_triangles()
+    data = database_cache.load_triangles()
+    pickled = pickle.dumps(data)
+    assert len(pickled) < 1000 # (the directory, not the arrays)
+    again = pickle.loads(pickled)
+    assert again.directory == data.directory and isinstance(again.triangles, np.memmap)
+    assert np.array_equal(again.triangles, data.triangles)
+    in_memory = database_cache.TriangleData({name:np.asarray(data.__dict__[name]) for name in ('triangles', 'anchors', 'pattern_data', 'pattern_ind')})
+    assert np.array_equal(pickle.loads(pickle.dumps(in_memory)).triangles, data.triangles)
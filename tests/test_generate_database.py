@@ -0,0 +1,92 @@
+import itertools
+import numpy as np
+import pytest
+from scipy.spatial import KDTree
+from conftest import make_star_table
+
+pytest.importorskip('tetra3') # (platesolve_new imports database_cache, which imports tetra3)
+import platesolve_new
+
+'''
+the database generation before it was vectorised (platesolve_new.generate), one star at a time
+(except that the #c nearest pattern stars are excluded from the #e brightest ones by their position among the
+neighbours: the original compared positions with star indices, which only mattered for c > 0)
+'''
+def _reference(vectors, a, b, theta_sep, theta_double_star, c, e, theta_pat):
+    theta_sep, theta_double_star, theta_pat = np.radians([theta_sep, theta_double_star, theta_pat])
+    d = vectors.shape[0]
+    kd_tree1 = KDTree(vectors)
+    kept = np.zeros(d, dtype=bool)
+    kept2 = np.zeros(d, dtype=bool)
+    for i in range(d):
+        neighbours = kd_tree1.query_ball_point(vectors[i], theta_sep)
+        neighbours2 = kd_tree1.query_ball_point(vectors[i], theta_double_star)
+        if not np.any(kept[neighbours]):
+            if i < a+b:
+                kept[i] = 1
+            kept2[i] = 1
+        elif not np.any(kept[neighbours2]):
+            if i < a:
+                kept[i] = 1
+            kept2[i] = 1
+    vectors_kept = vectors[kept, :]
+    kept_vectors_ind = np.nonzero(kept)[0]
+    nkept = vectors_kept.shape[0]
+    vectors2 = vectors[kept2, :]
+    kd_tree2 = KDTree(vectors2)
+    cumsum = np.cumsum(np.logical_not(kept2).astype(int))
+    pattern_ind = np.ones((nkept, c+e), dtype=int)*-1
+    pattern_data = np.zeros((nkept, c+e, 5), dtype=np.float32)
+    z = np.array([0, 0, 1])
+    for i in range(nkept):
+        neighbours = kd_tree2.query_ball_point(vectors_kept[i], theta_pat)
+        ind = kept_vectors_ind[i]
+        neighbours.remove(ind - cumsum[ind]) # don't match self
+        assert len(neighbours) >= c+e
+        delta = vectors2[neighbours] - vectors_kept[i]
+        dtheta = 2 * np.arcsin(.5 * np.linalg.norm(delta, axis=1))
+        tangent_vector_phi = np.cross(z, vectors_kept[i])
+        tangent_vector_phi /= np.linalg.norm(tangent_vector_phi)
+        tangent_vector_theta = np.cross(tangent_vector_phi, vectors_kept[i])
+        tangent_vector_theta /= np.linalg.norm(tangent_vector_theta)
+        phi = np.arctan2(np.dot(tangent_vector_phi, delta.T), np.dot(tangent_vector_theta, delta.T))
+        chosen_c = list(np.argsort(dtheta, kind='stable')[:c])
+        chosen_e = [x for x in np.argsort(neighbours) if x not in chosen_c][:e]
+        pattern_ind[i, :] = np.array(neighbours)[chosen_c + chosen_e]
+        pattern_data[i, :, 0] = dtheta[chosen_c+chosen_e]
+        pattern_data[i, :, 1] = phi[chosen_c+chosen_e]
+        pattern_data[i, :, 2:5] = vectors2[pattern_ind[i]]
+    triangles = np.zeros((nkept, (c+e)*(c+e-1)//2, 2), dtype=np.float32)
+    for i in range(nkept):
+        for n, (j, k) in enumerate(itertools.combinations(range(c+e), 2)):
+            ratio = pattern_data[i, k, 0] / pattern_data[i, j, 0]
+            dphi = pattern_data[i, k, 1] - pattern_data[i, j, 1]
+            if ratio > 1:
+                ratio = 1/ratio
+                dphi = -dphi
+            triangles[i, n] = ratio, dphi % (2 * np.pi)
+    return {'anchors':vectors_kept, 'pattern_ind':pattern_ind, 'pattern_data':pattern_data, 'triangles':triangles}
+
+@pytest.fixture(scope='module')
+def vectors():
+    return make_star_table(3000, seed=7)[:, 2:5]
+
+@pytest.mark.parametrize('c, e, n_processes', [(0, 6, 1), (2, 5, 1), (0, 6, 2)])
+def test_build_arrays_matches_reference(vectors, c, e, n_processes):
+    parameters = dict(a=100, b=400, theta_sep=3.0, theta_double_star=0.5, c=c, e=e, theta_pat=12)
+    expected = _reference(vectors, **parameters)
+    arrays = platesolve_new.build_arrays(vectors, **parameters, n_processes=n_processes, chunk_size=100, progress=lambda *args: None)
+    assert np.array_equal(arrays['anchors'], expected['anchors'])
+    assert np.array_equal(arrays['pattern_ind'], expected['pattern_ind'])
+    assert np.allclose(arrays['pattern_data'], expected['pattern_data'], atol=1e-6)
+    ratio_error = np.abs(arrays['triangles'][..., 0] - expected['triangles'][..., 0])
+    dphi_error = np.abs(arrays['triangles'][..., 1] - expected['triangles'][..., 1])
+    assert ratio_error.max() < 1e-5
+    assert np.minimum(dphi_error, 2 * np.pi - dphi_error).max() < 1e-5
+
+def test_anchors_with_too_few_neighbours_are_left_out(vectors):
+    arrays = platesolve_new.build_arrays(vectors, a=100, b=400, theta_sep=3.0, theta_double_star=0.5, c=0, e=30, theta_pat=12,
+                                         n_processes=1, progress=lambda *args: None)
+    assert 0 < arrays['anchors'].shape[0] < 500
+    assert np.all(arrays['pattern_ind'] >= 0)
+    assert arrays['triangles'].shape == (arrays['anchors'].shape[0], 30 * 29 // 2, 2)
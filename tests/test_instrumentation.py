@@ -0,0 +1,86 @@
+import json
+import contextlib
+import time
+import threading
+import instrumentation
+
+def test_span_as_dict():
+    s = instrumentation.Span('stack.centroiding', frame=3, parent='stack', items=7.0)
+    s.start()
+    time.sleep(0.01)
+    s.stop()
+    d = s.as_dict()
+    assert d['name'] == 'stack.centroiding' and d['frame'] == '3' and d['parent'] == 'stack' and d['items'] == 7
+    assert d['wall_s'] >= 0.01 and d['cpu_s'] >= 0
+    assert set(instrumentation.Span('x').as_dict()) == {'name', 'wall_s', 'cpu_s', 'peak_rss_mb'}
+
+def test_spans_nest_and_are_summarised():
+    recorder = instrumentation.Recorder('run1')
+    with recorder.span('stack'):
+        for i in range(3):
+            with recorder.span('stack.frame', frame=i) as s:
+                s.items = 10
+    with recorder.span('platesolve'):
+        pass
+    assert [s.name for s in recorder.spans] == ['stack.frame'] * 3 + ['stack', 'platesolve']
+    assert [s.parent for s in recorder.spans] == ['stack'] * 3 + [None, None]
+    summary = recorder.summary()
+    assert list(summary) == ['stack.frame', 'stack', 'platesolve'] # (in order of first completion)
+    assert summary['stack.frame']['count'] == 3 and summary['stack.frame']['items'] == 30
+    assert summary['stack.frame']['items/s'] > 0 and not 'items/s' in summary['stack']
+    assert summary['stack']['wall_s'] >= summary['stack.frame']['wall_s']
+    lines = recorder.format_summary().splitlines()
+    assert len(lines) == 4 and lines[1].split()[:2] == ['stack.frame', '3']
+
+def test_spans_of_other_threads_have_their_own_parents():
+    recorder = instrumentation.Recorder()
+    def worker():
+        with recorder.span('worker'):
+            pass
+    with recorder.span('main'):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    assert {s.name:s.parent for s in recorder.spans} == {'worker':None, 'main':None}
+
+def test_span_is_recorded_on_error():
+    recorder = instrumentation.Recorder(max_spans=2)
+    for i in range(3):
+        try:
+            with recorder.span('fails', frame=i):
+                raise ValueError
+        except ValueError:
+            pass
+    assert [s.frame for s in recorder.spans] == [1, 2] # (the oldest span is dropped)
+    assert recorder._stack() == []
+
+def test_write_jsonl(tmp_path):
+    recorder = instrumentation.Recorder('run1')
+    with recorder.span('a', items=2):
+        pass
+    path = tmp_path / 'timing.jsonl'
+    recorder.write_jsonl(path)
+    recorder.write_jsonl(path, append=True, extra={'host':'test'})
+    with open(path, encoding="utf-8") as fp:
+        rows = [json.loads(line) for line in fp]
+    assert len(rows) == 2 and all(row['run'] == 'run1' and row['name'] == 'a' and row['items'] == 2 for row in rows)
+    assert rows[1]['host'] == 'test' and not 'host' in rows[0]
+
+def test_hooks_and_module_recorder():
+    entered = []
+    def hook(span):
+        entered.append(span.name)
+        return contextlib.nullcontext()
+    instrumentation.add_hook(hook)
+    try:
+        recorder = instrumentation.start_run('run2')
+        @instrumentation.timed('decorated')
+        def f(x):
+            return 2 * x
+        assert f(3) == 6
+        with instrumentation.span('plain'):
+            pass
+    finally:
+        instrumentation.remove_hook(hook)
+    assert instrumentation.current() is recorder and recorder.run_id == 'run2'
+    assert [s.name for s in recorder.spans] == ['decorated', 'plain'] and entered == ['decorated', 'plain']
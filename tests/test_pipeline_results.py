@@ -0,0 +1,62 @@
+import json
+import zipfile
+import numpy as np
+import pandas as pd
+import pytest
+import pipeline_results
+
+def _solution():
+    return {'success':True, 'x':np.array([2.1e-4, 1.0, 0.3, 2.0]), 'platescale/arcsec':43.3, 'ra':57.3, 'dec':17.2, 'roll':114.6,
+            'mirror':True, 'matched_centroids':np.arange(8.).reshape((4, 2)), 'matched_stars':np.arange(24.).reshape((4, 6)),
+            'solver':'triangle', 'elapsed':0.5}
+
+def _write_archive(path, prefix=''):
+    df = pd.DataFrame({'px':[1.5, 20.25, 300.], 'py':[4.5, 50.75, 600.], 'area (pixels)':[3, 4, 5], 'flux (noise-normed)':[9., 8., 7.]})
+    results = {'platesolved':True, 'n_centroids':3, 'img_shape':[1000, 1500], 'RA':57.3}
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr(prefix + 'results.txt', json.dumps(results))
+        archive.writestr(prefix + 'STACKED_CENTROIDS_DATA.csv', df.to_csv())
+    return df, results
+
+def test_plate_solution_round_trip():
+    solution = pipeline_results.PlateSolution(_solution())
+    assert solution.success and solution.mirror and solution.ra == 57.3
+    assert solution.extra == {'solver':'triangle', 'elapsed':0.5}
+    again = pipeline_results.PlateSolution(dict(solution.as_dict(), **solution.extra))
+    for key, value in solution.as_dict().items():
+        assert np.array_equal(again.as_dict()[key], value)
+    assert again.extra == solution.extra
+    assert 'mirror=True' in repr(again)
+
+def test_failed_plate_solution():
+    solution = pipeline_results.PlateSolution({'success':False, 'x':None, 'platescale/arcsec':None, 'ra':None, 'dec':None, 'roll':None,
+                                               'matched_centroids':None, 'matched_stars':None})
+    assert not solution.success and not solution.mirror
+    assert repr(solution) == 'PlateSolution(success=False)'
+
+@pytest.mark.parametrize('prefix', ['', 'data/']) # (current, and old archive layout)
+def test_stack_result_from_archive(tmp_path, prefix):
+    path = tmp_path / 'centroid_data.zip'
+    df, results = _write_archive(path, prefix)
+    stack_result = pipeline_results.StackResult.from_archive(path)
+    assert stack_result.results == results and stack_result.img_shape == (1000, 1500)
+    assert np.array_equal(stack_result.centroids_yx(), np.c_[df['py'], df['px']])
+    assert stack_result.centroids_yx().dtype == float
+    assert stack_result.solution is None and stack_result.stacked is None
+    assert stack_result.archive_path == path
+
+def test_do_stack_finishes_profiling_on_error(tmp_path, monkeypatch):
+    pytest.importorskip('tetra3')
+    pytest.importorskip('cv2')
+    pytest.importorskip('PySimpleGUI')
+    pytest.importorskip('skimage')
+    import stacker_implementation
+    calls = []
+    monkeypatch.setattr(stacker_implementation.profiling, 'configure', lambda *args: calls.append('configure'))
+    monkeypatch.setattr(stacker_implementation.profiling, 'finish', lambda: calls.append('finish'))
+    def fail(file):
+        raise OSError('unreadable: ' + file)
+    monkeypatch.setattr(stacker_implementation, 'open_image', fail)
+    with pytest.raises(OSError):
+        stacker_implementation.do_stack(['missing.fit'], [], [], {'output_dir':str(tmp_path)})
+    assert calls == ['configure', 'finish']
@@ -0,0 +1,84 @@
+from multiprocessing import shared_memory
+import numpy as np
+import pytest
+import synthetic_data
+from conftest import OPTIONS
+
+pytest.importorskip('tetra3') # (platesolve_batch imports database_cache)
+import platesolve_batch
+
+SHAPE = (1000, 1500)
+SCALE = 2.1e-4
+
+# a drifting sequence of frames
+def _items(star_table, n, seed=3):
+    rng = np.random.default_rng(seed)
+    x = np.array([SCALE, 1.0, 0.3, 2.0])
+    return [(synthetic_data.synthetic_centroids(star_table, x + [0, 0.002 * i, 0.001 * i, 0.0005 * i], SHAPE, rng, n_stars=60)[0], SHAPE)
+            for i in range(n)]
+
+def _solution(ra):
+    return {'success':True, 'ra':ra, 'dec':10., 'roll':30., 'platescale/arcsec':43.3, 'mirror':False}
+
+def test_warm_hint_from_the_nearest_solved_item():
+    assert platesolve_batch._warm_hint(3, {}) is None
+    hint = platesolve_batch._warm_hint(3, {0:_solution(0.), 5:_solution(5.), 6:_solution(6.)})
+    assert hint['ra'] == 5. and hint['radius'] == platesolve_batch.WARM_RADIUS
+    assert platesolve_batch._warm_hint(3, {1:_solution(1.), 5:_solution(5.)})['ra'] == 1. # (a tie goes to the earlier item)
+
+def test_in_process_batch_is_in_order_and_warm_started(solver, star_table, monkeypatch):
+    hints = {}
+    solve_item = platesolve_batch._solve_item
+    def recording(index, centroids, image_shape, options, hint, output_dir):
+        hints[index] = hint
+        return solve_item(index, centroids, image_shape, options, hint, output_dir)
+    monkeypatch.setattr(platesolve_batch, '_solve_item', recording)
+    results = list(platesolve_batch.solve_batch(_items(star_table, 4), OPTIONS, n_processes=1))
+    assert [i for i, _, _ in results] == [0, 1, 2, 3]
+    assert all(result['success'] for _, result, _ in results)
+    assert hints[0] is None
+    assert hints[1]['ra'] == pytest.approx(results[0][1]['ra'])
+    assert hints[3]['ra'] == pytest.approx(results[2][1]['ra'])
+    assert all(timing['elapsed_s'] >= timing['solve_s'] for _, _, timing in results)
+
+def test_own_hints_and_cold_start(star_table, monkeypatch):
+    hints = {}
+    def recording(index, centroids, image_shape, options, hint, output_dir):
+        hints[index] = hint
+        return index, {'success':True}, 0.
+    monkeypatch.setattr(platesolve_batch, '_solve_item', recording)
+    items = [{'centroids':c, 'image_shape':s, 'hint':_solution(1.) if i == 1 else None} for i, (c, s) in enumerate(_items(star_table, 3))]
+    list(platesolve_batch.solve_batch(items, OPTIONS, n_processes=1, warm_start=False))
+    assert hints[0] is None and hints[1]['ra'] == 1. and hints[2] is None
+
+@pytest.fixture
+def created_segments(monkeypatch):
+    created = []
+    SharedMemory = shared_memory.SharedMemory
+    def recording(*args, **kwargs):
+        shm = SharedMemory(*args, **kwargs)
+        if kwargs.get('create'):
+            created.append(shm.name)
+        return shm
+    monkeypatch.setattr(shared_memory, 'SharedMemory', recording)
+    return created
+
+def _unlinked(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return True
+    return False
+
+def test_parallel_batch_shares_and_cleans_up(solver, star_table, created_segments):
+    items = _items(star_table, 6)
+    results = dict((i, result) for i, result, _ in platesolve_batch.solve_batch(items, OPTIONS, n_processes=2))
+    assert sorted(results) == list(range(6))
+    assert all(result['success'] for result in results.values())
+    assert len(created_segments) == 1 and _unlinked(created_segments[0])
+
+def test_abandoned_batch_cleans_up(solver, star_table, created_segments):
+    batch = platesolve_batch.solve_batch(_items(star_table, 6), OPTIONS, n_processes=2)
+    next(batch)
+    batch.close()
+    assert len(created_segments) == 1 and _unlinked(created_segments[0])
@@ -0,0 +1,89 @@
+import json
+import os
+import numpy as np
+import pytest
+import platesolve_cache
+import platesolve_hint
+from conftest import OPTIONS
+
+SHAPE = (1000, 1500)
+
+def _centroids(seed=0):
+    return np.random.default_rng(seed).uniform(0, 1, (50, 2)) * np.array(SHAPE)
+
+def _key(centroids=None, options={}, **kwargs):
+    return platesolve_cache.fingerprint(_centroids() if centroids is None else centroids, SHAPE, options, **kwargs)
+
+def test_key_is_stable():
+    assert _key() == _key()
+    assert _key(_centroids() + 1e-5) == _key() # (rounded to 1/1000 pixel)
+    assert _key(options={'unrelated':1}) == _key() # (only the options which change the solution)
+
+def test_key_depends_on_the_number_of_centroids():
+    centroids = _centroids()
+    assert _key(centroids[:40]) != _key(centroids) # (same brightest stars, but not the same list)
+
+def test_key_depends_on_what_changes_the_solution():
+    keys = [_key(), _key(_centroids(1)), _key(try_mirror_also=False), _key(solver=(1, 2)),
+            _key(options={'platesolve_mirror_mode':'second_pass'}), _key(options={'triangle_database_family':False}),
+            _key(hint={'ra':10, 'dec':20, 'radius':5}), _key(hint={'ra':10, 'dec':25, 'radius':5}),
+            _key(databases=[('a.npz', 1.0)]), _key(databases=[('a.npz', 2.0)]), _key(databases=[('local', 10, 20, 1.5)])]
+    assert len(set(keys)) == len(keys)
+
+def test_get_and_put(tmp_path):
+    options = {'platesolve_cache_dir':str(tmp_path / 'cache')}
+    key = _key()
+    assert platesolve_cache.get(key, options) is None
+    result = {'success':True, 'x':np.array([1e-4, 1, 0.5, 2]), 'matched_centroids':_centroids()}
+    platesolve_cache.put(key, result, options)
+    cached = platesolve_cache.get(key, options)
+    assert cached['success'] and np.array_equal(cached['x'], result['x'])
+    assert np.array_equal(cached['matched_centroids'], result['matched_centroids'])
+
+def test_entries_are_data(tmp_path):
+    options = {'platesolve_cache_dir':str(tmp_path)}
+    platesolve_cache.put('a', {'success':True, 'ra':np.float64(10.5), 'mirror':np.bool_(False), 'stage':(30, 12, 0.01),
+                               'x':np.array([1e-4, 1, 0.5, 2]), 'matched_stars':np.ones((3, 6), dtype=np.float32)}, options)
+    with open(tmp_path / 'a.json', encoding='utf-8') as fp:
+        assert json.load(fp)['ra'] == 10.5
+    cached = platesolve_cache.get('a', options)
+    assert cached['matched_stars'].dtype == np.float32 and cached['mirror'] is False and cached['stage'] == [30, 12, 0.01]
+    # anything else than plain arrays, numbers and strings is not read
+    with open(tmp_path / 'b.json', 'w', encoding='utf-8') as fp:
+        json.dump({'success':True, 'x':{'__ndarray__':[1], 'dtype':'O'}}, fp)
+    assert platesolve_cache.get('b', options) is None
+    (tmp_path / 'c.json').write_bytes(b'\x80\x04not json')
+    assert platesolve_cache.get('c', options) is None
+
+def test_least_recently_used_are_evicted(tmp_path):
+    directory = tmp_path / 'cache'
+    entry = {'success':True, 'data':np.zeros(2**17)}
+    platesolve_cache.put('size', entry, {'platesolve_cache_dir':str(directory)})
+    size_mb = os.path.getsize(directory / 'size.json') / 2**20
+    os.remove(directory / 'size.json')
+    options = {'platesolve_cache_dir':str(directory), 'platesolve_cache_mb':2.5 * size_mb} # (room for two entries)
+    for i in range(4):
+        key = _key(_centroids(i))
+        platesolve_cache.put(key, entry, options)
+        os.utime(directory / (key + '.json'), (i, i))
+    assert platesolve_cache.get(_key(_centroids(2)), options) is not None # (now the most recently used)
+    platesolve_cache.put(_key(_centroids(4)), entry, options)
+    left = sorted(p.name for p in directory.iterdir())
+    assert left == sorted(_key(_centroids(i)) + '.json' for i in (2, 4))
+
+def test_cache_is_opt_in(solver, star_table, tmp_path, monkeypatch):
+    import synthetic_data
+    x = np.array([2.1e-4, 1.0, 0.3, 2.0])
+    centroids, _ = synthetic_data.synthetic_centroids(star_table, x, SHAPE, np.random.default_rng(0), n_stars=60)
+    directory = tmp_path / 'cache'
+    assert solver.platesolve(centroids, SHAPE, dict(OPTIONS, platesolve_cache_dir=str(directory)))['success']
+    assert not directory.exists()
+    options = dict(OPTIONS, platesolve_cache=True, platesolve_cache_dir=str(directory))
+    first = solver.platesolve(centroids, SHAPE, options)
+    assert first['success'] and len(os.listdir(directory)) == 1
+    monkeypatch.setattr(solver, '_platesolve', lambda *args: pytest.fail('the cached solution was not used'))
+    assert np.array_equal(solver.platesolve(centroids, SHAPE, options)['x'], first['x'])
+    # another hint searches other databases: not answered from the cache
+    monkeypatch.undo()
+    solver.platesolve(centroids, SHAPE, options, hint=platesolve_hint.make_hint(np.degrees(x[1]), np.degrees(x[2]), radius=10))
+    assert len(os.listdir(directory)) == 2
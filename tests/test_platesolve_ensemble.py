@@ -0,0 +1,145 @@
+import json
+import time
+import threading
+import numpy as np
+import pytest
+import synthetic_data
+import transforms
+from conftest import OPTIONS
+
+pytest.importorskip('tetra3') # (platesolve_ensemble imports database_cache)
+import platesolve_ensemble
+
+SHAPE = (1000, 1500)
+X = np.array([2.1e-4, 1.0, 0.3, 2.0])
+
+'''
+stand-in for _Tetra3Process: returns solution after delay seconds, unless cancelled first
+'''
+class FakeWorker:
+
+    def __init__(self, solution, delay=0.):
+        self.solution, self.delay = solution, delay
+        self.cancelled = None
+
+    def alive(self):
+        return True
+
+    def solve(self, centroids, size, arguments, timeout, cancel):
+        self.cancelled = cancel.wait(self.delay)
+        return None if self.cancelled else self.solution
+
+@pytest.fixture
+def field(star_table):
+    return synthetic_data.synthetic_centroids(star_table, X, SHAPE, np.random.default_rng(0), n_stars=60)[0]
+
+# a tetra3 solution of the field X: its brightest stars (without centroid noise) and the catalogue stars they are
+def _tetra3_solution(star_table, n=20, shuffle=False):
+    centre = transforms.linear_transform(X, np.zeros((1, 2)))[0]
+    near = star_table[star_table[:, 2:5] @ centre > np.cos(np.radians(8))]
+    q = transforms.detransform_vectors(X, near[:, 2:5].astype(float)) + np.array(SHAPE) / 2
+    inside = np.flatnonzero((q[:, 0] >= 0) & (q[:, 0] < SHAPE[0]) & (q[:, 1] >= 0) & (q[:, 1] < SHAPE[1]))[:n]
+    stars = near[inside]
+    if shuffle:
+        stars = stars[np.random.default_rng(1).permutation(n)]
+    return {'RA':np.degrees(X[1]), 'FOV':np.degrees(X[0]) * SHAPE[1], 'matched_centroids':q[inside].tolist(),
+            'matched_stars':np.c_[np.degrees(stars[:, :2]), stars[:, 5]].tolist()}
+
+@pytest.fixture
+def fake_tetra3(monkeypatch):
+    workers = []
+    def use(solution, delay=0.):
+        workers.append(FakeWorker(solution, delay))
+        monkeypatch.setattr(platesolve_ensemble, '_checkout_tetra3', lambda database: workers[-1])
+        monkeypatch.setattr(platesolve_ensemble, '_checkin_tetra3', lambda worker: None)
+        return workers[-1]
+    return use
+
+def _options(tmp_path, **kwargs):
+    return dict(OPTIONS, platesolve_ensemble=True, database='fake.npz', platesolve_ensemble_log=str(tmp_path / 'ensemble.jsonl'), **kwargs)
+
+def _log(tmp_path):
+    with open(tmp_path / 'ensemble.jsonl', encoding='utf-8') as fp:
+        return [json.loads(line) for line in fp]
+
+def test_triangle_wins_and_cancels_tetra3(solver, star_table, field, fake_tetra3, tmp_path):
+    worker = fake_tetra3(_tetra3_solution(star_table), delay=30)
+    t0 = time.perf_counter()
+    result = platesolve_ensemble.platesolve(field, SHAPE, _options(tmp_path))
+    assert result['success'] and result['solver'] == 'triangle'
+    for _ in range(100): # (tetra3 is cancelled in the background)
+        if worker.cancelled is not None:
+            break
+        time.sleep(0.05)
+    assert worker.cancelled and time.perf_counter() - t0 < 30
+    record, = _log(tmp_path)
+    assert record['winner'] == 'triangle' and record['solvers'] == ['tetra3', 'triangle'] and 'triangle' in record['solver_s']
+    assert record['n_centroids'] == field.shape[0] and record['image_shape'] == list(SHAPE)
+
+def test_tetra3_wins_and_cancels_the_triangle_solver(solver, star_table, field, fake_tetra3, tmp_path, monkeypatch):
+    fake_tetra3(_tetra3_solution(star_table))
+    on_caller = []
+    def slow_triangle(centroids, image_shape, options, output_dir, try_mirror_also, hint, cancel):
+        on_caller.append(threading.current_thread() is threading.main_thread())
+        assert cancel.wait(30)
+        return solver.failed_result(), 0.
+    monkeypatch.setattr(platesolve_ensemble, '_run_triangle', slow_triangle)
+    result = platesolve_ensemble.platesolve(field, SHAPE, _options(tmp_path))
+    assert result['success'] and result['solver'] == 'tetra3'
+    assert result['platescale/arcsec'] == pytest.approx(np.degrees(X[0]) * 3600, rel=1e-3)
+    assert on_caller == [True] # (the triangle solver, which may draw with pyplot, runs on the calling thread)
+    assert _log(tmp_path)[0]['winner'] == 'tetra3'
+
+def test_wrong_tetra3_solution_is_rejected(solver, star_table, field, fake_tetra3):
+    fake_tetra3(_tetra3_solution(star_table, shuffle=True))
+    result, _ = platesolve_ensemble._run_tetra3(field, SHAPE, dict(OPTIONS, database='fake.npz'), threading.Event())
+    assert not result['success']
+    fake_tetra3(_tetra3_solution(star_table))
+    result, _ = platesolve_ensemble._run_tetra3(field, SHAPE, dict(OPTIONS, database='fake.npz'), threading.Event())
+    assert result['success']
+
+def test_no_solver_succeeds(solver, fake_tetra3, tmp_path):
+    fake_tetra3({'RA':None})
+    centroids = np.random.default_rng(5).uniform(0, 1, (60, 2)) * np.array(SHAPE)
+    result = platesolve_ensemble.platesolve(centroids, SHAPE, _options(tmp_path, platesolve_progressive=False))
+    assert not result['success'] and result['solver'] is None
+    assert _log(tmp_path)[0]['winner'] is None
+
+def test_cancel_stops_a_running_stage(solver, field, monkeypatch):
+    cancel = threading.Event()
+    match_triangles = solver.match_triangles
+    def cancelled_while_matching(*args):
+        matches = match_triangles(*args)
+        cancel.set()
+        return matches
+    monkeypatch.setattr(solver, 'match_triangles', cancelled_while_matching)
+    monkeypatch.setattr(solver, '_verify_matches', lambda *args: pytest.fail('the candidates were verified after the cancellation'))
+    assert not solver.platesolve(field, SHAPE, OPTIONS, cancel=cancel)['success']
+
+FAKE_TETRA3 = """
+import time
+class Tetra3:
+    def __init__(self, load_database=None):
+        pass
+    def solve_from_centroids(self, star_centroids, size, pattern_checking_stars=8, return_matches=False):
+        if len(star_centroids) == 1:
+            time.sleep(60)
+        return {'RA':None, 'arguments':[pattern_checking_stars, return_matches]}
+"""
+
+def test_tetra3_process(tmp_path, monkeypatch):
+    (tmp_path / 'tetra3.py').write_text(FAKE_TETRA3)
+    monkeypatch.syspath_prepend(str(tmp_path)) # (the spawned worker imports this tetra3)
+    worker = platesolve_ensemble._Tetra3Process('fake.npz')
+    try:
+        cancel = threading.Event()
+        arguments = {'pattern_checking_stars':5, 'return_matches':True, 'solve_timeout':1000}
+        # (solve_timeout is not supported by this tetra3, and left out)
+        assert worker.solve([[1, 2], [3, 4]], (10, 10), arguments, 10, cancel) == {'RA':None, 'arguments':[5, True]}
+        threading.Timer(0.5, cancel.set).start()
+        t0 = time.perf_counter()
+        assert worker.solve([[1, 2]], (10, 10), arguments, 30, cancel) is None
+        assert time.perf_counter() - t0 < 10 and not worker.alive()
+    finally:
+        if worker.alive():
+            worker.terminate()
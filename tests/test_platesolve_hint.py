@@ -0,0 +1,33 @@
+import pytest
+from astropy.io import fits
+import platesolve_hint
+
+@pytest.mark.parametrize('value, hours, expected', [
+    (187.5, False, 187.5),
+    ('12 30 00', True, 187.5),
+    ('12:30:00.0', True, 187.5),
+    ('12h30m00s', True, 187.5),
+    ('-05:30:00', False, -5.5),
+    ('-00 30 00', False, -0.5),
+])
+def test_parse_angle(value, hours, expected):
+    assert platesolve_hint.parse_angle(value, hours=hours) == pytest.approx(expected)
+
+@pytest.mark.parametrize('ra', [187.5, '187.5', '12 30 00', '12:30:00'])
+def test_header_ra_in_degrees_or_hours(ra):
+    hint = platesolve_hint.from_fits_header({'RA':ra, 'DEC':'+45 30 00'})
+    assert hint['ra'] == pytest.approx(187.5)
+    assert hint['dec'] == pytest.approx(45.5)
+
+def test_header_objctra_is_in_hours():
+    header = fits.Header({'OBJCTRA':'12 30 00', 'OBJCTDEC':'-10 15 00'})
+    hint = platesolve_hint.from_fits_header(header)
+    assert (hint['ra'], hint['dec']) == pytest.approx((187.5, -10.25))
+
+def test_header_scale_from_focal_length():
+    hint = platesolve_hint.from_fits_header({'FOCALLEN':1000., 'XPIXSZ':3.76})
+    assert hint['ra'] is None
+    assert sum(hint['scale']) / 2 == pytest.approx(0.7756, rel=1e-3)
+
+def test_header_without_pointing_or_scale():
+    assert platesolve_hint.from_fits_header({'EXPTIME':1.}) is None
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import synthetic_data
+import transforms
+from conftest import OPTIONS
+
+SHAPE = (1000, 1500)
+SCALE = 2.1e-4 # radians per pixel (a field of about 10 x 15 degrees)
+MAX_ERROR = 3 * np.degrees(SCALE) * 3600 # arcsec: 3 pixels (the centroid noise is 0.3 pixels, neighbouring stars are degrees apart)
+
+def _field(star_table, seed, mirror):
+    rng = np.random.default_rng(seed)
+    x = np.array([SCALE, rng.uniform(0, 2 * np.pi), np.arcsin(rng.uniform(-0.8, 0.8)), rng.uniform(0, 2 * np.pi)])
+    centroids, _ = synthetic_data.synthetic_centroids(star_table, x, SHAPE, rng, n_stars=60, mirror=mirror)
+    return x, centroids
+
+# largest angle (arcsec) between the matched stars and their centroids under the true attitude x
+def _match_error(result, x, mirror):
+    centroids = result['matched_centroids'][:, [1, 0]] if mirror else result['matched_centroids']
+    vectors = transforms.linear_transform(x, centroids - np.array(SHAPE) / 2)
+    cos = np.sum(vectors * result['matched_stars'][:, 2:5], axis=1)
+    return np.degrees(np.arccos(np.clip(cos, -1, 1))).max() * 3600
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+@pytest.mark.parametrize('mirror_mode', ['single_pass', 'second_pass'])
+def test_mirrored_field(solver, star_table, seed, mirror_mode):
+    x, centroids = _field(star_table, seed, mirror=True)
+    result = solver.platesolve(centroids, SHAPE, dict(OPTIONS, platesolve_mirror_mode=mirror_mode))
+    assert result['success']
+    assert result['mirror']
+    assert result['platescale/arcsec'] == pytest.approx(np.degrees(SCALE) * 3600, rel=0.01)
+    assert _match_error(result, x, mirror=True) < MAX_ERROR
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_field_is_not_taken_for_its_mirror_image(solver, star_table, seed):
+    x, centroids = _field(star_table, seed, mirror=False)
+    result = solver.platesolve(centroids, SHAPE, OPTIONS)
+    assert result['success']
+    assert not result['mirror']
+    assert _match_error(result, x, mirror=False) < MAX_ERROR
+
+def test_random_centroids_are_rejected(solver):
+    # both parities are searched, so the acceptance threshold must hold for twice the candidates
+    rng = np.random.default_rng(5)
+    for _ in range(5):
+        centroids = rng.uniform(0, 1, (60, 2)) * np.array(SHAPE)
+        assert not solver.platesolve(centroids, SHAPE, dict(OPTIONS, platesolve_progressive=False))['success']
+
+def test_acceptance_threshold_grows_with_parities(solver):
+    single = solver.estimate_acceptance_threshold(60, 30000, np.radians(20 / 3600), 12, parities=1)
+    both = solver.estimate_acceptance_threshold(60, 30000, np.radians(20 / 3600), 12, parities=2)
+    assert both >= single
@@ -0,0 +1,76 @@
+import time
+import threading
+import numpy as np
+import pytest
+from conftest import OPTIONS
+
+pytest.importorskip('tetra3') # (platesolve_triangle imports database_cache, which imports tetra3)
+import platesolve_triangle
+
+@pytest.fixture
+def stages(monkeypatch):
+    calls = []
+    state = {'success_at':None, 'during':None}
+    def helper(centroids, image_size, options, output_dir=None, f=None, g=None, tolerance=None, mirror_also=False, hint=None, cancel=None):
+        calls.append((f, g, tolerance))
+        if state['during'] is not None:
+            state['during']()
+        result = platesolve_triangle.failed_result()
+        result['success'] = len(calls) == state['success_at']
+        return result
+    monkeypatch.setattr(platesolve_triangle, '_platesolve_helper', helper)
+    return calls, state
+
+def _solve(n_stars=40, deadline=None, options={}, cancel=None):
+    centroids = np.random.default_rng(0).uniform(0, 1000, (n_stars, 2))
+    deadline = time.time() + 1000 if deadline is None else deadline
+    return platesolve_triangle._solve_progressive(centroids, (1000, 1000), dict(OPTIONS, **options), None, deadline, cancel=cancel)
+
+def test_stages_escalate_until_a_solution(stages):
+    calls, state = stages
+    state['success_at'] = 3
+    result = _solve()
+    assert calls == list(platesolve_triangle.SCHEDULE[:3])
+    assert result['success'] and result['stage'] == platesolve_triangle.SCHEDULE[2]
+
+def test_all_stages_fail(stages):
+    calls, _ = stages
+    result = _solve()
+    assert calls == list(platesolve_triangle.SCHEDULE)
+    assert not result['success'] and result['stage'] == platesolve_triangle.SCHEDULE[-1]
+
+def test_single_stage_without_progressive(stages):
+    calls, _ = stages
+    _solve(options={'platesolve_progressive':False})
+    assert calls == [(platesolve_triangle.f, platesolve_triangle.g, platesolve_triangle.TOLERANCE)]
+
+def test_stages_identical_for_few_stars_are_skipped(stages, monkeypatch):
+    calls, _ = stages
+    monkeypatch.setattr(platesolve_triangle, 'SCHEDULE', ((3, 8, 0.01), (5, 10, 0.01), (7, 12, 0.015)))
+    _solve(n_stars=4)
+    assert calls == [(3, 8, 0.01), (5, 10, 0.01), (7, 12, 0.015)] # (effective (3, 4), (4, 4), (4, 4) with a larger tolerance)
+    calls.clear()
+    _solve(n_stars=3)
+    assert calls == [(3, 8, 0.01), (7, 12, 0.015)]
+
+def test_first_stage_runs_after_the_deadline(stages):
+    calls, _ = stages
+    result = _solve(deadline=time.time() - 1)
+    assert calls == [platesolve_triangle.SCHEDULE[0]] and not result['success']
+
+def test_no_stage_is_started_once_the_deadline_passed(stages):
+    calls, state = stages
+    deadline = time.time() + 0.2
+    state['during'] = lambda: time.sleep(0.15)
+    _solve(deadline=deadline)
+    assert calls == list(platesolve_triangle.SCHEDULE[:2])
+
+def test_cancel_stops_the_escalation(stages):
+    calls, state = stages
+    cancel = threading.Event()
+    state['during'] = cancel.set
+    result = _solve(cancel=cancel)
+    assert calls == [platesolve_triangle.SCHEDULE[0]] and not result['success']
+    calls.clear()
+    _solve(cancel=cancel)
+    assert calls == []
@@ -0,0 +1,82 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+from conftest import OPTIONS
+
+pytest.importorskip('tetra3') # (platesolve_server imports database_cache)
+import platesolve_server
+
+@pytest.fixture
+def server(tmp_path):
+    server = platesolve_server._Server(0, [str(tmp_path / 'output')], {'platesolve_cache':True, 'platesolve_cache_dir':str(tmp_path / 'cache'),
+                                                                        'platesolve_ensemble_log':str(tmp_path / 'ensemble.jsonl')})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _post(server, path, payload, headers={}, content_type='application/json'):
+    req = urllib.request.Request(f'http://{platesolve_server.HOST}:{server.server_address[1]}{path}',
+                                 data=json.dumps(payload).encode('utf-8'), headers=dict(headers, **{'Content-Type':content_type}))
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def test_encode_round_trip():
+    payload = {'centroids':np.arange(6, dtype=np.float32).reshape(3, 2), 'shape':(10, 20), 'x':np.float64(1.5)}
+    decoded = platesolve_server.loads(platesolve_server.dumps(payload))
+    assert decoded['centroids'].dtype == np.float32
+    assert np.array_equal(decoded['centroids'], payload['centroids'])
+    assert decoded['x'] == 1.5
+
+def test_output_dir_inside_roots(server, tmp_path):
+    assert server.output_allowed(str(tmp_path / 'output'))
+    assert server.output_allowed(str(tmp_path / 'output' / 'run1'))
+    assert not server.output_allowed(str(tmp_path / 'output2'))
+    assert not server.output_allowed(str(tmp_path / 'output' / '..' / 'elsewhere'))
+    assert not server.output_allowed('output/run1') # (relative to the working directory of the server)
+    assert not platesolve_server._Server.output_allowed(server, None)
+
+def test_output_dir_outside_roots_is_refused(server, tmp_path):
+    status = _post(server, '/platesolve', {'centroids':[], 'image_shape':[10, 10], 'output_dir':str(tmp_path / 'elsewhere')})
+    assert status == 403
+
+def test_shutdown_needs_token(server):
+    assert _post(server, '/shutdown', {}) == 403
+    assert _post(server, '/shutdown', {}, headers={platesolve_server.TOKEN_HEADER:'0' * 32}) == 403
+    assert _post(server, '/shutdown', {}, headers={platesolve_server.TOKEN_HEADER:server.token}) == 200
+
+def test_only_json_requests_from_outside_a_browser(server):
+    token = {platesolve_server.TOKEN_HEADER:server.token}
+    assert _post(server, '/shutdown', {}, headers=token, content_type='text/plain') == 415
+    assert _post(server, '/shutdown', {}, headers=dict(token, Origin='http://example.com')) == 403
+
+def test_request_options_are_filtered(server, tmp_path):
+    options = server.solve_options({'rough_match_threshhold':30, 'platesolve_mirror_mode':'second_pass', 'flag_display':True,
+                                    'platesolve_cache':False, 'platesolve_cache_dir':'/tmp', 'platesolve_ensemble_log':'/tmp/log',
+                                    'database':'/tmp/db', 'platesolve_time_budget':[1, 2]})
+    assert options['rough_match_threshhold'] == 30 and options['platesolve_mirror_mode'] == 'second_pass'
+    assert not options['flag_display'] and options['platesolve_cache'] and options['database'] == ''
+    assert options['platesolve_cache_dir'] == str(tmp_path / 'cache')
+    assert options['platesolve_ensemble_log'] == str(tmp_path / 'ensemble.jsonl')
+    assert not 'platesolve_time_budget' in options # (not a scalar)
+
+def test_solve_writes_only_to_the_server_paths(solver, star_table, server, tmp_path):
+    import synthetic_data
+    shape = (1000, 1500)
+    centroids, _ = synthetic_data.synthetic_centroids(star_table, np.array([2.1e-4, 1.0, 0.3, 2.0]), shape, np.random.default_rng(0), n_stars=60)
+    elsewhere = tmp_path / 'elsewhere'
+    options = dict(OPTIONS, platesolve_ensemble=True, platesolve_ensemble_log=str(elsewhere / 'log.jsonl'), platesolve_cache=True,
+                   platesolve_cache_dir=str(elsewhere / 'cache'), database=str(elsewhere / 'db.npz'))
+    server.ready.set()
+    payload = {'centroids':centroids.tolist(), 'image_shape':list(shape), 'options':options, 'hint':None, 'try_mirror_also':True, 'output_dir':None}
+    assert _post(server, '/platesolve', payload) == 200
+    assert not elsewhere.exists()
+    assert len(list((tmp_path / 'cache').iterdir())) == 1
+    assert (tmp_path / 'ensemble.jsonl').exists()
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import subprocess
+import pytest
+import instrumentation
+import profiling
+
+@pytest.fixture
+def clean(monkeypatch):
+    monkeypatch.delenv(profiling.ENV_VAR, raising=False)
+    yield
+    profiling.configure({}, '.')
+
+def test_parse_patterns():
+    assert profiling._parse('') == [] and profiling._parse(None) == []
+    assert profiling._parse('platesolve.triangle_query, stack.*;;eclipse') == ['platesolve.triangle_query', 'stack.*', 'eclipse']
+    assert profiling._parse(['distortion', 'ALL']) == ['distortion', '*']
+
+def test_options_and_environment_are_combined(clean, monkeypatch, tmp_path):
+    monkeypatch.setenv(profiling.ENV_VAR, 'eclipse')
+    profiling.configure({'profile_stages':'stack.*'}, tmp_path)
+    assert profiling.is_profiled('stack.centroiding') and profiling.is_profiled('eclipse')
+    assert not profiling.is_profiled('stack') and not profiling.is_profiled('platesolve')
+    monkeypatch.delenv(profiling.ENV_VAR)
+    profiling.configure({}, tmp_path)
+    assert not profiling.is_profiled('eclipse')
+
+def test_profiles_are_written_by_finish(clean, tmp_path):
+    profiling.configure({'profile_stages':'test.*'}, tmp_path)
+    instrumentation.start_run('test')
+    for _ in range(2):
+        with instrumentation.span('test.stage'):
+            with instrumentation.span('test.nested'): # (included in the outer profile)
+                time.sleep(0.05)
+    with instrumentation.span('other'):
+        pass
+    assert not os.listdir(tmp_path)
+    profiling.finish()
+    assert sorted(os.listdir(tmp_path)) == ['PROFILE_test.stage.collapsed', 'PROFILE_test.stage.pstats']
+    with open(tmp_path / 'PROFILE_test.stage.collapsed', encoding="utf-8") as fp:
+        assert any('test_profiling:test_profiles_are_written_by_finish' in line for line in fp)
+
+def test_import_has_no_side_effects(tmp_path):
+    code = 'import profiling, instrumentation; print(profiling._state.patterns, len(instrumentation._hooks))'
+    out = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, capture_output=True, text=True, check=True,
+                         env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), **{profiling.ENV_VAR:'all'}))
+    assert out.stdout.split() == ['[]', '0']
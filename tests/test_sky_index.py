@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import pytest
+import database_lookup2
+from database_lookup2 import SkyIndex
+from conftest import make_star_table
+
+@pytest.fixture(scope='module')
+def stars():
+    return make_star_table(20000, seed=4)
+
+# (the box query before the sky index: a mask over the whole table)
+def _box_scan(star_table, range_ra, range_dec):
+    kept = np.ones(star_table.shape[0], dtype=bool)
+    ra, dec = star_table[:, 0], star_table[:, 1]
+    if range_ra is not None:
+        kept &= np.logical_and(ra > range_ra[0], ra < range_ra[1]) if range_ra[0] < range_ra[1] else np.logical_or(ra > range_ra[0], ra < range_ra[1])
+    if range_dec is not None:
+        kept &= np.logical_and(dec > range_dec[0], dec < range_dec[1]) if range_dec[0] < range_dec[1] else np.logical_or(dec > range_dec[0], dec < range_dec[1])
+    return np.flatnonzero(kept)
+
+def _cone_scan(star_table, ra, dec, radius):
+    centre = np.array([np.cos(ra) * np.cos(dec), np.sin(ra) * np.cos(dec), np.sin(dec)])
+    return np.flatnonzero(star_table[:, 2:5].astype(float) @ centre >= np.cos(radius))
+
+@pytest.mark.parametrize('range_ra, range_dec', [
+    ((10, 40), (-20, 15)),
+    ((350, 20), (30, 60)), # (through 360 degrees)
+    (None, (80, 90)),
+    ((100, 101), None),
+    ((0, 360), (-90, -85)),
+    ((200, 150), (50, -50)), # (both wrapping around)
+])
+def test_box_matches_scan(stars, range_ra, range_dec):
+    index = SkyIndex.build(stars)
+    range_ra = None if range_ra is None else np.radians(range_ra)
+    range_dec = None if range_dec is None else np.radians(range_dec)
+    assert np.array_equal(index.box(range_ra, range_dec), _box_scan(stars, range_ra, range_dec))
+
+@pytest.mark.parametrize('ra, dec, radius', [
+    (30, 10, 5), (359, -20, 8), (0.5, 0, 3), (120, 88, 4), (250, -89.5, 2), (10, 60, 40), (80, -30, 100),
+])
+def test_cone_matches_scan(stars, ra, dec, radius):
+    index = SkyIndex.build(stars)
+    ra, dec, radius = np.radians([ra, dec, radius])
+    found = index.cone(ra, dec, radius)
+    assert np.array_equal(found, _cone_scan(stars, ra, dec, radius))
+    assert found.shape[0] > 0
+
+def test_index_is_stored_and_rebuilt_for_another_table(stars, tmp_path):
+    path = str(tmp_path / 'cat_skyindex.npz')
+    index = SkyIndex.open(stars, path)
+    assert os.path.exists(path)
+    stored = SkyIndex.open(stars, path)
+    assert np.array_equal(stored.order, index.order)
+    other = make_star_table(5000, seed=5)
+    rebuilt = SkyIndex.open(other, path) # (the checksum does not match: rebuilt, and stored for the new table)
+    assert rebuilt.order.shape[0] == 5000
+    with np.load(path) as data:
+        assert str(data['checksum']) == SkyIndex.checksum(other)
+
+def test_searcher_from_star_table(stars, tmp_path):
+    path = str(tmp_path / 'cat_skyindex.npz')
+    searcher = database_lookup2.database_searcher.from_star_table(stars, path)
+    star_table, _ = searcher.cone_search(45, 20, 6, star_max_magnitude=8)
+    expected = _cone_scan(stars, *np.radians([45, 20, 6]))
+    expected = expected[stars[expected, 5] < 8]
+    assert np.array_equal(star_table, stars[expected])
+    star_table, _ = searcher.lookup_objects((40, 50), (15, 25))
+    assert np.array_equal(star_table, stars[_box_scan(stars, np.radians((40, 50)), np.radians((15, 25)))])
+    assert np.array_equal(SkyIndex.open(stars, path).order, searcher.sky_index().order)
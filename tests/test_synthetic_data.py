@@ -0,0 +1,68 @@
+import json
+import numpy as np
+import pytest
+from astropy.io import fits
+import synthetic_data
+import transforms
+
+SMALL = dict(shape=(120, 160), n_frames=3, star_density=400, mag_range=(5, 7), drift=(1.5, -2.0), jitter=0.2, seed=3)
+
+@pytest.mark.parametrize('psf', ['gaussian', 'moffat'])
+def test_psf_stamps_hold_the_flux(psf):
+    config = synthetic_data.make_config(psf=psf)
+    stamps, iy, ix = synthetic_data._psf_stamps(np.array([10.3, 50.]), np.array([20.7, 60.5]), np.array([1000., 5.]), config)
+    assert np.allclose(stamps.sum(axis=(1, 2)), [1000., 5.], rtol=2e-3)
+    k = stamps.shape[1]
+    cy, cx = np.unravel_index(np.argmax(stamps[0]), stamps[0].shape)
+    assert (iy[0] + cy, ix[0] + cx) == (10, 21) and k % 2 == 1
+
+def test_stars_off_the_image_are_clipped():
+    config = synthetic_data.make_config(shape=(20, 20))
+    img = synthetic_data.add_stars(np.zeros((20, 20)), np.array([-1., 10.]), np.array([10., 19.5]), np.array([100., 100.]), config)
+    assert 0 < img.sum() < 200
+
+def test_sequence_is_reproducible_and_drifts():
+    frames = list(synthetic_data.render_sequence(**SMALL))
+    again = list(synthetic_data.render_sequence(**SMALL))
+    assert len(frames) == 3 and all(np.array_equal(a[0], b[0]) for a, b in zip(frames, again))
+    img, truth = frames[0]
+    assert img.dtype == np.uint16 and img.shape == (120, 160) and truth['offset'] == (0., 0.)
+    for i, (_, t) in enumerate(frames):
+        assert np.allclose(t['y'] - frames[0][1]['y'], t['offset'][0]) and np.allclose(t['x'] - frames[0][1]['x'], t['offset'][1])
+        assert np.allclose(t['offset'], np.array(SMALL['drift']) * i, atol=1.5)
+    # the brightest star on the image is where the truth puts it
+    inside = (truth['y'] > 5) & (truth['y'] < 115) & (truth['x'] > 5) & (truth['x'] < 155)
+    j = np.nonzero(inside)[0][0]
+    y, x = int(round(truth['y'][j])), int(round(truth['x'][j]))
+    assert img[y, x] == img[max(y-3, 0):y+4, max(x-3, 0):x+4].max()
+
+def test_blob_is_saturated():
+    img, _ = next(synthetic_data.render_sequence(SMALL, blob_radius=20, blob_centre=(60, 80)))
+    assert img[60, 80] == 65535 and img[60, 80+25] < 65535
+
+def test_write_sequence(tmp_path):
+    files = synthetic_data.write_sequence(str(tmp_path), SMALL)
+    assert len(files) == 3
+    with open(tmp_path / 'truth.json', encoding="utf-8") as fp:
+        truth = json.load(fp)
+    assert len(truth['offsets']) == 3 and truth['config']['seed'] == 3
+    img, t = next(synthetic_data.render_sequence(**SMALL))
+    assert np.array_equal(fits.getdata(files[0]), img) and np.allclose(truth['stars']['x'], t['x'])
+
+def test_synthetic_centroids_are_the_catalogue_stars(star_table):
+    x = np.array([2.1e-4, 1.0, 0.3, 2.0])
+    shape = (1000, 1500)
+    rng = np.random.default_rng(0)
+    centroids, is_star = synthetic_data.synthetic_centroids(star_table, x, shape, rng, n_stars=50, centroid_noise=0, mag_noise=0)
+    assert centroids.shape == (50, 2) and is_star.all()
+    assert np.all((centroids >= 0) & (centroids < shape))
+    vectors = transforms.linear_transform(x, centroids - np.array(shape) / 2)
+    distance = np.min(np.linalg.norm(vectors[:, None, :] - star_table[None, :, 2:5].astype(float), axis=2), axis=1)
+    assert np.all(distance < 0.01 * x[0]) # (0.01 pixels)
+    mirrored, _ = synthetic_data.synthetic_centroids(star_table, x, shape, np.random.default_rng(0), n_stars=50, centroid_noise=0, mag_noise=0, mirror=True)
+    assert np.array_equal(mirrored, centroids[:, ::-1])
+
+def test_synthetic_centroids_with_spurious_ones(star_table):
+    x = np.array([2.1e-4, 1.0, 0.3, 2.0])
+    centroids, is_star = synthetic_data.synthetic_centroids(star_table, x, (1000, 1500), np.random.default_rng(1), n_stars=40, contamination=0.25)
+    assert centroids.shape == (50, 2) and np.sum(~is_star) == 10
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from scipy.spatial.transform import Rotation
+import transform_kernels
+
+# (the transform before the kernels: scipy rotations, one attitude at a time)
+def _reference_forward(x, q):
+    icoords = q * x[0]
+    c0 = np.cos(icoords[:, 0])
+    i1 = icoords[:, 1] / c0
+    plate = np.c_[c0 * np.cos(i1), c0 * np.sin(i1), np.sin(icoords[:, 0])]
+    return Rotation.from_euler('xyz', [x[3], -x[2], x[1]]).apply(plate)
+
+def _reference_inverse(x, v):
+    rotated = Rotation.from_euler('zyx', [-x[1], x[2], -x[3]]).apply(v)
+    icoord0 = np.arcsin(rotated[:, 2])
+    icoord1 = np.arcsin(rotated[:, 1] / np.cos(icoord0)) * np.cos(icoord0)
+    return np.c_[icoord0, icoord1] / x[0]
+
+def _attitudes(k, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.c_[rng.uniform(1e-5, 5e-4, k), rng.uniform(0, 2 * np.pi, k), rng.uniform(-np.pi / 2, np.pi / 2, k), rng.uniform(0, 2 * np.pi, k)]
+
+def _offsets(shape, seed=1):
+    return np.random.default_rng(seed).uniform(-1000, 1000, shape + (2,))
+
+def test_rotation_matrices_match_scipy():
+    attitudes = _attitudes(20)[:, 1:]
+    expected = Rotation.from_euler('xyz', np.c_[attitudes[:, 2], -attitudes[:, 1], attitudes[:, 0]]).as_matrix()
+    assert np.allclose(transform_kernels.rotation_matrices(attitudes), expected, atol=1e-14)
+
+def test_forward_matches_reference():
+    x, q = _attitudes(1)[0], _offsets((50,))
+    assert np.allclose(transform_kernels.forward(x, q), _reference_forward(x, q), atol=1e-13)
+
+def test_batched_forward_and_inverse_match_each_attitude():
+    x, q = _attitudes(8), _offsets((8, 30))
+    v = transform_kernels.forward(x, q)
+    assert v.shape == (8, 30, 3)
+    for k in range(8):
+        assert np.allclose(v[k], _reference_forward(x[k], q[k]), atol=1e-13)
+        assert np.allclose(transform_kernels.inverse(x, v)[k], _reference_inverse(x[k], v[k]), atol=1e-6)
+
+def test_inverse_round_trip():
+    x, q = _attitudes(5, seed=2), _offsets((5, 40))
+    assert np.allclose(transform_kernels.inverse(x, transform_kernels.forward(x, q)), q, atol=1e-6)
+    transform = transform_kernels.PlateTransform(x[0])
+    assert np.allclose(transform.inverse(transform.forward(q[0])), q[0], atol=1e-6)
+
+def test_inputs_are_not_modified():
+    x, q = _attitudes(3), _offsets((3, 10))
+    x_copy, q_copy = x.copy(), q.copy()
+    v = transform_kernels.forward(x, q)
+    v_copy = v.copy()
+    transform_kernels.inverse(x, v)
+    transform_kernels.icoord_to_vector(q * 1e-4)
+    assert np.array_equal(x, x_copy) and np.array_equal(q, q_copy) and np.array_equal(v, v_copy)
+
+def test_float32():
+    x, q = _attitudes(4, seed=3), _offsets((4, 25))
+    v32 = transform_kernels.forward(x, q.astype(np.float32))
+    assert v32.dtype == np.float32
+    # about 1e-7 radians
+    assert np.abs(v32 - transform_kernels.forward(x, q)).max() < 1e-6
+    assert transform_kernels.forward(x, q, dtype=np.float32).dtype == np.float32
+
+def test_icoord_to_vector_shape_check():
+    with pytest.raises(Exception):
+        transform_kernels.icoord_to_vector(np.zeros((4, 3)))
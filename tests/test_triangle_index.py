@@ -0,0 +1,137 @@
+import os
+import numpy as np
+import pytest
+from scipy.spatial import KDTree
+import triangle_database
+
+PERIOD = 2 * np.pi
+
+def _triangles(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.c_[rng.uniform(0.01, 1, n), rng.uniform(0, PERIOD, n)]
+
+def _queries(n, seed=1):
+    rng = np.random.default_rng(seed)
+    q = np.c_[rng.uniform(-0.02, 1.02, n), rng.uniform(0, PERIOD, n)]
+    q[:20, 1] = rng.choice([0.001, PERIOD - 0.001], 20) # (wrapping around in dphi)
+    return q
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    triangles = _triangles(20000)
+    path = str(tmp_path_factory.mktemp('triangles') / 'triangles.npz')
+    np.savez(path, anchors=np.arange(100), pattern_ind=np.arange(200).reshape((100, 2)), pattern_data=np.arange(300),
+             triangles=triangles.reshape((-1, 4, 2)).astype(np.float32))
+    return path, triangles.astype(np.float32).astype(float)
+
+def _reference(triangles, queries, r):
+    return [sorted(found) for found in KDTree(triangles, boxsize=[9999999, PERIOD]).query_ball_point(queries, r)]
+
+@pytest.mark.parametrize('r', [0.005, 0.01, 0.03, 1.0])
+def test_grid_index_is_exact(database, r):
+    path, triangles = database
+    directory, arrays, index = triangle_database.load(path)
+    assert isinstance(index, triangle_database.GridIndex)
+    queries = _queries(500)
+    expected = _reference(triangles, queries, r)
+    assert [sorted(found) for found in index.query_ball_point(queries, r)] == expected
+    lengths, ids = index.query_flat(queries, r)
+    assert lengths.tolist() == [len(found) for found in expected]
+    assert ids.tolist() == [i for found in expected for i in found]
+    assert sorted(index.query_ball_point(queries[0], r)) == expected[0]
+
+@pytest.mark.parametrize('index_type', ['grid', 'hash'])
+def test_query_ball_point_shapes(database, index_type):
+    path, triangles = database
+    directory, _, _ = triangle_database.load(path)
+    _, index = triangle_database.open_directory(directory, index=index_type)
+    queries = _queries(60)
+    lengths, ids = index.query_flat(queries, 0.01)
+    found = index.query_ball_point(queries.reshape((3, 20, 2)), 0.01, workers=-1, return_sorted=True)
+    assert found.shape == (3, 20)
+    assert [i for part in found.ravel() for i in part] == ids.tolist()
+    assert index.query_ball_point(queries.reshape((3, 20, 2)), 0.01, return_length=True).tolist() == lengths.reshape((3, 20)).tolist()
+    assert index.query_ball_point(queries[5], 0.01, return_length=True) == lengths[5]
+    assert index.query_ball_point(np.zeros((0, 2)), 0.01).shape == (0,)
+    assert index.query_ball_point(np.zeros((0, 2)), 0.01, return_length=True).shape == (0,)
+
+def test_hash_index_is_close(database):
+    path, triangles = database
+    directory, _, _ = triangle_database.load(path)
+    _, index = triangle_database.open_directory(directory, index='hash')
+    queries = _queries(500)
+    expected = _reference(triangles, queries, 0.01)
+    found = index.query_ball_point(queries, 0.01)
+    agreement = np.mean([set(a) == set(b) for a, b in zip(found, expected)])
+    assert agreement >= 0.99
+
+def test_conversion_is_kept_until_the_npz_changes(database):
+    path, _ = database
+    directory, arrays, _ = triangle_database.load(path)
+    assert triangle_database.is_valid(directory, path)
+    assert arrays['triangles'].shape == (5000, 4, 2)
+    mtime = os.stat(path).st_mtime
+    os.utime(path, (mtime + 10, mtime + 10))
+    assert not triangle_database.is_valid(directory, path)
+    triangle_database.load(path)
+    assert triangle_database.is_valid(directory, path)
+
+def test_converted_arrays_are_memory_mapped(database):
+    path, _ = database
+    directory, arrays, index = triangle_database.load(path)
+    with np.load(path) as data:
+        for name in triangle_database.ARRAYS:
+            assert isinstance(arrays[name], np.memmap) and np.array_equal(arrays[name], data[name])
+    assert isinstance(index.order, np.memmap)
+    assert triangle_database.read_manifest(directory)['source']['path'] == 'triangles.npz'
+
+def test_incomplete_or_corrupt_directory(database, tmp_path):
+    path, _ = database
+    directory = triangle_database.convert(path, str(tmp_path / 'converted'))
+    os.remove(os.path.join(directory, 'hash_ids.npy'))
+    assert not triangle_database.is_valid(directory)
+    directory = triangle_database.convert(path, directory)
+    assert triangle_database.is_valid(directory) and not os.path.exists(directory + '.tmp')
+    np.save(os.path.join(directory, 'anchors.npy'), np.arange(10))
+    with pytest.raises(Exception, match='corrupt'):
+        triangle_database.open_directory(directory)
+    assert not triangle_database.is_valid(str(tmp_path / 'missing'))
+
+def test_unknown_index(database):
+    path, _ = database
+    directory, _, _ = triangle_database.load(path)
+    with pytest.raises(Exception):
+        triangle_database.open_directory(directory, index='kdtree')
+
+@pytest.fixture(scope='module')
+def tiles(tmp_path_factory):
+    rng = np.random.default_rng(2)
+    anchors = rng.normal(size=(3000, 3))
+    anchors /= np.linalg.norm(anchors, axis=1)[:, None]
+    path = str(tmp_path_factory.mktemp('tiles') / 'triangles.npz')
+    np.savez(path, anchors=anchors, pattern_ind=np.arange(6000).reshape((3000, 2)), pattern_data=np.arange(9000).reshape((3000, 3)),
+             triangles=_triangles(12000).reshape((3000, 4, 2)).astype(np.float32))
+    return triangle_database.build_tiles(path)
+
+def test_tiles_are_memory_mapped_with_their_index(tiles):
+    cache = triangle_database.TileCache(tiles)
+    name = next(iter(cache.tiles))
+    arrays, index = cache.get(name)
+    assert all(isinstance(a, np.memmap) for a in arrays.values())
+    assert isinstance(index.order, np.memmap)
+    triangles = np.asarray(arrays['triangles'], dtype=float).reshape((-1, 2))
+    queries = _queries(100)
+    assert [sorted(found) for found in index.query_ball_point(queries, 0.01)] == _reference(triangles, queries, 0.01)
+
+def test_stream_stays_within_the_memory_budget(tiles):
+    budget = 3 * max(t['bytes'] for t in triangle_database.read_manifest(tiles)['tiles'])
+    cache = triangle_database.TileCache(tiles, memory_budget=budget)
+    loads = []
+    cache._load = lambda name, load=cache._load: loads.append(name) or load(name)
+    names = list(cache.tiles)
+    streamed = []
+    for name, arrays, index in cache.stream(names, n_threads=2):
+        assert len(loads) <= len(streamed) + 1 + 2 # (the tile being processed, and at most n_threads ahead)
+        assert cache.memory_used <= budget
+        streamed.append(name)
+    assert sorted(streamed) == sorted(names) and len(names) > 10
@@ -0,0 +1,121 @@
+'''
+plate transform kernels: the transforms of transforms.py (pixel offsets <-> celestial 3-vectors) with the rotation
+matrix of each attitude computed once, for one or K attitudes at a time, and without modifying their inputs
+
+an attitude x is (scale, ra, dec, roll) in radians (scale in radians per pixel), pixel offsets q are (y, x) from the
+centre of the image (as for transforms.linear_transform)
+    forward(x, q): pixel offsets -> 3-vectors, x of shape (4,) or (K, 4), q of shape (N, 2) or (K, N, 2)
+                   returns (N, 3) or (K, N, 3)
+    inverse(x, v): 3-vectors -> pixel offsets, v of shape (N, 3) or (K, N, 3)
+dtype: np.float32 (half the memory, precise to about 1e-7 radians, i.e. a few hundredths of an arcsecond)
+or np.float64 (the default for float64 / integer inputs)
+'''
+
+import numpy as np
+
+def _dtype(dtype, *arrays):
+    if dtype is not None:
+        return np.dtype(dtype)
+    return np.result_type(np.float32, *[np.asarray(a).dtype for a in arrays])
+
+'''
+rotation matrices R = Rz(ra) Ry(-dec) Rx(roll), i.e. scipy's Rotation.from_euler('xyz', [roll, -dec, ra]):
+apply roll, then declination, then RA
+attitudes: (..., 3) array of (ra, dec, roll) in radians
+returns (..., 3, 3) array
+'''
+def rotation_matrices(attitudes, dtype=np.float64):
+    attitudes = np.asarray(attitudes, dtype=np.float64)
+    ra, dec, roll = attitudes[..., 0], attitudes[..., 1], attitudes[..., 2]
+    ca, sa = np.cos(ra), np.sin(ra)
+    cd, sd = np.cos(dec), np.sin(dec)
+    cr, sr = np.cos(roll), np.sin(roll)
+    matrices = np.empty(attitudes.shape[:-1] + (3, 3), dtype=np.float64)
+    matrices[..., 0, 0] = ca * cd
+    matrices[..., 0, 1] = -ca * sd * sr - sa * cr
+    matrices[..., 0, 2] = -ca * sd * cr + sa * sr
+    matrices[..., 1, 0] = sa * cd
+    matrices[..., 1, 1] = -sa * sd * sr + ca * cr
+    matrices[..., 1, 2] = -sa * sd * cr - ca * sr
+    matrices[..., 2, 0] = sd
+    matrices[..., 2, 1] = cd * sr
+    matrices[..., 2, 2] = cd * cr
+    return matrices.astype(dtype, copy=False)
+
+def rotation_matrix(ra, dec, roll, dtype=np.float64):
+    return rotation_matrices(np.array([ra, dec, roll]), dtype)
+
+'''
+intermediate "rectilinear" coordinates (radians) -> 3-vectors, with (0, 0) -> (1, 0, 0)
+icoords: (..., 2) array, returns (..., 3) array (icoords is not modified)
+'''
+def icoord_to_vector(icoords, dtype=None):
+    icoords = np.asarray(icoords)
+    if not icoords.shape[-1] == 2:
+        raise Exception("Last dimension of shape of input must be 2!")
+    dtype = _dtype(dtype, icoords)
+    icoords = icoords.astype(dtype, copy=False)
+    c0 = np.cos(icoords[..., 0])
+    i1 = icoords[..., 1] / c0 # spherical coordinate curveture
+    out = np.empty(icoords.shape[:-1] + (3,), dtype=dtype)
+    np.multiply(c0, np.cos(i1), out=out[..., 0])
+    np.multiply(c0, np.sin(i1), out=out[..., 1]) # y -> right ascension
+    np.sin(icoords[..., 0], out=out[..., 2]) # z -> declination
+    return out
+
+'''
+3-vectors -> intermediate coordinates (the inverse of icoord_to_vector)
+'''
+def vector_to_icoord(vectors, dtype=None):
+    vectors = np.asarray(vectors)
+    dtype = _dtype(dtype, vectors)
+    vectors = vectors.astype(dtype, copy=False)
+    out = np.empty(vectors.shape[:-1] + (2,), dtype=dtype)
+    np.arcsin(vectors[..., 2], out=out[..., 0])
+    c0 = np.cos(out[..., 0])
+    out[..., 1] = np.arcsin(vectors[..., 1] / c0) * c0
+    return out
+
+# scale (broadcasting over the stars of each attitude) and rotation matrices of the attitude(s) x
+def _split(x, dtype):
+    x = np.asarray(x, dtype=np.float64)
+    scale = x[..., 0].astype(dtype)
+    return (scale[..., np.newaxis, np.newaxis] if scale.ndim else scale), rotation_matrices(x[..., 1:4], dtype)
+
+'''
+pixel offsets q -> 3-vectors under the attitude(s) x (see the top of this file for the shapes)
+'''
+def forward(x, q, dtype=None):
+    q = np.asarray(q)
+    dtype = _dtype(dtype, q)
+    scale, matrices = _split(x, dtype)
+    plate_vectors = icoord_to_vector(q.astype(dtype, copy=False) * scale, dtype)
+    return plate_vectors @ np.swapaxes(matrices, -1, -2) # (v R^T = (R v^T)^T for each vector)
+
+'''
+3-vectors v -> pixel offsets under the attitude(s) x (the inverse of forward)
+'''
+def inverse(x, v, dtype=None):
+    v = np.asarray(v)
+    dtype = _dtype(dtype, v)
+    scale, matrices = _split(x, dtype)
+    rotated = v.astype(dtype, copy=False) @ matrices # (R^T is the inverse rotation)
+    return vector_to_icoord(rotated, dtype) / scale
+
+'''
+precomputed transform of one attitude, for repeated use (e.g. matching many sets of stars under the same solution)
+'''
+class PlateTransform:
+
+    def __init__(self, x, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.scale = float(x[0])
+        self.matrix = rotation_matrix(x[1], x[2], x[3], self.dtype)
+
+    def forward(self, q):
+        q = np.asarray(q, dtype=self.dtype)
+        return icoord_to_vector(q * self.dtype.type(self.scale), self.dtype) @ self.matrix.T
+
+    def inverse(self, v):
+        v = np.asarray(v, dtype=self.dtype)
+        return vector_to_icoord(v @ self.matrix, self.dtype) / self.dtype.type(self.scale)
@@ -1,5 +1,5 @@
 import numpy as np
-from scipy.spatial.transform import Rotation
+import transform_kernels
 
 '''
 input: cartesian 3-unit-vectors
@@ -20,19 +20,10 @@ inputs:
 x: (platescale, coordinate) 4-tuple
 v: array of shape (n, 3) : n 3-vectors of star positions
 outputs: array of shape (n, 2): n 2-vectors of intermediate (i.e. pixel-like) coordinates
+(see transform_kernels.py for the batched / float32 versions of these transforms)
 '''
 def detransform_vectors(x, v):
-    scale, ra, dec, roll = x[0], x[1], x[2], x[3]
-
-    r = Rotation.from_euler('zyx', [-ra, dec, -roll])
-    rotated = r.apply(v)
-
-    icoord0 = np.arcsin(rotated[:, 2])
-
-    icoord1 = np.arcsin(rotated[:, 1] / np.cos(icoord0))
-    icoord1 *= np.cos(icoord0)
-
-    return np.array([icoord0, icoord1]).T / scale
+    return transform_kernels.inverse(x, v, dtype=np.float64)
 
 '''
 transform from intermediate "rectilinear" coordinate system icoords to
@@ -40,40 +31,23 @@ transform from intermediate "rectilinear" coordinate system icoords to
 '''
 
 def icoord_to_vector(icoords):
-    initial_shape = icoords.shape
-    if not initial_shape[-1] == 2:
-        raise Exception("Last dimension of shape of input must be 2!")
-    icoords = icoords.reshape((-1, 2))
-    icoords[:, 1] = icoords[:, 1] / np.cos(icoords[:, 0]) # spherical coordinate curveture
-    
-    vector_positions_z = np.sin(icoords[:, 0]) # z -> declination
-    vector_positions_x = np.cos(icoords[:, 0]) * np.cos(icoords[:, 1])
-    vector_positions_y = np.cos(icoords[:, 0]) * np.sin(icoords[:, 1]) # y -> right ascension
-    newshape = list(initial_shape)
-    newshape[-1]  = 3
-    return np.array([vector_positions_x, vector_positions_y, vector_positions_z]).T.reshape(tuple(newshape))
+    return transform_kernels.icoord_to_vector(icoords)
     
 '''
 transform from intermediate "rectilinear" coordinate system icoords to 
 3-vector true coordinates given (ra, dec, roll) in x 
 '''
 def rotate_icoords(x, icoords):
-    ra, dec, roll = x[0], x[1], x[2]
-    plate_vectors = icoord_to_vector(icoords)
     # apply roll, then declination, then RA
-    r = Rotation.from_euler('xyz', [roll, -dec, ra])
-    rotated = r.apply(plate_vectors)
-    return rotated
+    matrix = transform_kernels.rotation_matrix(x[0], x[1], x[2])
+    return transform_kernels.icoord_to_vector(icoords, dtype=np.float64) @ matrix.T
 
 '''
 perform a coordinate transform with rotation (ra, dec, roll) and (shearless) scaling
 so 3 + 1 = 4 degrees of freedom in x
 '''
 def linear_transform(x, q, img_shape=None):
-
-    pixel_scale = x[0] # radians per pixel
-    icoords = q * pixel_scale
-    return rotate_icoords(x[1:4], icoords)
+    return transform_kernels.forward(x, q, dtype=np.float64)
 
 '''
 # all following functions are now unused
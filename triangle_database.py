@@ -0,0 +1,481 @@
+'''
+uncompressed, versioned on-disk format of the triple triangle platesolving database
+
+the compressed TripleTriangle_pattern_data.npz has to be fully decompressed and a KDTree built
+over all triangles on every launch. Instead it is converted once into a directory of .npy files
+(next to the npz) which are opened with np.load(mmap_mode='r'), so loading takes milliseconds and
+the pages are shared between processes. The directory also holds two prebuilt search indices
+(GridIndex: triangles sorted by a quantized ratio bin, then by angle; HashIndex: fixed (ratio, angle)
+buckets with CSR offsets and compact float16 positions) and a manifest.json
+with the format version and the npz it was converted from (it is reconverted if the npz changes)
+The database can also be split into sky tiles which are loaded on demand (see build_tiles, TileCache)
+'''
+
+import os
+import json
+import shutil
+import datetime
+import threading
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+from MEE2024util import _version
+
+FORMAT_VERSION = 2
+ARRAYS = ('anchors', 'pattern_ind', 'pattern_data', 'triangles')
+INDEX_ARRAYS = ('index_order', 'index_dphi', 'index_offsets', 'hash_ids', 'hash_offsets', 'hash_residuals')
+GRID_CELL = 0.01 # width of a ratio bin (same as the triangle matching tolerance)
+DEFAULT_INDEX = 'grid' # index used by open_directory and TileCache: 'grid' (GridIndex, exact) or 'hash' (HashIndex, approximate)
+
+'''
+search index over the (ratio, dphi) triangle features with the same query_ball_point
+interface (and results) as a KDTree with boxsize=[9999999, 2*pi], i.e. periodic in dphi
+
+triangles are sorted by ratio bin, and within each bin by dphi, so a query is a binary search
+in the few bins within r of the ratio, followed by an exact distance check of the candidates
+'''
+class GridIndex:
+
+    period = 2 * np.pi
+
+    def __init__(self, triangles, order, dphi, offsets, cell):
+        self.triangles = triangles # (N x 2) all triangle features
+        self.order = order # triangle indices, sorted by (ratio bin, dphi)
+        self.dphi = dphi # dphi in that order
+        self.offsets = offsets # start of each ratio bin in order
+        self.cell = cell
+        self.n_bins = offsets.shape[0] - 1
+
+    '''
+    returns the arrays (order, dphi, offsets) of the index over triangles (N x 2)
+    '''
+    @staticmethod
+    def build(triangles, cell=GRID_CELL):
+        n_bins = int(np.ceil(1 / cell)) + 1 # ratio is in (0, 1]
+        bins = np.clip(np.floor(triangles[:, 0] / cell).astype(np.int64), 0, n_bins-1)
+        order = np.lexsort((triangles[:, 1], bins))
+        order = order.astype(np.int32 if triangles.shape[0] < 2**31 else np.int64)
+        offsets = np.r_[0, np.cumsum(np.bincount(bins, minlength=n_bins))].astype(np.int64)
+        return order, triangles[order, 1].astype(np.float32), offsets
+
+    @property
+    def nbytes(self):
+        return self.order.nbytes + self.dphi.nbytes + self.offsets.nbytes
+
+    '''
+    all (point, triangle) pairs within distance r, for points x (m x 2), as HashIndex.query_flat
+    (one binary search per ratio bin for all points touching it, instead of a search per point)
+    returns (lengths: number of triangles found per point, ids: the triangles of each point in turn, sorted by id)
+    '''
+    def query_flat(self, x, r):
+        x = np.asarray(x, dtype=float).reshape((-1, 2))
+        m = x.shape[0]
+        ratio, dphi = x[:, 0], x[:, 1] % self.period
+        b0 = np.maximum(np.floor((ratio - r) / self.cell).astype(np.int64), 0)
+        b1 = np.minimum(np.floor((ratio + r) / self.cell).astype(np.int64), self.n_bins-1)
+        # up to two dphi intervals per point (wrapping around 0 / 2 pi), an empty one is (inf, -inf)
+        if 2 * r >= self.period:
+            intervals = [(np.full(m, -np.inf), np.full(m, np.inf))]
+        else:
+            lo, hi = (dphi - r) % self.period, (dphi + r) % self.period
+            wrap = lo > hi
+            intervals = [(np.where(wrap, -np.inf, lo), hi), (np.where(wrap, lo, np.inf), np.where(wrap, np.inf, -np.inf))]
+        points, starts, counts = [], [], []
+        for b in range(int(b0.min(initial=0)), int(b1.max(initial=-1)) + 1):
+            s, e = self.offsets[b], self.offsets[b+1]
+            p = np.nonzero((b0 <= b) & (b <= b1))[0]
+            if s == e or p.size == 0:
+                continue
+            seg = self.dphi[s:e]
+            for lo, hi in intervals:
+                i0 = np.searchsorted(seg, lo[p], side='left')
+                i1 = np.searchsorted(seg, hi[p], side='right')
+                points.append(p)
+                starts.append(s + i0)
+                counts.append(np.maximum(i1 - i0, 0))
+        if not points:
+            return np.zeros(m, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        point, start, count = np.concatenate(points), np.concatenate(starts).astype(np.int64), np.concatenate(counts)
+        # expand the ranges into candidate positions in order, then check the exact distances
+        point = np.repeat(point, count)
+        pos = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(start, count)
+        cand = self.order[pos].astype(np.int64)
+        t = np.asarray(self.triangles[cand], dtype=float)
+        dp = np.abs(t[:, 1] - dphi[point]) % self.period
+        dp = np.minimum(dp, self.period - dp)
+        hit = (t[:, 0] - ratio[point])**2 + dp**2 <= r**2
+        point, found = point[hit], cand[hit]
+        order = np.lexsort((found, point))
+        return np.bincount(point, minlength=m), found[order]
+
+    '''
+    indices of all triangles within distance r of x (a single (ratio, dphi) point, or an m x 2 array), sorted
+    all points are searched at once with query_flat (so workers, accepted for compatibility with KDTree, is not needed)
+    '''
+    def query_ball_point(self, x, r, p=2., eps=0, workers=1, return_sorted=None, return_length=False):
+        return _query_ball_point(self, x, r, return_length)
+
+'''
+geometric hash index over the (ratio, dphi) triangle features, with the same query_ball_point interface
+(and, up to the float16 rounding of the stored positions, the same results) as the periodic KDTree
+
+the feature plane is cut into fixed buckets: ratio bins of width cell, and dphi bins of width 2*pi/n_phi >= cell
+(so that the bins tile the period exactly). The triangle ids are sorted by bucket (uint32), with CSR offsets per
+bucket, and the position of each triangle within its bucket is kept as two float16 fractions. A query with r <= cell
+only has to look at the 3 x 3 neighbouring buckets (wrapping around in dphi), which is done for all points at once
+(a larger r looks at correspondingly more buckets)
+'''
+class HashIndex:
+
+    period = 2 * np.pi
+
+    def __init__(self, ids, offsets, residuals, cell):
+        self.ids = ids # triangle ids sorted by bucket (uint32)
+        self.offsets = offsets # start of each bucket in ids, bucket = ratio_bin * n_phi + dphi_bin
+        self.residuals = residuals # (N x 2, float16) position of each triangle within its bucket, as fractions of the bin widths
+        self.cell = cell
+        self.n_phi = int(np.floor(self.period / cell))
+        self.cell_phi = self.period / self.n_phi
+        self.n_ratio = (offsets.shape[0] - 1) // self.n_phi
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes + self.residuals.nbytes
+
+    '''
+    returns the arrays (ids, offsets, residuals) of the index over triangles (N x 2)
+    '''
+    @staticmethod
+    def build(triangles, cell=GRID_CELL):
+        n_phi = int(np.floor(HashIndex.period / cell))
+        cell_phi = HashIndex.period / n_phi
+        n_ratio = int(np.ceil(1 / cell)) + 1 # ratio is in (0, 1]
+        ratio = np.asarray(triangles[:, 0], dtype=float)
+        dphi = np.asarray(triangles[:, 1], dtype=float) % HashIndex.period
+        rb = np.clip(np.floor(ratio / cell).astype(np.int64), 0, n_ratio-1)
+        pb = np.clip(np.floor(dphi / cell_phi).astype(np.int64), 0, n_phi-1)
+        bucket = rb * n_phi + pb
+        ids = np.argsort(bucket, kind='stable')
+        offsets = np.r_[0, np.cumsum(np.bincount(bucket, minlength=n_ratio*n_phi))]
+        offsets = offsets.astype(np.uint32 if triangles.shape[0] < 2**32 else np.uint64)
+        residuals = np.empty((triangles.shape[0], 2), dtype=np.float16)
+        residuals[:, 0] = (ratio[ids] / cell - rb[ids])
+        residuals[:, 1] = (dphi[ids] / cell_phi - pb[ids])
+        return ids.astype(np.uint32 if triangles.shape[0] < 2**32 else np.uint64), offsets, residuals
+
+    '''
+    all (point, triangle) pairs within distance r, for points x (m x 2)
+    returns (lengths: number of triangles found per point, ids: the triangles of each point in turn, sorted by id)
+    '''
+    def query_flat(self, x, r):
+        x = np.asarray(x, dtype=float).reshape((-1, 2))
+        m = x.shape[0]
+        k = max(int(np.ceil(r / min(self.cell, self.cell_phi))), 1) # how many neighbouring bins to look at on each side
+        ratio, dphi = x[:, 0], x[:, 1] % self.period
+        rb = np.floor(ratio / self.cell).astype(np.int64)
+        pb = np.floor(dphi / self.cell_phi).astype(np.int64)
+        # the (2k+1) x (2k+1) neighbouring buckets of each point (ratio bins out of range are empty, dphi bins wrap around)
+        dr, dp = np.meshgrid(np.arange(-k, k+1), np.arange(-k, k+1), indexing='ij')
+        nrb = rb[:, None] + dr.ravel()
+        npb = (pb[:, None] + dp.ravel()) % self.n_phi
+        valid = (nrb >= 0) & (nrb < self.n_ratio)
+        bucket = np.where(valid, nrb * self.n_phi + npb, 0)
+        start = self.offsets[bucket].astype(np.int64)
+        count = np.where(valid, self.offsets[bucket + 1].astype(np.int64) - start, 0).ravel()
+        # expand the CSR ranges into candidate positions in ids
+        point = np.repeat(np.repeat(np.arange(m), dr.size), count)
+        pos = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(start.ravel(), count)
+        # candidate positions, with the dphi bin unwrapped (e.g. -1 instead of n_phi-1) so no modulo is needed
+        res = self.residuals[pos]
+        cand_ratio = (np.repeat(nrb.ravel(), count) + res[:, 0]) * self.cell
+        cand_dphi = (np.repeat((pb[:, None] + dp.ravel()).ravel(), count) + res[:, 1]) * self.cell_phi
+        hit = (cand_ratio - ratio[point])**2 + (cand_dphi - dphi[point])**2 <= r**2
+        point, found = point[hit], self.ids[pos[hit]].astype(np.int64)
+        order = np.lexsort((found, point))
+        return np.bincount(point, minlength=m), found[order]
+
+    '''
+    indices of all triangles within distance r of x (a single (ratio, dphi) point, or an m x 2 array), sorted
+    all points are searched at once with query_flat (so workers, accepted for compatibility with KDTree, is not needed)
+    '''
+    def query_ball_point(self, x, r, p=2., eps=0, workers=1, return_sorted=None, return_length=False):
+        return _query_ball_point(self, x, r, return_length)
+
+'''
+KDTree.query_ball_point results from the flat (lengths, ids) of index.query_flat
+'''
+def _query_ball_point(index, x, r, return_length):
+    x = np.asarray(x, dtype=float)
+    lengths, found = index.query_flat(x, r)
+    if x.ndim == 1:
+        return int(lengths[0]) if return_length else found.tolist()
+    if return_length:
+        return lengths.reshape(x.shape[:-1])
+    out = np.empty(lengths.shape[0], dtype=object)
+    for i, part in enumerate(np.split(found, np.cumsum(lengths)[:-1]) if lengths.shape[0] else []):
+        out[i] = part.tolist()
+    return out.reshape(x.shape[:-1])
+
+'''
+directory of the uncompressed database belonging to a npz database
+'''
+def directory_for(npz_path):
+    return os.path.splitext(str(npz_path))[0] + f'_v{FORMAT_VERSION}'
+
+def _source_info(npz_path):
+    st = os.stat(npz_path)
+    return {'path':os.path.basename(str(npz_path)), 'size':st.st_size, 'mtime':st.st_mtime}
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json'), 'r', encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+'''
+is the directory a complete database of the current format (and up to date with npz_path, if that exists)?
+'''
+def is_valid(directory, npz_path=None):
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get('format_version') != FORMAT_VERSION:
+        return False
+    if not all(os.path.exists(os.path.join(directory, name + '.npy')) for name in ARRAYS + INDEX_ARRAYS):
+        return False
+    if npz_path is not None and os.path.exists(npz_path):
+        source = _source_info(npz_path)
+        if manifest['source']['size'] != source['size'] or manifest['source']['mtime'] != source['mtime']:
+            return False
+    return True
+
+'''
+convert a (compressed) npz database into the uncompressed directory format, including the search index
+the directory is written under a temporary name and renamed when complete
+'''
+def convert(npz_path, directory=None, cell=GRID_CELL):
+    directory = directory or directory_for(npz_path)
+    print(f'converting triangle database {npz_path} -> {directory}')
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    manifest = {'format':'MEE2024 triple triangle database', 'format_version':FORMAT_VERSION,
+                'created':datetime.datetime.now().isoformat(timespec='seconds'), 'software_version':_version(),
+                'source':_source_info(npz_path), 'arrays':{},
+                'index':{'types':['sorted_grid', 'hash'], 'cell':cell}}
+    with np.load(npz_path) as data:
+        arrays = {name:data[name] for name in ARRAYS}
+    order, dphi, offsets = GridIndex.build(arrays['triangles'].reshape((-1, 2)), cell)
+    arrays.update({'index_order':order, 'index_dphi':dphi, 'index_offsets':offsets})
+    ids, offsets, residuals = HashIndex.build(arrays['triangles'].reshape((-1, 2)), cell)
+    arrays.update({'hash_ids':ids, 'hash_offsets':offsets, 'hash_residuals':residuals})
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), arr)
+        manifest['arrays'][name] = {'shape':list(arr.shape), 'dtype':str(arr.dtype)}
+    with open(os.path.join(tmp, 'manifest.json'), 'w', encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=4)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    return directory
+
+'''
+memory-map a database directory
+index: 'grid' (GridIndex, same results as a KDTree) or 'hash' (HashIndex, faster to query but approximate:
+       the float16 positions can add or drop triangles right at the query radius)
+returns (dict of the arrays anchors, pattern_ind, pattern_data, triangles; the index)
+'''
+def open_directory(directory, index=DEFAULT_INDEX):
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get('format_version') != FORMAT_VERSION:
+        raise Exception(f"not a triangle database of format version {FORMAT_VERSION}: {directory}")
+    arrays = {name:np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in ARRAYS + INDEX_ARRAYS}
+    for name, info in manifest['arrays'].items():
+        if list(arrays[name].shape) != info['shape']:
+            raise Exception(f"triangle database {directory} is corrupt ({name} has shape {arrays[name].shape})")
+    if index == 'hash':
+        index = HashIndex(arrays['hash_ids'], arrays['hash_offsets'], arrays['hash_residuals'], manifest['index']['cell'])
+    elif index == 'grid':
+        index = GridIndex(arrays['triangles'].reshape((-1, 2)), arrays['index_order'], arrays['index_dphi'],
+                          arrays['index_offsets'], manifest['index']['cell'])
+    else:
+        raise Exception("unknown triangle database index: " + str(index))
+    return {name:arrays[name] for name in ARRAYS}, index
+
+'''
+open the database belonging to npz_path, converting it first if there is no up-to-date directory yet
+returns (directory, arrays, index)
+'''
+def load(npz_path):
+    directory = directory_for(npz_path)
+    if not is_valid(directory, npz_path):
+        if not os.path.exists(npz_path):
+            raise FileNotFoundError(npz_path)
+        convert(npz_path, directory)
+    arrays, index = open_directory(directory)
+    return directory, arrays, index
+
+'''
+sky-tiled variant of the database: the anchors (with their patterns and triangles) are partitioned into
+tiles of declination bands, each band cut into RA cells of about the same width on the sky.
+Every tile is a sub-directory with the four arrays and its own prebuilt search indices, which TileCache
+memory-maps when the tile is first used. TileCache keeps the recently used tiles (and their index) up to
+a byte budget, so hinted solves only ever load the few tiles around the hinted pointing, and blind
+solves stream through all tiles without holding the whole database at once
+'''
+TILES_FORMAT_VERSION = 2
+TILE_BAND = 30 # degrees: height of the declination bands
+
+def tiles_directory_for(npz_path):
+    return os.path.splitext(str(npz_path))[0] + f'_tiles_v{TILES_FORMAT_VERSION}'
+
+'''
+tile number of each (ra, dec) (radians), and the list of (dec range, ra range) of all tiles (degrees)
+'''
+def tile_layout(ra, dec, band=TILE_BAND):
+    n_bands = int(np.ceil(180 / band))
+    edges = np.linspace(-90, 90, n_bands+1)
+    n_ra = [max(1, int(round(360 * np.cos(np.radians(0.5 * (lo + hi))) / band))) for lo, hi in zip(edges[:-1], edges[1:])]
+    first = np.r_[0, np.cumsum(n_ra)]
+    b = np.clip(np.searchsorted(edges, np.degrees(dec), side='right') - 1, 0, n_bands-1)
+    cell = np.minimum((np.degrees(ra) % 360 / 360 * np.array(n_ra)[b]).astype(int), np.array(n_ra)[b] - 1)
+    tiles = [((edges[i], edges[i+1]), (360 * j / n_ra[i], 360 * (j+1) / n_ra[i])) for i in range(n_bands) for j in range(n_ra[i])]
+    return first[b] + cell, tiles
+
+def tiles_valid(directory, npz_path=None):
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get('format_version') != TILES_FORMAT_VERSION:
+        return False
+    if npz_path is not None and os.path.exists(npz_path):
+        source = _source_info(npz_path)
+        if manifest['source']['size'] != source['size'] or manifest['source']['mtime'] != source['mtime']:
+            return False
+    return True
+
+'''
+split the database of npz_path into sky tiles (reads the arrays memory-mapped from its converted directory)
+'''
+def build_tiles(npz_path, directory=None, band=TILE_BAND):
+    directory = directory or tiles_directory_for(npz_path)
+    source = directory_for(npz_path)
+    if not is_valid(source, npz_path):
+        convert(npz_path, source)
+    arrays, _ = open_directory(source)
+    print(f'splitting triangle database {npz_path} into sky tiles -> {directory}')
+    anchors = np.asarray(arrays['anchors'], dtype=float)
+    ra = np.arctan2(anchors[:, 1], anchors[:, 0]) % (2 * np.pi)
+    dec = np.arcsin(np.clip(anchors[:, 2], -1, 1))
+    tile_of, layout = tile_layout(ra, dec, band)
+    tmp = directory + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    manifest = {'format':'MEE2024 triple triangle database (sky tiles)', 'format_version':TILES_FORMAT_VERSION,
+                'created':datetime.datetime.now().isoformat(timespec='seconds'), 'software_version':_version(),
+                'source':_source_info(npz_path), 'band':band, 'cell':GRID_CELL, 'tiles':[]}
+    for t, (dec_range, ra_range) in enumerate(layout):
+        ind = np.nonzero(tile_of == t)[0]
+        if ind.shape[0] == 0:
+            continue
+        name = f'tile{t:04d}'
+        os.makedirs(os.path.join(tmp, name))
+        tile = {key:np.ascontiguousarray(arrays[key][ind]) for key in ARRAYS}
+        # the search indices of the tile are built once here, not on every load
+        order, dphi, offsets = GridIndex.build(tile['triangles'].reshape((-1, 2)), GRID_CELL)
+        tile.update({'index_order':order, 'index_dphi':dphi, 'index_offsets':offsets})
+        ids, offsets, residuals = HashIndex.build(tile['triangles'].reshape((-1, 2)), GRID_CELL)
+        tile.update({'hash_ids':ids, 'hash_offsets':offsets, 'hash_residuals':residuals})
+        n_bytes = 0
+        for key, arr in tile.items():
+            np.save(os.path.join(tmp, name, key + '.npy'), arr)
+            n_bytes += arr.nbytes
+        # bounding cap of the tile's anchors
+        centre = np.sum(anchors[ind], axis=0)
+        centre /= np.linalg.norm(centre)
+        radius = float(np.arccos(np.clip(np.min(anchors[ind] @ centre), -1, 1)))
+        manifest['tiles'].append({'name':name, 'dec':list(dec_range), 'ra':list(ra_range), 'n_anchors':int(ind.shape[0]),
+                                  'centre':centre.tolist(), 'radius':radius, 'bytes':n_bytes})
+    with open(os.path.join(tmp, 'manifest.json'), 'w', encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=4)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp, directory)
+    print(f'{len(manifest["tiles"])} tiles written')
+    return directory
+
+'''
+lazily loaded tiles of a tiled database, with a LRU memory budget
+get(name) returns (arrays, index) of a tile, memory-mapping it (index: 'grid' or 'hash', see open_directory) on first use
+'''
+class TileCache:
+
+    def __init__(self, directory, memory_budget=2**30, index=DEFAULT_INDEX):
+        if not index in ('grid', 'hash'):
+            raise Exception("unknown triangle database index: " + str(index))
+        self.directory = directory
+        self.index = index
+        self.manifest = read_manifest(directory)
+        if self.manifest is None or self.manifest.get('format_version') != TILES_FORMAT_VERSION:
+            raise Exception(f"not a tiled triangle database of format version {TILES_FORMAT_VERSION}: {directory}")
+        self.tiles = {t['name']:t for t in self.manifest['tiles']}
+        self.memory_budget = memory_budget
+        self._loaded = collections.OrderedDict() # name -> (arrays, index, bytes), least recently used first
+        self._lock = threading.Lock()
+
+    @property
+    def memory_used(self):
+        with self._lock:
+            return sum(v[2] for v in self._loaded.values())
+
+    '''
+    names of the tiles which have an anchor star within radius (radians) of the 3-vector centre (all tiles if centre is None)
+    '''
+    def tiles_near(self, centre=None, radius=np.pi):
+        if centre is None:
+            return list(self.tiles)
+        return [name for name, t in self.tiles.items()
+                if np.arccos(np.clip(np.dot(t['centre'], centre), -1, 1)) <= radius + t['radius']]
+
+    def _load(self, name):
+        path = os.path.join(self.directory, name)
+        arrays = {key:np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in ARRAYS + INDEX_ARRAYS}
+        cell = self.manifest['cell']
+        if self.index == 'grid':
+            index = GridIndex(arrays['triangles'].reshape((-1, 2)), arrays['index_order'], arrays['index_dphi'], arrays['index_offsets'], cell)
+        else:
+            index = HashIndex(arrays['hash_ids'], arrays['hash_offsets'], arrays['hash_residuals'], cell)
+        arrays = {key:arrays[key] for key in ARRAYS}
+        n_bytes = sum(a.nbytes for a in arrays.values()) + index.nbytes # (at most this much is paged in)
+        return arrays, index, n_bytes
+
+    def get(self, name):
+        with self._lock:
+            if name in self._loaded:
+                self._loaded.move_to_end(name)
+                return self._loaded[name][:2]
+        loaded = self._load(name)
+        with self._lock:
+            self._loaded[name] = loaded
+            self._loaded.move_to_end(name)
+            used = sum(v[2] for v in self._loaded.values())
+            while used > self.memory_budget and len(self._loaded) > 1:
+                _, evicted = self._loaded.popitem(last=False)
+                used -= evicted[2]
+        return loaded[:2]
+
+    '''
+    load the tiles with a pool of threads, yields (name, arrays, index) in order of completion
+    only n_threads tiles are being loaded ahead of the consumer at any time, so that streaming through
+    all tiles keeps no more tiles alive than the memory budget (and those being processed)
+    '''
+    def stream(self, names, n_threads=4):
+        names = iter(names)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            pending = {}
+            for name in itertools.islice(names, n_threads):
+                pending[executor.submit(self.get, name)] = name
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    arrays, index = future.result()
+                    for following in itertools.islice(names, 1):
+                        pending[executor.submit(self.get, following)] = following
+                    yield name, arrays, index